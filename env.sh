@@ -39,53 +39,33 @@ function _conversation_list() {
     local title
     [[ $limit -gt 0 ]] && title="最近的${limit}条对话记录" || title="所有对话记录"
 
-    # 使用 Python 处理核心逻辑
+    # 首次使用时从对话目录建立数据库目录
+    [[ -f "$GPT_PATH/.conversation/catalog.db" ]] || \
+        $GPT_PATH/.venv/bin/python $GPT_PATH/llm_query.py --rebuild-catalog >/dev/null
+
+    # 使用 Python 查询对话目录数据库
     local selection=$(CONVERSATION_LIMIT=$limit python3 -c '
-import os, sys, json
-from datetime import datetime
-
-conversation_dir = os.path.join(os.environ["GPT_PATH"], ".conversation")
-files = []
-
-# 递归扫描目录
-for root, _, filenames in os.walk(conversation_dir):
-    for fname in filenames:
-        if fname in ["index.json", ".DS_Store"] or not fname.endswith(".json"):
-            continue
-        path = os.path.join(root, fname)
-
-        try:
-            # 解析路径结构 .conversation/YYYY-MM-DD/HH-MM-SS-UUID.json
-            date_str = os.path.basename(os.path.dirname(path))
-            time_uuid = os.path.splitext(fname)[0]
-            uuid = "-".join(time_uuid.split("-")[3:])
-            time_str = ":".join(time_uuid.split("-")[0:3])
-
-            # 获取文件修改时间
-            mtime = os.path.getmtime(path)
-
-            # 读取第一条消息内容
-            preview = "N/A"
-            with open(path, "r") as f:
-                data = json.load(f)
-                if isinstance(data, list) and len(data) > 0:
-                    first_msg = data[0].get("content", "")
-                    preview = first_msg[:32].replace("\n", " ").strip()
-
-            files.append((mtime, date_str, time_str, uuid, preview, path))
-        except Exception as e:
-            continue
-
-# 按修改时间倒序排序
-files.sort(reverse=True, key=lambda x: x[0])
-
-# 应用数量限制
+import os, sqlite3
+
+catalog = os.path.join(os.environ["GPT_PATH"], ".conversation", "catalog.db")
 limit = int(os.getenv("CONVERSATION_LIMIT", "0"))
-if limit > 0:
-    files = files[:limit]
+
+try:
+    conn = sqlite3.connect(f"file:{catalog}?mode=ro", uri=True, timeout=5)
+    # 按修改时间倒序排序并应用数量限制
+    rows = conn.execute(
+        "SELECT uuid, path, preview FROM conversations ORDER BY modified DESC LIMIT ?",
+        (limit if limit > 0 else -1,),
+    ).fetchall()
+except sqlite3.Error:
+    rows = []
 
 # 生成带制表符分隔的选择列表
-for idx, (_, date, time, uuid, preview, _) in enumerate(files):
+for idx, (uuid, path, preview) in enumerate(rows):
+    # 解析路径结构 .conversation/YYYY-MM-DD/HH-MM-SS-UUID.jsonl
+    date = os.path.basename(os.path.dirname(path))
+    time = ":".join(os.path.basename(path).split("-")[0:3])
+    preview = preview or "N/A"
     print(f"{idx+1}\t{date} {time}\t{uuid}\t{preview}")
 ')
 
@@ -260,6 +240,28 @@ function askgpt() {
     $GPT_PATH/.venv/bin/python $GPT_PATH/llm_query.py --ask "$question"
 }
 
+# 启动常驻进程，askgpt/explaingpt会自动通过Unix socket复用预热好的连接
+function startgptd() {
+    nohup $GPT_PATH/.venv/bin/python $GPT_PATH/llm_query.py --daemon >>"$GPT_LOGS_DIR/daemon.log" 2>&1 &
+    echo "常驻进程已在后台启动，日志: $GPT_LOGS_DIR/daemon.log"
+}
+
+# 在后台预热并持续维护当前工作区的文件缓存
+function watchgpt() {
+    local dir="${1:-$PWD}"
+    nohup $GPT_PATH/.venv/bin/python $GPT_PATH/llm_query.py --watch "$dir" >>"$GPT_LOGS_DIR/watch.log" 2>&1 &
+    echo "已在后台监视工作区: $dir，日志: $GPT_LOGS_DIR/watch.log"
+}
+
+# 按模型汇总askgpt/explaingpt的耗时日志
+function gptstats() {
+    $GPT_PATH/.venv/bin/python $GPT_PATH/llm_query.py --stats
+}
+
+function stopgptd() {
+    pkill -f "$GPT_PATH/llm_query.py --daemon" && echo "常驻进程已停止" || echo "常驻进程未运行"
+}
+
 if [[ -n "$ZSH_VERSION" ]]; then
     _at_complete() {
         # 定义调试开关
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
+import time
+
+_MODULE_LOAD_START = time.perf_counter()
+
 import os
 import sys
-import requests
 import json
-import time
 import subprocess
 import argparse
 import string
@@ -11,17 +13,90 @@ from urllib.parse import urlparse
 from pathlib import Path
 import tempfile
 import re
-from openai import OpenAI
+import functools
+import contextlib
+import io
+import codecs
+import importlib
 import platform
-import difflib
+import hashlib
+import shutil
+import threading
+import queue
+import collections
+import array
+import math
+import mmap
+import socket
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-from pygments import highlight
-from pygments.lexers import DiffLexer
-from pygments.formatters import TerminalFormatter
+
+# openai、requests、pygments、difflib等较重的模块只在用到的路径上延迟导入
 
 MAX_FILE_SIZE = 32000
 MAX_PROMPT_SIZE = 10240
 MAX_OUTPUT_TOKEN = 32768
+MAX_CHUNK_TOKENS = 8192
+DEFAULT_CONTEXT_LIMIT = 65536
+TREE_MAX_ENTRIES = 2000
+TREE_FULL_MAX_BYTES = 2048
+TEXT_SNIFF_SIZE = 8192
+TREEFULLFILE_BUDGET = int(os.environ.get("GPT_TREEFULLFILE_BUDGET", 512 * 1024))
+TREEFULLFILE_WORKERS = 8
+# @treefullfile跳过的依赖和构建输出目录
+VENDOR_DIRS = {
+    "node_modules",
+    "bower_components",
+    "vendor",
+    "third_party",
+    "site-packages",
+    "__pycache__",
+    "venv",
+    "build",
+    "dist",
+    "target",
+    "out",
+}
+SEARCH_TOP_K = 8
+SEARCH_TOKEN_BUDGET = int(os.environ.get("GPT_SEARCH_TOKENS", 4000))
+SEARCH_WINDOW_LINES = 40
+SEARCH_MAX_FILE_BYTES = 1024 * 1024
+BM25_K1 = 1.2
+BM25_B = 0.75
+SYMBOL_MAX_MATCHES = 5
+DIRECTIVE_WORKERS = 8
+DIRECTIVE_TIMEOUT = int(os.environ.get("GPT_DIRECTIVE_TIMEOUT", 90))
+CONVERT_SERVER = os.environ.get("GPT_CONVERT_SERVER", "http://127.0.0.1:8000")
+# 每个@URL最多引入的token数，超出部分由转换服务截断
+URL_TOKEN_BUDGET = int(os.environ.get("GPT_URL_TOKENS", 12000))
+# 所有请求共用的采样参数，也参与响应缓存的键
+SAMPLING_PARAMS = {"temperature": 0.0, "top_p": 0.8, "max_tokens": MAX_OUTPUT_TOKEN}
+CACHE_DIR = Path(__file__).parent / ".cache"
+RESPONSE_CACHE_DIR = CACHE_DIR / "responses"
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("GPT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+RESPONSE_CACHE_MAX_AGE = int(os.environ.get("GPT_CACHE_MAX_AGE_DAYS", 30)) * 86400
+RESPONSE_CACHE_SWEEP_INTERVAL = 86400
+WORKSPACE_CACHE_DIR = CACHE_DIR / "workspaces"
+LINE_INDEX_MAX_BYTES = 16 * 1024 * 1024
+HISTORY_RECENT_RATIO = 0.6
+SUMMARY_MAX_TOKENS = 1024
+CHUNK_PARALLEL = int(os.environ.get("GPT_CHUNK_PARALLEL", "1"))
+CHUNK_RETRIES = 2
+DAEMON_SOCKET = os.environ.get(
+    "GPT_DAEMON_SOCKET",
+    os.path.join(
+        tempfile.gettempdir(), f"terminal-llm-{getattr(os, 'getuid', lambda: 0)()}.sock"
+    ),
+)
+DAEMON_KEEPALIVE = 300
+# 回答的终端渲染方式：stream为内置的流式渲染，glow为生成结束后调用glow，raw为原样输出
+MARKDOWN_RENDERER = os.environ.get("GPT_RENDERER", "stream")
+LOGS_DIR = Path(os.environ.get("GPT_LOGS_DIR", Path(__file__).parent / "logs"))
+TIMING_LOG_FILE = LOGS_DIR / "timings.jsonl"
+
+# 仅在常驻进程中设置，表示连接池空闲连接的保活时间
+_daemon_keepalive = None
 
 
 def parse_arguments():
@@ -33,6 +108,43 @@ def parse_arguments():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--file", help="要分析的源代码文件路径")
     group.add_argument("--ask", help="直接提供提示词内容，与--file互斥")
+    group.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="输出启动阶段各模块导入和初始化的耗时",
+    )
+    group.add_argument(
+        "--compact-conversations",
+        action="store_true",
+        help="把旧格式的对话文件迁移为日志格式，并压缩所有对话日志",
+    )
+    group.add_argument(
+        "--rebuild-catalog",
+        action="store_true",
+        help="扫描对话目录，重建对话数据库目录",
+    )
+    group.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="输出响应缓存的命中统计",
+    )
+    group.add_argument(
+        "--stats",
+        action="store_true",
+        help="按模型汇总耗时日志，输出各阶段耗时和生成速度的分位数",
+    )
+    group.add_argument(
+        "--watch",
+        nargs="?",
+        const=".",
+        metavar="DIR",
+        help="预热并持续维护工作区文件缓存，文件变化时自动更新",
+    )
+    group.add_argument(
+        "--daemon",
+        action="store_true",
+        help="以常驻进程方式运行，在Unix socket上复用已预热的客户端",
+    )
     parser.add_argument(
         "--prompt-file",
         default=os.path.expanduser("~/.llm/source-query.txt"),
@@ -41,8 +153,30 @@ def parse_arguments():
     parser.add_argument(
         "--chunk-size",
         type=int,
-        default=MAX_FILE_SIZE,
-        help="代码分块大小（字符数，仅在使用--file时有效）",
+        default=MAX_CHUNK_TOKENS,
+        help="代码分块大小（估算token数，仅在使用--file时有效）",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=CHUNK_PARALLEL,
+        help="分块并发请求数，大于1时各分块并发处理（仅在使用--file时有效）",
+    )
+    parser.add_argument(
+        "--chunk-retries",
+        type=int,
+        default=CHUNK_RETRIES,
+        help="并发模式下单个分块失败后的重试次数",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="绕过响应缓存，既不读取也不写入",
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="忽略已缓存的响应，重新请求并更新缓存",
     )
     parser.add_argument(
         "--obsidian-doc",
@@ -98,79 +232,304 @@ def detect_proxies():
     return proxies, sources
 
 
-def split_code(content, chunk_size):
-    """将代码内容分割成指定大小的块
-    注意：当前实现适用于英文字符场景，如需支持多语言建议改用更好的分块算法"""
-    return [content[i : i + chunk_size] for i in range(0, len(content), chunk_size)]
+# 支持语法感知分块的语言，对应pyproject.toml中的tree-sitter语法包
+TREE_SITTER_LANGUAGES = {
+    ".py": "python",
+    ".c": "c",
+    ".h": "c",
+    ".cpp": "cpp",
+    ".cc": "cpp",
+    ".cxx": "cpp",
+    ".hpp": "cpp",
+    ".hh": "cpp",
+    ".js": "javascript",
+    ".mjs": "javascript",
+    ".jsx": "javascript",
+}
+
+_CJK_PATTERN = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\u3000-\u303f\uff00-\uffef]"
+)
+
+
+def estimate_tokens(text):
+    """粗略估算token数：中日韩字符约每字1个token，其它字符约每4个字符1个token"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@functools.lru_cache(maxsize=None)
+def get_tree_sitter_parser(language):
+    """加载指定语言的tree-sitter解析器，依赖缺失时返回None"""
+    try:
+        import tree_sitter
+
+        grammar = importlib.import_module(f"tree_sitter_{language}")
+        return tree_sitter.Parser(tree_sitter.Language(grammar.language()))
+    except Exception:
+        return None
+
+
+def _split_lines(content):
+    """按\\n切分并保留换行符，与tree-sitter的行号保持一致"""
+    return re.findall(r"[^\n]*\n|[^\n]+\Z", content)
 
 
-INDEX_PATH = Path(__file__).parent / ".conversation" / "index.json"
+def syntax_units(content, file_path=None):
+    """把内容切成语法单元，返回[(起始行, 结束行)]，行号从0开始、结束行不包含
 
+    已知语言按顶层定义切分，紧邻的前置注释归入后面的定义；
+    未知语言或解析失败时每一行就是一个单元。
+    """
+    lines = _split_lines(content)
+    language = TREE_SITTER_LANGUAGES.get(Path(file_path or "").suffix.lower())
+    parser = get_tree_sitter_parser(language) if language else None
+    if parser is None:
+        return [(i, i + 1) for i in range(len(lines))]
+
+    tree = parser.parse(content.encode("utf-8"))
+    boundaries = {0}
+    previous = None
+    for node in tree.root_node.named_children:
+        row = node.start_point[0]
+        attached = (
+            previous is not None
+            and previous.type == "comment"
+            and previous.end_point[0] >= row - 1
+        )
+        if not attached:
+            boundaries.add(row)
+        previous = node
+    starts = sorted(b for b in boundaries if b < len(lines))
+    return list(zip(starts, starts[1:] + [len(lines)]))
+
+
+def _split_oversized(text, max_tokens):
+    """把超出预算的单个单元按行、必要时按字符继续切分"""
+    pieces = []
+    current = ""
+    current_tokens = 0
+    for line in _split_lines(text):
+        while estimate_tokens(line) > max_tokens:
+            # 单行超长，二分查找不超过预算的最长前缀硬切，至少切下一个字符
+            low, high = 1, len(line) - 1
+            while low < high:
+                middle = (low + high + 1) // 2
+                if estimate_tokens(line[:middle]) <= max_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            cut = low
+            if current:
+                pieces.append(current)
+                current, current_tokens = "", 0
+            pieces.append(line[:cut])
+            line = line[cut:]
+        tokens = estimate_tokens(line)
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append(current)
+            current, current_tokens = "", 0
+        current += line
+        current_tokens += tokens
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_code(content, max_tokens, file_path=None):
+    """按语法结构把代码切成不超过max_tokens个token的块
+
+    顶层定义尽量保持完整并按预算装箱，超大的定义再按行切分，
+    不认识的语言直接按行装箱。
+    """
+    lines = _split_lines(content)
+    chunks = []
+    current = ""
+    current_tokens = 0
+    for start, end in syntax_units(content, file_path):
+        unit = "".join(lines[start:end])
+        tokens = estimate_tokens(unit)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        if tokens > max_tokens:
+            chunks.extend(_split_oversized(unit, max_tokens))
+            continue
+        current += unit
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+CONVERSATION_DIR = Path(__file__).parent / ".conversation"
+CATALOG_PATH = CONVERSATION_DIR / "catalog.db"
+CATALOG_PREVIEW_SIZE = 64
+
+
+@contextlib.contextmanager
+def _open_catalog():
+    """打开对话目录数据库，WAL模式下多个终端可以同时读写"""
+    import sqlite3
+
+    CONVERSATION_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(CATALOG_PATH, timeout=10)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                uuid TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                created REAL NOT NULL,
+                modified REAL NOT NULL,
+                turns INTEGER NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL DEFAULT 0,
+                preview TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS conversations_modified ON conversations(modified);
+            CREATE INDEX IF NOT EXISTS conversations_path ON conversations(path);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        with conn:
+            yield conn
+    finally:
+        conn.close()
 
-def _ensure_index():
-    """确保索引文件存在，不存在则创建空索引"""
-    if not INDEX_PATH.exists():
-        INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
-        with open(INDEX_PATH, "w") as f:
-            json.dump({}, f)
 
+def _make_preview(messages):
+    """取第一条消息的开头作为预览"""
+    if not messages:
+        return ""
+    content = messages[0].get("content", "")
+    return content[:CATALOG_PREVIEW_SIZE].replace("\n", " ").strip()
 
-def _update_index(uuid, file_path):
-    """更新索引文件"""
-    _ensure_index()
-    with open(INDEX_PATH, "r+") as f:
-        index = json.load(f)
-        index[uuid] = str(file_path)
-        f.seek(0)
-        json.dump(index, f, indent=4)
-        f.truncate()
 
+# 对话文件名：时间戳 + UUID，.jsonl为日志格式，.json为旧格式
+_CONVERSATION_FILE = re.compile(r"^\d{1,2}-\d{1,2}-\d{1,2}-(.+?)\.(jsonl|json)$")
 
-def _build_index():
-    """遍历目录构建索引"""
-    index = {}
-    conv_dir = Path(__file__).parent / ".conversation"
 
-    # 匹配文件名模式：任意时间戳 + UUID
-    pattern = re.compile(r"^\d{1,2}-\d{1,2}-\d{1,2}-(.+?)\.json$")
+def _scan_conversation(path):
+    """从对话文件统计轮数、预览和创建时间，用于重建目录
 
-    for root, _, files in os.walk(conv_dir):
+    创建时间取第一条日志记录的时间，追加新轮次不会改变它；
+    空日志和旧格式文件没有记录时间，退回文件的创建时间。
+    """
+    created = None
+    if path.endswith(".jsonl"):
+        records, _ = _read_journal(path)
+        turns = len(records)
+        preview = _make_preview(records[0]["messages"]) if records else ""
+        if records:
+            created = records[0].get("time")
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            history = json.load(f)
+        turns = sum(1 for message in history if message.get("role") == "user")
+        preview = _make_preview(history)
+    return turns, preview, created
+
+
+def _catalog_row(uuid, path):
+    """统计单个对话文件，返回目录表的一行"""
+    stat = os.stat(path)
+    turns, preview, created = _scan_conversation(path)
+    if created is None:
+        created = getattr(stat, "st_birthtime", min(stat.st_ctime, stat.st_mtime))
+    return (uuid, path, created, stat.st_mtime, turns, stat.st_size, preview)
+
+
+def rebuild_catalog():
+    """遍历对话目录重建数据库目录"""
+    found = {}
+    for root, _, files in os.walk(CONVERSATION_DIR):
         for filename in files:
-            # 跳过索引文件本身
-            if filename == "index.json":
+            match = _CONVERSATION_FILE.match(filename)
+            if not match:
+                continue
+            uuid = match.group(1)
+            # 迁移中断时新旧文件可能同时存在，以日志文件为准
+            if match.group(2) == "json" and (
+                found.get(uuid, "").endswith(".jsonl")
+                or Path(root, filename).with_suffix(".jsonl").exists()
+            ):
                 continue
+            found[uuid] = os.path.join(root, filename)
+
+    with _open_catalog() as conn:
+        # 已登记的对话保留更早的创建时间
+        known = dict(conn.execute("SELECT uuid, created FROM conversations"))
+    rows = []
+    for uuid, path in found.items():
+        try:
+            row = _catalog_row(uuid, path)
+        except (OSError, ValueError, KeyError):
+            continue
+        if uuid in known:
+            row = row[:2] + (min(known[uuid], row[2]),) + row[3:]
+        rows.append(row)
+
+    with _open_catalog() as conn:
+        conn.execute("DELETE FROM conversations")
+        conn.executemany(
+            "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('scanned', ?)", (str(time.time()),))
+    return {uuid: path for uuid, path, *_ in rows}
+
 
-            match = pattern.match(filename)
-            if match:
-                uuid = match.group(1)
-                full_path = Path(root) / filename
-                index[uuid] = str(full_path)
+def _register_conversation(uuid):
+    """目录中没有的对话(例如旧版客户端写入的)按文件名单独查找并登记，找不到返回None"""
+    import glob
 
-    with open(INDEX_PATH, "w") as f:
-        json.dump(index, f, indent=4)
+    paths = [
+        path
+        for path in CONVERSATION_DIR.glob(f"*/*-{glob.escape(uuid)}.json*")
+        if (match := _CONVERSATION_FILE.match(path.name)) and match.group(1) == uuid
+    ]
+    if not paths:
+        return None
+    # 迁移中断时新旧文件可能同时存在，以日志文件为准
+    path = str(max(paths, key=lambda path: path.suffix == ".jsonl"))
+    try:
+        row = _catalog_row(uuid, path)
+    except (OSError, ValueError, KeyError):
+        return None
+    with _open_catalog() as conn:
+        conn.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+    return path
 
-    return index
+
+def _lookup_catalog(uuid):
+    """在目录中查找对话文件，返回(路径, 是否已完成过全量扫描)"""
+    with _open_catalog() as conn:
+        row = conn.execute(
+            "SELECT path FROM conversations WHERE uuid = ?", (uuid,)
+        ).fetchone()
+        scanned = conn.execute("SELECT 1 FROM meta WHERE key = 'scanned'").fetchone()
+    return (row[0] if row else None), bool(scanned)
 
 
 def get_conversation(uuid):
-    """获取对话记录"""
-    try:
-        # 先尝试读取索引
-        with open(INDEX_PATH, "r") as f:
-            index = json.load(f)
-            if uuid in index:
-                path = Path(index[uuid])
-                if path.exists():
-                    return path
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
+    """获取对话记录，旧格式的.json文件会先迁移为.jsonl日志"""
+    path, scanned = _lookup_catalog(uuid)
+    if path is None and scanned:
+        # 已全量扫描过，只按文件名查找这一个对话
+        path = _register_conversation(uuid)
+        if path is None:
+            raise FileNotFoundError(f"Conversation with UUID {uuid} not found")
 
-    # 索引不存在或查找失败，重新构建索引
-    index = _build_index()
-    if uuid in index:
-        return index[uuid]
+    if path is None or not os.path.exists(path):
+        # 首次使用目录，或文件被移动过，全量扫描一次
+        path = rebuild_catalog().get(uuid)
+        if path is None:
+            raise FileNotFoundError(f"Conversation with UUID {uuid} not found")
 
-    raise FileNotFoundError(f"Conversation with UUID {uuid} not found")
+    if path.endswith(".json"):
+        path = migrate_conversation(path)
+    return path
 
 
 def new_conversation(uuid):
@@ -183,48 +542,971 @@ def new_conversation(uuid):
 
     # 构建完整路径
     base_dir = Path(__file__).parent / ".conversation" / date_dir
-    filename = f"{time_str}-{uuid}.json"
+    filename = f"{time_str}-{uuid}.jsonl"
     file_path = base_dir / filename
 
     # 确保目录存在
     base_dir.mkdir(parents=True, exist_ok=True)
 
-    # 写入初始数据并更新索引
-    with open(file_path, "w") as f:
-        json.dump([], f, indent=4)
+    # 创建空日志并登记到目录
+    file_path.touch()
 
-    _update_index(uuid, file_path)
+    now = time.time()
+    with _open_catalog() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO conversations (uuid, path, created, modified) "
+            "VALUES (?, ?, ?, ?)",
+            (uuid, str(file_path), now, now),
+        )
     return str(file_path)
 
 
+def _read_journal(file_path):
+    """读取对话日志，返回(记录列表, 是否存在损坏行)"""
+    records = []
+    damaged = False
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 写入中途崩溃留下的残缺记录
+                damaged = True
+    return records, damaged
+
+
+@contextlib.contextmanager
+def _file_lock(lock_path):
+    """用flock对lock_path加排他锁，排斥其他进程；没有fcntl的平台(Windows)不加锁"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+_journal_thread_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _journal_lock():
+    """对话日志的排他锁，追加、压缩和迁移都在锁内进行
+
+    多个终端可能同时写同一个对话；锁文件固定不变，
+    不会像日志本身那样在压缩时被替换成新的inode。
+    """
+    CONVERSATION_DIR.mkdir(parents=True, exist_ok=True)
+    with _journal_thread_lock, _file_lock(CONVERSATION_DIR / "journal.lock"):
+        yield
+
+
+def _write_journal(file_path, records):
+    """把记录整体写入唯一的临时文件后原子替换，用于迁移和压缩，调用方需持有_journal_lock"""
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=os.path.dirname(file_path), suffix=".tmp", delete=False
+    ) as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, file_path)
+
+
 def load_conversation_history(file_path):
-    """加载对话历史文件"""
+    """加载对话历史日志，展开为消息列表"""
     try:
-        if os.path.exists(file_path):
-            with open(file_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        return []
+        if not os.path.exists(file_path):
+            return []
+        records, damaged = _read_journal(file_path)
+        if damaged:
+            compact_conversation(file_path)
+        return [message for record in records for message in record["messages"]]
     except Exception as e:
         print(f"加载对话历史失败: {e}")
         return []
 
 
-def save_conversation_history(file_path, history):
-    """保存对话历史到文件"""
+def append_conversation_turn(file_path, messages):
+    """把一轮对话作为一条记录追加到日志并落盘，崩溃时最多丢失这一轮"""
+    record = {"time": time.time(), "messages": messages}
+    line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
+        with _journal_lock(), open(file_path, "a+b") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # 上次写入被中断，先补换行把残缺记录隔开
+                    f.write(b"\n")
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        with _open_catalog() as conn:
+            conn.execute(
+                "UPDATE conversations SET modified = ?, turns = turns + 1, size = ?, "
+                "preview = CASE WHEN preview = '' THEN ? ELSE preview END "
+                "WHERE path = ?",
+                (record["time"], size, _make_preview(messages), str(file_path)),
+            )
     except Exception as e:
         print(f"保存对话历史失败: {e}")
 
 
+def compact_conversation(file_path):
+    """压缩对话日志：丢弃残缺记录，重写为整齐的一轮一行"""
+    with _journal_lock():
+        # 在锁内重新读取，不会丢掉其他终端刚追加的轮次
+        records, _ = _read_journal(file_path)
+        _write_journal(file_path, records)
+
+
+def migrate_conversation(json_path):
+    """把旧格式的.json对话文件迁移为.jsonl日志，返回新路径"""
+    journal_path = str(Path(json_path).with_suffix(".jsonl"))
+    with _journal_lock():
+        _migrate_locked(json_path, journal_path)
+    with _open_catalog() as conn:
+        conn.execute(
+            "UPDATE conversations SET path = ?, size = ? WHERE path = ?",
+            (journal_path, os.path.getsize(journal_path), json_path),
+        )
+    return journal_path
+
+
+def _migrate_locked(json_path, journal_path):
+    """在_journal_lock内把旧格式文件转换为日志并删除旧文件"""
+    if not os.path.exists(json_path):
+        # 其他终端已经完成了迁移
+        return
+    if os.path.exists(journal_path):
+        # 上次迁移在删除旧文件前中断：日志是原子写入的，之后还可能追加过新轮次，
+        # 再迁移一次会用旧内容覆盖它，只删除旧文件
+        print(f"对话日志已存在，删除迁移中断遗留的旧文件: {json_path}")
+        os.unlink(json_path)
+    else:
+        with open(json_path, "r", encoding="utf-8") as f:
+            history = json.load(f)
+
+        # 按用户提问切分成轮次，每轮一条记录
+        records = []
+        mtime = os.path.getmtime(json_path)
+        for message in history:
+            if message.get("role") == "user" or not records:
+                records.append({"time": mtime, "messages": []})
+            records[-1]["messages"].append(message)
+
+        _write_journal(journal_path, records)
+        os.unlink(json_path)
+
+
+def compact_all_conversations():
+    """迁移所有旧格式对话并压缩全部日志"""
+    migrated = stale = compacted = 0
+    for path in sorted(CONVERSATION_DIR.rglob("*.json")):
+        if path.name == "index.json":
+            continue
+        if path.with_suffix(".jsonl").exists():
+            stale += 1
+        else:
+            migrated += 1
+        migrate_conversation(str(path))
+    for path in sorted(CONVERSATION_DIR.rglob("*.jsonl")):
+        compact_conversation(str(path))
+        compacted += 1
+    rebuild_catalog()
+    print(f"已迁移 {migrated} 个旧对话文件，清理 {stale} 个迁移中断遗留的旧文件，压缩 {compacted} 个对话日志")
+
+
+def _resolve_conversation_file(conversation_file):
+    """根据GPT_UUID_CONVERSATION定位对话文件，不存在则新建"""
+    cid = os.environ.get("GPT_UUID_CONVERSATION")
+    if cid:
+        try:
+            conversation_file = get_conversation(cid)
+            # print("旧对话: %s\n" % conversation_file)
+        except FileNotFoundError:
+            conversation_file = new_conversation(cid)
+            # print("开新对话: %s\n" % conversation_file)
+    return conversation_file
+
+
+def _print_stream(kind, text):
+    """默认的流式输出：推理内容和正式回复直接打印到终端"""
+    print(text, end="", flush=True)
+
+
+_ANSI_RESET = "\033[0m"
+_ANSI_BOLD = "\033[1m"
+_ANSI_DIM = "\033[2m"
+_ANSI_ITALIC = "\033[3m"
+_ANSI_UNDERLINE = "\033[4m"
+_ANSI_HEADING = "\033[1;36m"
+_ANSI_CODE = "\033[33m"
+_MD_FENCE = re.compile(r"^\s*(`{3,}|~{3,})\s*([\w+#.-]*)")
+_MD_HEADING = re.compile(r"^(#{1,6})\s+(.*)")
+_MD_RULE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+_MD_BULLET = re.compile(r"^(\s*)[-*+]\s+(.*)")
+_MD_NUMBERED = re.compile(r"^(\s*)(\d+[.)])\s+(.*)")
+_MD_QUOTE = re.compile(r"^\s*>\s?(.*)")
+_MD_BOLD = re.compile(r"\*\*(.+?)\*\*|__(.+?)__")
+_MD_ITALIC = re.compile(r"(?<![*\w])\*(?![\s*])(.+?)(?<![\s*])\*(?![*\w])")
+_MD_LINK = re.compile(r"\[([^\]]+)\]\(([^)\s]+)\)")
+
+
+class MarkdownStreamRenderer:
+    """流式Markdown终端渲染，作为emit回调使用
+
+    完整的行立即按块类型格式化输出，代码块逐行用pygments高亮；
+    只缓存尚未换行的半行，过长的段落行在标记成对的空格处提前输出。
+    输出不是终端时原样打印。
+    """
+
+    PARTIAL_FLUSH = 80
+
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.color = self.out.isatty()
+        self.kind = None
+        self.pending = ""
+        self.fence = None
+        self.lexer = None
+        self.formatter = None
+        # 当前行已部分输出时保存其块样式(前缀, 样式)，行结束时清空
+        self.block = None
+
+    def write(self, text):
+        self.out.write(text)
+        self.out.flush()
+
+    def emit(self, kind, text):
+        if not self.color:
+            self.write(text)
+            return
+        if kind != self.kind:
+            if self.kind == "reasoning":
+                self.write(_ANSI_RESET + "\n")
+            self.kind = kind
+        if kind == "reasoning":
+            # 推理内容只做弱化显示，不解析Markdown
+            self.write(_ANSI_DIM + text)
+            return
+        self.pending += text
+        *lines, self.pending = self.pending.split("\n")
+        for line in lines:
+            self.render_line(line)
+            self.write("\n")
+        self.flush_partial()
+
+    def finish(self):
+        """输出剩余的半行并复位终端样式"""
+        if not self.color:
+            return
+        if self.pending:
+            self.render_line(self.pending)
+            self.pending = ""
+        if self.kind == "reasoning":
+            self.write(_ANSI_RESET)
+        self.kind = None
+
+    def flush_partial(self):
+        """段落行过长时，在标记成对的最后一个空格处切分并提前输出前半部分"""
+        if self.fence or len(self.pending) < self.PARTIAL_FLUSH:
+            return
+        if self.block is None and _MD_FENCE.match(self.pending):
+            return
+        cut = len(self.pending)
+        while True:
+            cut = self.pending.rfind(" ", 0, cut)
+            if cut <= 0:
+                return
+            head = self.pending[: cut + 1]
+            if not (head.count("**") % 2 or head.count("`") % 2 or head.count("[") != head.count("]")):
+                break
+        if self.block is None:
+            self.block = self.block_style(head)
+            prefix, style, head = self.block
+            self.write(prefix)
+        else:
+            style = self.block[1]
+        self.write(style + self.inline(head, style) + _ANSI_RESET)
+        self.pending = self.pending[cut + 1 :]
+
+    def block_style(self, line):
+        """识别行首的块类型，返回(前缀, 样式, 去掉标记后的内容)"""
+        heading = _MD_HEADING.match(line)
+        if heading:
+            return "", _ANSI_HEADING, heading.group(2)
+        bullet = _MD_BULLET.match(line)
+        if bullet:
+            return f"{bullet.group(1)}  • ", "", bullet.group(2)
+        numbered = _MD_NUMBERED.match(line)
+        if numbered:
+            return f"{numbered.group(1)}  {numbered.group(2)} ", "", numbered.group(3)
+        quote = _MD_QUOTE.match(line)
+        if quote:
+            return _ANSI_DIM + "│ " + _ANSI_RESET, _ANSI_ITALIC, quote.group(1)
+        return "", "", line
+
+    def render_line(self, line):
+        if self.fence:
+            if line.strip().startswith(self.fence) and not line.strip().strip(self.fence[0]):
+                self.fence = None
+                self.write(_ANSI_DIM + line + _ANSI_RESET)
+            else:
+                self.write(self.highlight(line))
+            return
+        if self.block is not None:
+            # 半行已输出，剩余部分沿用同一块样式
+            style = self.block[1]
+            self.block = None
+            self.write(style + self.inline(line, style) + _ANSI_RESET)
+            return
+        fence = _MD_FENCE.match(line)
+        if fence:
+            self.fence = fence.group(1)
+            self.lexer = self.get_lexer(fence.group(2))
+            self.write(_ANSI_DIM + line + _ANSI_RESET)
+            return
+        if _MD_RULE.match(line):
+            self.write(_ANSI_DIM + "─" * min(shutil.get_terminal_size().columns, 80) + _ANSI_RESET)
+            return
+        prefix, style, text = self.block_style(line)
+        self.write(prefix + style + self.inline(text, style) + _ANSI_RESET)
+
+    def inline(self, text, style=""):
+        """行内样式：`代码`、**粗体**、*斜体*和[链接](地址)，代码内不再解析"""
+        parts = text.split("`")
+        for i, part in enumerate(parts):
+            if i % 2:
+                parts[i] = _ANSI_CODE + part + _ANSI_RESET + style
+                continue
+            # 链接最先处理，避免匹配到其它样式生成的转义序列中的"["
+            part = _MD_LINK.sub(
+                lambda m: _ANSI_UNDERLINE + m.group(1) + _ANSI_RESET + style
+                + _ANSI_DIM + f" ({m.group(2)})" + _ANSI_RESET + style,
+                part,
+            )
+            part = _MD_BOLD.sub(
+                lambda m: _ANSI_BOLD + (m.group(1) or m.group(2)) + _ANSI_RESET + style, part
+            )
+            parts[i] = _MD_ITALIC.sub(
+                lambda m: _ANSI_ITALIC + m.group(1) + _ANSI_RESET + style, part
+            )
+        return "".join(parts)
+
+    def get_lexer(self, language):
+        from pygments.lexers import get_lexer_by_name, TextLexer
+        from pygments.util import ClassNotFound
+
+        try:
+            return get_lexer_by_name(language or "text", stripnl=False, ensurenl=False)
+        except ClassNotFound:
+            return TextLexer()
+
+    def highlight(self, line):
+        from pygments import highlight
+        from pygments.formatters import TerminalFormatter
+
+        if self.formatter is None:
+            self.formatter = TerminalFormatter()
+        return highlight(line, self.lexer, self.formatter)
+
+
+def load_model_config():
+    """读取model.json中的供应商配置，文件不存在时返回空配置"""
+    config_file = Path(os.environ.get("GPT_PATH", Path(__file__).parent)) / "model.json"
+    try:
+        with open(config_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+_openai_clients = {}
+_openai_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key, base_url, keepalive=None):
+    """按供应商复用OpenAI客户端，keepalive指定连接池中空闲连接的保活秒数"""
+    key = (api_key, base_url)
+    with _openai_clients_lock:
+        client = _openai_clients.get(key)
+        if client is None:
+            import httpx
+            from openai import OpenAI, DefaultHttpxClient
+
+            http_client = None
+            if keepalive:
+                http_client = DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=100,
+                        max_keepalive_connections=20,
+                        keepalive_expiry=keepalive,
+                    )
+                )
+            client = OpenAI(
+                api_key=api_key, base_url=base_url, http_client=http_client
+            )
+            _openai_clients[key] = client
+        return client
+
+
+def _stream_chat_local(api_key, base_url, model, messages, emit):
+    """在当前进程内发起流式请求"""
+    client = get_openai_client(api_key, base_url, keepalive=_daemon_keepalive)
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        **SAMPLING_PARAMS,
+    )
+
+    content = ""
+    reasoning = ""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        # 处理推理内容（仅打印不保存）
+        if getattr(delta, "reasoning_content", None):
+            emit("reasoning", delta.reasoning_content)
+            reasoning += delta.reasoning_content
+        # 处理正式回复内容
+        if delta.content:
+            emit("content", delta.content)
+            content += delta.content
+    return content, reasoning
+
+
+class DaemonUnavailable(Exception):
+    """常驻进程未启动或无法连接"""
+
+
+def _stream_chat_via_daemon(api_key, base_url, model, messages, emit):
+    """通过Unix socket把请求交给常驻进程，并转发其流式输出"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(DAEMON_SOCKET)
+    except OSError as e:
+        sock.close()
+        raise DaemonUnavailable(str(e)) from e
+
+    request = {
+        "api_key": api_key,
+        "base_url": base_url,
+        "model": model,
+        "messages": messages,
+    }
+    with sock, sock.makefile("rwb") as stream:
+        stream.write(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        stream.flush()
+        for line in stream:
+            event = json.loads(line)
+            if event["type"] in ("reasoning", "content"):
+                emit(event["type"], event["text"])
+            elif event["type"] == "done":
+                return event["content"], event["reasoning"]
+            elif event["type"] == "error":
+                raise RuntimeError(event["error"])
+    raise RuntimeError("常驻进程连接意外断开")
+
+
+# 响应缓存模式：use读写缓存，refresh只写不读，off完全绕过
+RESPONSE_CACHE_OPTIONS = {"mode": os.environ.get("GPT_RESPONSE_CACHE", "use")}
+
+
+def _response_cache_key(base_url, model, messages):
+    """根据供应商、模型、消息和采样参数计算缓存键"""
+    payload = json.dumps(
+        {
+            "base_url": base_url,
+            "model": model,
+            "messages": messages,
+            "params": SAMPLING_PARAMS,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _response_cache_path(key):
+    return RESPONSE_CACHE_DIR / key[:2] / f"{key}.json"
+
+
+_cache_stats_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _locked_cache_stats():
+    """加锁读写缓存统计文件，线程锁之外再用文件锁排斥其他进程
+
+    产出统计字典，退出时经临时文件原子替换写回。
+    """
+    stats_path = RESPONSE_CACHE_DIR / "stats.json"
+    RESPONSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with _cache_stats_lock, _file_lock(RESPONSE_CACHE_DIR / "stats.lock"):
+        try:
+            with open(stats_path, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            stats = {}
+        yield stats
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=RESPONSE_CACHE_DIR, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(stats, f)
+        os.replace(f.name, stats_path)
+
+
+def _record_cache_stat(field):
+    """累加缓存命中/未命中计数"""
+    try:
+        with _locked_cache_stats() as stats:
+            stats[field] = stats.get(field, 0) + 1
+    except OSError:
+        pass
+
+
+def _read_response_cache(key):
+    """读取缓存的响应，过期或不存在时返回None，命中时刷新使用时间"""
+    path = _response_cache_path(key)
+    try:
+        if time.time() - path.stat().st_mtime > RESPONSE_CACHE_MAX_AGE:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        os.utime(path)
+        return entry
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _evict_response_cache():
+    """删除过期的缓存，总大小超限时按最近使用时间淘汰最旧的条目，返回剩余总大小"""
+    entries = []
+    now = time.time()
+    for path in RESPONSE_CACHE_DIR.glob("*/*.json"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        if now - stat.st_mtime > RESPONSE_CACHE_MAX_AGE:
+            path.unlink(missing_ok=True)
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= RESPONSE_CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+    return total
+
+
+def _write_response_cache(key, model, content, reasoning):
+    """写入响应缓存，累计大小超限或距上次清理超过一天时才遍历淘汰"""
+    path = _response_cache_path(key)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=path.parent, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(
+                {
+                    "model": model,
+                    "created": time.time(),
+                    "content": content,
+                    "reasoning": reasoning,
+                },
+                f,
+                ensure_ascii=False,
+            )
+        size = os.path.getsize(f.name)
+        os.replace(f.name, path)
+        with _locked_cache_stats() as stats:
+            # 覆盖已有条目时会多算，只会让清理提前发生，清理后按实际大小校正
+            stats["bytes"] = stats.get("bytes", 0) + size
+            now = time.time()
+            if (
+                stats["bytes"] > RESPONSE_CACHE_MAX_BYTES
+                or now - stats.get("swept", 0) > RESPONSE_CACHE_SWEEP_INTERVAL
+            ):
+                stats["bytes"] = _evict_response_cache()
+                stats["swept"] = now
+    except OSError as e:
+        print(f"写入响应缓存失败: {e}")
+
+
+def response_cache_stats():
+    """输出响应缓存的命中统计和占用"""
+    try:
+        with open(RESPONSE_CACHE_DIR / "stats.json", "r", encoding="utf-8") as f:
+            stats = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        stats = {}
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    sizes = [path.stat().st_size for path in RESPONSE_CACHE_DIR.glob("*/*.json")]
+    ratio = hits / (hits + misses) * 100 if hits + misses else 0.0
+    print(f"响应缓存: {RESPONSE_CACHE_DIR}")
+    print(f"  命中: {hits}  未命中: {misses}  命中率: {ratio:.1f}%")
+    print(f"  条目: {len(sizes)}  占用: {sum(sizes) / 1024 / 1024:.2f} MB")
+
+
+def _stream_chat_uncached(api_key, base_url, model, messages, emit):
+    """常驻进程在运行时优先交给它处理，否则在本进程内请求"""
+    if _daemon_keepalive is None and os.path.exists(DAEMON_SOCKET):
+        try:
+            return _stream_chat_via_daemon(api_key, base_url, model, messages, emit)
+        except DaemonUnavailable:
+            pass
+    return _stream_chat_local(api_key, base_url, model, messages, emit)
+
+
+def stream_chat_completion(api_key, base_url, model, messages, emit=_print_stream):
+    """发起一次流式请求，增量内容通过emit(kind, text)输出
+
+    kind为"reasoning"或"content"，返回(content, reasoning)，失败时抛出异常。
+    temperature为0时结果可复现，命中缓存则经同一个emit回放缓存内容。
+    """
+    mode = RESPONSE_CACHE_OPTIONS["mode"]
+    if mode == "off" or SAMPLING_PARAMS["temperature"] != 0.0:
+        return _stream_chat_uncached(api_key, base_url, model, messages, emit)
+
+    key = _response_cache_key(base_url, model, messages)
+    entry = _read_response_cache(key) if mode == "use" else None
+    if entry is not None:
+        _record_cache_stat("hits")
+        # 只有经_timed_emit计时的请求才计入本次调用的缓存命中数，摘要等内部请求不算
+        timing = getattr(emit, "timing", None)
+        if timing is not None:
+            timing["cache_hit"] = True
+        if entry["reasoning"]:
+            emit("reasoning", entry["reasoning"])
+        if entry["content"]:
+            emit("content", entry["content"])
+        return entry["content"], entry["reasoning"]
+
+    _record_cache_stat("misses")
+    content, reasoning = _stream_chat_uncached(api_key, base_url, model, messages, emit)
+    _write_response_cache(key, model, content, reasoning)
+    return content, reasoning
+
+
+class _DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """处理一次客户端请求，把流式增量按行写回JSON事件"""
+
+    def send_event(self, event):
+        self.wfile.write(json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            content, reasoning = _stream_chat_local(
+                request["api_key"],
+                request["base_url"],
+                request["model"],
+                request["messages"],
+                lambda kind, text: self.send_event({"type": kind, "text": text}),
+            )
+            self.send_event({"type": "done", "content": content, "reasoning": reasoning})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            try:
+                self.send_event({"type": "error", "error": str(e)})
+            except OSError:
+                pass
+
+
+def _warm_up_providers():
+    """为model.json中的每个供应商预建客户端并完成一次TLS握手"""
+    for name, provider in load_model_config().items():
+        if not (provider.get("key") and provider.get("base_url")):
+            continue
+        client = get_openai_client(
+            provider["key"], provider["base_url"], keepalive=_daemon_keepalive
+        )
+        try:
+            client.models.list()
+            print(f"已预热供应商 {name}: {provider['base_url']}")
+        except Exception as e:
+            print(f"预热供应商 {name} 失败: {e}")
+
+
+def run_daemon(socket_path=None, keepalive=DAEMON_KEEPALIVE):
+    """启动常驻进程，在Unix socket上为askgpt/explaingpt提供流式请求"""
+    global _daemon_keepalive
+    _daemon_keepalive = keepalive
+    socket_path = socket_path or DAEMON_SOCKET
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print(f"常驻进程已在运行: {socket_path}")
+            return
+        except OSError:
+            os.unlink(socket_path)  # 清理上次残留的socket文件
+        finally:
+            probe.close()
+
+    # 预热放到后台，不耽误接受请求
+    threading.Thread(target=_warm_up_providers, daemon=True).start()
+
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(
+            socket_path, _DaemonRequestHandler
+        )
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    print(f"常驻进程已启动，监听 {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def get_context_limit(model, base_url):
+    """查找模型的上下文长度：优先model.json里的context_limit，其次GPT_CONTEXT_LIMIT"""
+    for provider in load_model_config().values():
+        if provider.get("model_name") == model and provider.get("base_url") == base_url:
+            if provider.get("context_limit"):
+                return int(provider["context_limit"])
+    return int(os.environ.get("GPT_CONTEXT_LIMIT", DEFAULT_CONTEXT_LIMIT))
+
+
+def _message_tokens(message):
+    """估算单条消息的token数，包含角色等格式开销"""
+    return estimate_tokens(message.get("content") or "") + 4
+
+
+def _summarize_messages(api_key, base_url, model, summary, messages, budget):
+    """把消息分批折叠进摘要，每批不超过budget个token"""
+    pending = list(messages)
+    while pending:
+        batch = []
+        batch_tokens = 0
+        while pending and (not batch or batch_tokens + _message_tokens(pending[0]) <= budget):
+            batch.append(pending.pop(0))
+            batch_tokens += _message_tokens(batch[-1])
+        transcript = "\n\n".join(
+            f"[{message['role']}]\n{message.get('content') or ''}" for message in batch
+        )
+        # 单条消息超出预算时截断，避免摘要请求本身超长
+        while transcript and estimate_tokens(transcript) > budget:
+            transcript = transcript[: len(transcript) * 3 // 4]
+        prompt = (
+            f"请把下面的对话内容整理成简洁的摘要，保留关键事实、结论、代码位置和未解决的问题，"
+            f"不超过{SUMMARY_MAX_TOKENS}个token。\n\n"
+            f"已有摘要：\n{summary or '（无）'}\n\n新增对话：\n{transcript}"
+        )
+        summary, _ = stream_chat_completion(
+            api_key,
+            base_url,
+            model,
+            [{"role": "user", "content": prompt}],
+            emit=lambda kind, text: None,
+        )
+    return summary
+
+
+def fit_history_to_context(history, prompt, conversation_file, api_key, base_url, model):
+    """按模型上下文长度裁剪历史，返回要发送的历史消息（不含本轮提问）
+
+    放得下时原样返回；否则最新的若干轮保持原文，更早的消息折叠成摘要。
+    摘要缓存在对话日志旁的.summary文件里，只对新折叠的消息增量生成。
+    """
+    context_limit = get_context_limit(model, base_url)
+    input_budget = context_limit - min(MAX_OUTPUT_TOKEN, context_limit // 4)
+    input_budget -= estimate_tokens(prompt)
+    if sum(_message_tokens(message) for message in history) <= input_budget:
+        return history
+
+    # 从最新的消息往前保留原文，保证从用户提问开始
+    recent_budget = int(input_budget * HISTORY_RECENT_RATIO)
+    keep_from = len(history)
+    used = 0
+    for index in range(len(history) - 1, -1, -1):
+        used += _message_tokens(history[index])
+        if used > recent_budget:
+            break
+        if history[index].get("role") == "user":
+            keep_from = index
+
+    summary_path = f"{conversation_file}.summary"
+    cached = {"covers": 0, "summary": ""}
+    try:
+        with open(summary_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    if cached["covers"] > keep_from:
+        # 已有摘要覆盖得更多，直接沿用，少发一些原文
+        keep_from = cached["covers"]
+        while keep_from < len(history) and history[keep_from].get("role") != "user":
+            keep_from += 1
+
+    summary = cached["summary"]
+    if cached["covers"] < keep_from:
+        print(f"历史对话较长，正在把前 {keep_from} 条消息折叠为摘要...")
+        summary = _summarize_messages(
+            api_key,
+            base_url,
+            model,
+            summary,
+            history[cached["covers"] : keep_from],
+            max(input_budget - recent_budget, SUMMARY_MAX_TOKENS * 4),
+        )
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump({"covers": keep_from, "summary": summary}, f, ensure_ascii=False)
+
+    summary_message = {"role": "system", "content": f"之前对话的摘要：\n{summary}"}
+    return [summary_message] + history[keep_from:]
+
+
+# 本次调用的计时记录，命令结束时追加到TIMING_LOG_FILE
+INVOCATION_TIMING = {}
+_timing_lock = threading.Lock()
+
+
+def _add_timing(field, value):
+    with _timing_lock:
+        INVOCATION_TIMING[field] = INVOCATION_TIMING.get(field, 0) + value
+
+
+def _timed_emit(emit, start):
+    """包装emit，记录本次调用中首个推理token和首个正文token相对请求开始的耗时"""
+
+    timing = {"first": None, "cache_hit": False}
+
+    def wrapped(kind, text):
+        if text:
+            INVOCATION_TIMING.setdefault(f"ttft_{kind}_ms", (time.perf_counter() - start) * 1000)
+            timing["first"] = timing["first"] or time.perf_counter()
+        emit(kind, text)
+
+    wrapped.timing = timing
+    return wrapped
+
+
+def _tee_emit(*emits):
+    """把流式增量同时交给多个emit回调"""
+
+    def emit(kind, text):
+        for target in emits:
+            target(kind, text)
+
+    return emit
+
+
+def _record_request_timing(model, base_url, messages, content, reasoning, start, emit):
+    """累计一次模型请求的token数、耗时和生成速度"""
+    end = time.perf_counter()
+    completion_tokens = estimate_tokens(content) + estimate_tokens(reasoning or "")
+    first = emit.timing["first"] or end
+    with _timing_lock:
+        INVOCATION_TIMING["model"] = model
+        INVOCATION_TIMING["base_url"] = base_url
+    _add_timing("requests", 1)
+    _add_timing("cache_hits", int(emit.timing["cache_hit"]))
+    _add_timing("prompt_tokens", sum(_message_tokens(m) for m in messages))
+    _add_timing("completion_tokens", completion_tokens)
+    _add_timing("request_ms", (end - start) * 1000)
+    _add_timing("generation_ms", (end - first) * 1000)
+
+
+def write_timing_record(mode):
+    """把本次调用的计时记录追加到耗时日志，没有发起模型请求时不记录"""
+    if "model" not in INVOCATION_TIMING:
+        return
+    record = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "mode": mode,
+        **INVOCATION_TIMING,
+        "total_ms": (time.perf_counter() - _MODULE_LOAD_START) * 1000,
+    }
+    generation_ms = record.pop("generation_ms", 0)
+    # token数为估算值，与上下文窗口计算使用同一口径
+    record["tokens_per_sec"] = (
+        record["completion_tokens"] / (generation_ms / 1000) if generation_ms > 0 else None
+    )
+    for field, value in record.items():
+        if isinstance(value, float):
+            record[field] = round(value, 2)
+    try:
+        LOGS_DIR.mkdir(parents=True, exist_ok=True)
+        with open(TIMING_LOG_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"写入耗时日志失败: {e}")
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def timing_stats():
+    """按模型汇总耗时日志，完全命中响应缓存的调用不参与统计"""
+    by_model = collections.defaultdict(list)
+    try:
+        with open(TIMING_LOG_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("cache_hits", 0) >= record.get("requests", 0):
+                    continue
+                by_model[record.get("model", "?")].append(record)
+    except FileNotFoundError:
+        pass
+    if not by_model:
+        print(f"没有耗时记录: {TIMING_LOG_FILE}")
+        return
+
+    fields = [
+        ("context_ms", "上下文组装(ms)"),
+        ("ttft_reasoning_ms", "首个推理token(ms)"),
+        ("ttft_content_ms", "首个正文token(ms)"),
+        ("request_ms", "模型请求(ms)"),
+        ("tokens_per_sec", "生成速度(token/s)"),
+        ("render_ms", "渲染(ms)"),
+        ("total_ms", "总耗时(ms)"),
+    ]
+    width = max(len(label) for _, label in fields)
+    print(f"耗时日志: {TIMING_LOG_FILE}")
+    for model, records in sorted(by_model.items()):
+        print(f"\n{model}  ({len(records)} 次调用)")
+        print(f"  {'指标'.ljust(width)} {'p50':>10} {'p90':>10} {'p99':>10}")
+        for field, label in fields:
+            values = [r[field] for r in records if r.get(field) is not None]
+            if not values:
+                continue
+            cells = " ".join(f"{_percentile(values, p):10.1f}" for p in (50, 90, 99))
+            print(f"  {label.ljust(width)} {cells}")
+
+
 def query_gpt_api(
     api_key,
     prompt,
     model="gpt-4",
     proxies=None,
     base_url=None,
-    conversation_file="conversation_history.json",
+    conversation_file="conversation_history.jsonl",
 ):
     """支持多轮对话的OpenAI API流式查询
 
@@ -232,74 +1514,207 @@ def query_gpt_api(
         conversation_file (str): 对话历史存储文件路径
         其他参数同上
     """
-    cid = os.environ.get("GPT_UUID_CONVERSATION")
-    if cid:
-        try:
-            conversation_file = get_conversation(cid)
-            # print("旧对话: %s\n" % conversation_file)
-        except FileNotFoundError:
-            conversation_file = new_conversation(cid)
-            # print("开新对话: %s\n" % conversation_file)
+    conversation_file = _resolve_conversation_file(conversation_file)
 
     # 加载历史对话
     history = load_conversation_history(conversation_file)
 
-    # 添加用户新提问到历史
-    history.append({"role": "user", "content": prompt})
-
-    # 初始化OpenAI客户端
-    client = OpenAI(api_key=api_key, base_url=base_url)
-
     try:
-        # 创建流式响应（使用完整对话历史）
-        stream = client.chat.completions.create(
-            model=model,
-            messages=history,
-            temperature=0.0,
-            max_tokens=MAX_OUTPUT_TOKEN,
-            top_p=0.8,
-            stream=True,
+        # 历史超出上下文时，较早的轮次折叠成摘要
+        start = time.perf_counter()
+        history = fit_history_to_context(
+            history, prompt, conversation_file, api_key, base_url, model
         )
-
-        content = ""
-        reasoning = ""
-        # 处理流式响应
-        for chunk in stream:
-            # 处理推理内容（仅打印不保存）
-            if (
-                hasattr(chunk.choices[0].delta, "reasoning_content")
-                and chunk.choices[0].delta.reasoning_content
-            ):
-                print(chunk.choices[0].delta.reasoning_content, end="", flush=True)
-                reasoning += chunk.choices[0].delta.reasoning_content
-            # 处理正式回复内容
-            if chunk.choices[0].delta.content:
-                print(chunk.choices[0].delta.content, end="", flush=True)
-                content += chunk.choices[0].delta.content
+        _add_timing("context_ms", (time.perf_counter() - start) * 1000)
+
+        # 添加用户新提问到历史
+        user_message = {"role": "user", "content": prompt}
+        history.append(user_message)
+
+        # 创建流式响应，边生成边渲染，同时提取回答中的文件块
+        renderer = MarkdownStreamRenderer() if MARKDOWN_RENDERER == "stream" else None
+        blocks = FileBlockExtractor()
+        start = time.perf_counter()
+        emit = _timed_emit(
+            _tee_emit(renderer.emit if renderer else _print_stream, blocks.emit), start
+        )
+        content, reasoning = stream_chat_completion(
+            api_key, base_url, model, history, emit
+        )
+        if renderer:
+            renderer.finish()
+        blocks.finish()
+        _record_request_timing(model, base_url, history, content, reasoning, start, emit)
         print()  # 换行
 
-        # 将助理回复添加到历史（仅保存正式内容）
-        history.append({"role": "assistant", "content": content})
-
-        # 保存更新后的对话历史
-        save_conversation_history(conversation_file, history)
+        # 将本轮问答追加到对话日志（仅保存正式内容）
+        append_conversation_turn(
+            conversation_file,
+            [user_message, {"role": "assistant", "content": content}],
+        )
 
         # 存储思维过程
         if reasoning:
             content = reasoning + "\n" + content
 
-        return {"choices": [{"message": {"content": content}}]}
+        return {"choices": [{"message": {"content": content}}], "file_blocks": blocks}
 
     except Exception as e:
         print(f"OpenAI API请求失败: {e}")
         sys.exit(1)
 
+
+class ChunkStreamPrinter:
+    """并发分块模式的输出器，每个分块的输出按整行加上标签打印，避免互相穿插"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = {}
+
+    def emitter(self, label):
+        """返回绑定到某个分块标签的emit回调"""
+
+        def emit(kind, text):
+            with self.lock:
+                buffer = self.buffers.get(label, "") + text
+                *lines, rest = buffer.split("\n")
+                for line in lines:
+                    print(f"{label} {line}", flush=True)
+                self.buffers[label] = rest
+
+        return emit
+
+    def flush(self, label):
+        """输出分块缓冲区中尚未换行的内容"""
+        with self.lock:
+            rest = self.buffers.pop(label, "")
+            if rest:
+                print(f"{label} {rest}", flush=True)
+
+    def note(self, label, message):
+        """打印分块的状态信息"""
+        self.flush(label)
+        with self.lock:
+            print(f"{label} >>> {message}", flush=True)
+
+
+def query_chunks_concurrently(
+    api_key,
+    prompts,
+    model,
+    base_url=None,
+    max_workers=CHUNK_PARALLEL,
+    retries=CHUNK_RETRIES,
+    conversation_file="conversation_history.jsonl",
+):
+    """并发查询多个分块，返回按分块顺序排列的回答列表
+
+    每个分块基于同一份历史独立请求，失败的分块单独重试，
+    重试耗尽后用失败说明占位，不影响其它分块。
+    """
+    conversation_file = _resolve_conversation_file(conversation_file)
+    history = load_conversation_history(conversation_file)
+    start = time.perf_counter()
+    history = fit_history_to_context(
+        history, max(prompts, key=len), conversation_file, api_key, base_url, model
+    )
+    _add_timing("context_ms", (time.perf_counter() - start) * 1000)
+    printer = ChunkStreamPrinter()
+    total = len(prompts)
+
+    def run(index, prompt):
+        label = f"[{index}/{total}]"
+        messages = history + [{"role": "user", "content": prompt}]
+        for attempt in range(1, retries + 2):
+            try:
+                start = time.perf_counter()
+                emit = _timed_emit(printer.emitter(label), start)
+                content, reasoning = stream_chat_completion(
+                    api_key, base_url, model, messages, emit
+                )
+                _record_request_timing(
+                    model, base_url, messages, content, reasoning, start, emit
+                )
+                printer.note(label, "完成")
+                return content, reasoning
+            except Exception as e:
+                printer.note(label, f"请求失败 ({attempt}/{retries + 1}): {e}")
+                if attempt <= retries:
+                    time.sleep(min(2**attempt, 10))
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [
+            executor.submit(run, index, prompt)
+            for index, prompt in enumerate(prompts, 1)
+        ]
+        results = [future.result() for future in futures]
+
+    answers = []
+    for index, (prompt, result) in enumerate(zip(prompts, results), 1):
+        if result is None:
+            answers.append(f"（第 {index}/{total} 部分处理失败，已跳过）")
+            continue
+        content, reasoning = result
+        append_conversation_turn(
+            conversation_file,
+            [
+                {"role": "user", "content": prompt},
+                {"role": "assistant", "content": content},
+            ],
+        )
+        answers.append(reasoning + "\n" + content if reasoning else content)
+
+    return answers
+
+
+DEPS_CACHE_PATH = CACHE_DIR / "deps.json"
+DEPS_CACHE_ENTRIES = 16
+
+
+@functools.lru_cache(maxsize=None)
+def _load_deps_cache():
+    """读取工具检测缓存，返回(全部缓存, 当前PATH对应的缓存)"""
+    path_key = hashlib.sha1(os.environ.get("PATH", "").encode()).hexdigest()
+    try:
+        with open(DEPS_CACHE_PATH, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {}
+    return cache, cache.setdefault(path_key, {})
+
+
+def _save_deps_cache():
+    """写回工具检测缓存，只保留最近的若干个PATH"""
+    cache, _ = _load_deps_cache()
+    while len(cache) > DEPS_CACHE_ENTRIES:
+        cache.pop(next(iter(cache)))
+    try:
+        DEPS_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = DEPS_CACHE_PATH.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, DEPS_CACHE_PATH)
+    except OSError:
+        pass
+
+
+def _find_tool(tool_name):
+    """查找工具路径，按PATH缓存已找到的结果，未找到的每次重新检测"""
+    _, tools = _load_deps_cache()
+    tool_path = tools.get(tool_name)
+    if tool_path and os.access(tool_path, os.X_OK):
+        return tool_path
+    tool_path = shutil.which(tool_name)
+    if tool_path:
+        tools[tool_name] = tool_path
+        _save_deps_cache()
+    return tool_path
+
+
 def _check_tool_installed(tool_name, install_url=None, install_commands=None):
     """检查指定工具是否已安装"""
-    result = subprocess.run(
-        ["which", tool_name], stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    if result.returncode != 0:
+    if not _find_tool(tool_name):
         print(f"错误：{tool_name} 未安装")
         if install_url:
             print(f"请访问 {install_url} 安装{tool_name}")
@@ -312,28 +1727,17 @@ def _check_tool_installed(tool_name, install_url=None, install_commands=None):
 
 
 def check_deps_installed():
-    """检查glow、tree和剪贴板工具是否已安装"""
+    """检查glow(仅GPT_RENDERER=glow时需要)和剪贴板工具是否已安装"""
     all_installed = True
 
     # 检查glow
-    if not _check_tool_installed(
+    if MARKDOWN_RENDERER == "glow" and not _check_tool_installed(
         "glow",
         install_url="https://github.com/charmbracelet/glow",
         install_commands=["brew install glow"],
     ):
         all_installed = False
 
-    # 检查tree
-    if not _check_tool_installed(
-        "tree",
-        install_commands=[
-            "macOS: brew install tree",
-            "Ubuntu/Debian: sudo apt install tree",
-            "CentOS/Fedora: sudo yum install tree",
-        ],
-    ):
-        all_installed = False
-
     # 检查剪贴板工具
     if sys.platform == "win32":
         try:
@@ -362,76 +1766,870 @@ def check_deps_installed():
     return all_installed
 
 
+def _gitignore_regex(pattern):
+    """把.gitignore的通配模式翻译为匹配相对路径的正则
+
+    **/表示零到多层目录，/**匹配目录下的全部内容，*和?不跨越/。
+    """
+    parts = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith("**/", index) and (index == 0 or pattern[index - 1] == "/"):
+            parts.append("(?:.*/)?")
+            index += 3
+        elif pattern.startswith("**", index) and index + 2 == len(pattern) and (
+            index == 0 or pattern[index - 1] == "/"
+        ):
+            parts.append(".*")
+            index += 2
+        elif pattern[index] == "*":
+            parts.append("[^/]*")
+            index += 1
+        elif pattern[index] == "?":
+            parts.append("[^/]")
+            index += 1
+        elif pattern[index] == "[" and "]" in pattern[index + 2 :]:
+            end = pattern.index("]", index + 2)
+            body = pattern[index + 1 : end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            parts.append("[" + body.replace("\\", "\\\\") + "]")
+            index = end + 1
+        elif pattern[index] == "\\" and index + 1 < len(pattern):
+            parts.append(re.escape(pattern[index + 1]))
+            index += 2
+        else:
+            parts.append(re.escape(pattern[index]))
+            index += 1
+    return re.compile("".join(parts) + r"\Z", re.S)
+
+
+class GitIgnore:
+    """简化的.gitignore规则匹配，支持通配符、**、!取反、/结尾的目录规则和带/的锚定规则"""
+
+    def __init__(self, rules=()):
+        self.rules = tuple(rules)
+
+    def extend(self, dir_path, rel_dir):
+        """读取目录下的.gitignore，返回叠加了新规则的匹配器"""
+        try:
+            with open(os.path.join(dir_path, ".gitignore"), "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except (OSError, UnicodeDecodeError):
+            return self
+        rules = list(self.rules)
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            # 不含/的规则匹配任意层级下的同名条目，等价于前面加**/
+            pattern = line.lstrip("/") if "/" in line else "**/" + line
+            rules.append((rel_dir, _gitignore_regex(pattern), negate, dir_only))
+        return GitIgnore(rules)
+
+    def ignored(self, rel_path, is_dir):
+        """判断相对路径是否被忽略，后出现的规则优先"""
+        result = False
+        for base, regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if base:
+                if not rel_path.startswith(base + "/"):
+                    continue
+                sub_path = rel_path[len(base) + 1 :]
+            else:
+                sub_path = rel_path
+            if regex.match(sub_path):
+                result = not negate
+        return result
+
+
+def _workspace_gitignore(root):
+    """加载从工作区根目录到root上一级的各层.gitignore
+
+    返回(匹配器, root相对工作区根目录的路径)，匹配器按工作区相对路径匹配；
+    root不在git工作区内时返回空匹配器和空前缀。
+    """
+    root = os.path.abspath(root)
+    workspace = _git_root(root)
+    ignore = GitIgnore()
+    if workspace is None or workspace == root:
+        return ignore, ""
+    parts = Path(os.path.relpath(root, workspace)).parts
+    for depth in range(len(parts)):
+        ignore = ignore.extend(os.path.join(workspace, *parts[:depth]), "/".join(parts[:depth]))
+    return ignore, "/".join(parts)
+
+
+def walk_directory(root, max_depth=None, skip_dirs=()):
+    """按tree的顺序深度优先遍历目录，跳过隐藏条目和.gitignore忽略的条目
+
+    从子目录开始遍历时，工作区根目录到该目录之间的.gitignore同样生效。
+    生成(相对路径, DirEntry, 每一层是否为最后一项)，调用方停止迭代即停止遍历。
+    """
+    ignore, prefix = _workspace_gitignore(root)
+
+    def scoped(rel_path):
+        """把相对root的路径转换为匹配器使用的工作区相对路径"""
+        if not prefix:
+            return rel_path
+        return f"{prefix}/{rel_path}" if rel_path else prefix
+
+    def walk(path, rel_dir, ignore, lasts):
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        ignore = ignore.extend(path, scoped(rel_dir))
+        visible = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if is_dir and entry.name in skip_dirs:
+                continue
+            if ignore.ignored(scoped(rel_path), is_dir):
+                continue
+            visible.append((entry, rel_path, is_dir))
+        for index, (entry, rel_path, is_dir) in enumerate(visible):
+            flags = lasts + (index == len(visible) - 1,)
+            yield rel_path, entry, flags
+            if is_dir and (max_depth is None or len(flags) < max_depth):
+                yield from walk(entry.path, rel_path, ignore, flags)
+
+    yield from walk(root, "", ignore, ())
+
+
+def render_directory_tree(root, max_depth=None, max_entries=TREE_MAX_ENTRIES, max_bytes=None):
+    """生成tree风格的目录结构，超出条目数或字节数预算时提前停止，返回(文本, 是否截断)"""
+    lines = ["."]
+    size = 2
+    dirs = files = 0
+    truncated = False
+    for _, entry, lasts in walk_directory(root, max_depth):
+        prefix = "".join("    " if last else "│   " for last in lasts[:-1])
+        line = prefix + ("└── " if lasts[-1] else "├── ") + entry.name
+        size += len(line.encode()) + 1
+        if dirs + files >= max_entries or (max_bytes and size > max_bytes):
+            truncated = True
+            break
+        lines.append(line)
+        if entry.is_dir(follow_symlinks=False):
+            dirs += 1
+        else:
+            files += 1
+    if truncated:
+        lines.append("... (已达到输出上限，省略其余条目)")
+    lines.append("")
+    lines.append(f"{dirs} directories, {files} files")
+    return "\n".join(lines), truncated
+
+
 def get_directory_context(max_depth=1):
     """获取当前目录上下文信息（支持动态层级控制）"""
     try:
         current_dir = os.getcwd()
-        cmd = ["tree", '-I ".*"']
-        if max_depth is not None:
-            cmd.extend(["-L", str(max_depth)])
-
-        result = subprocess.run(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True
-        )
-
-        if result.returncode == 0:
-            output = result.stdout
-            # 仅在无层级限制时检查输出长度
-            if max_depth is None and len(output.encode()) > 2048:
-                return get_directory_context(max_depth=1)  # 递归调用回退到一层
-            return f"\n当前工作目录: {current_dir}\n\n目录结构:\n{output}"
-
-        # 当tree命令失败时使用ls
-        ls_result = subprocess.run(["ls", "-l"], stdout=subprocess.PIPE, text=True)
-        msg = ls_result.stdout or "无法获取目录信息"
-        return f"\n当前工作目录: {current_dir}\n\n目录结构:\n{msg}"
+        if max_depth is None:
+            # 完整目录树超过预算时回退到一层
+            output, truncated = render_directory_tree(
+                current_dir, max_bytes=TREE_FULL_MAX_BYTES
+            )
+            if truncated:
+                output, _ = render_directory_tree(current_dir, max_depth=1)
+        else:
+            output, _ = render_directory_tree(current_dir, max_depth=max_depth)
+        return f"\n当前工作目录: {current_dir}\n\n目录结构:\n{output}"
 
     except Exception as e:
         return f"获取目录上下文时出错: {str(e)}"
 
 
-def is_text_file(file_path):
+def _looks_like_text(data):
+    """根据文件开头的字节判断是否为文本：含NUL字节视为二进制，非UTF-8时看控制字符比例"""
+    if not data:
+        return True
+    if b"\0" in data:
+        return False
     try:
-        # 使用 subprocess.run 调用 file 命令
-        result = subprocess.run(['file', '--mime-type', '-b', file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        data.decode("utf-8")
+        return True
+    except UnicodeDecodeError as e:
+        # 只是截断在多字节字符中间
+        if e.start >= len(data) - 3:
+            return True
+    control = sum(1 for byte in data if byte < 32 and byte not in b"\t\n\r\f\b\x1b")
+    return control / len(data) < 0.05
 
-        # 获取命令输出并去除空格和换行符
-        mime_type = result.stdout.strip()
 
-        # 判断 MIME 类型是否为 text
-        if mime_type.startswith('text/'):
-            return True
-        else:
-            return False
-    except Exception as e:
+def is_text_file(file_path):
+    """读取文件开头判断是否为文本文件，不再依赖file命令"""
+    try:
+        with open(file_path, "rb") as f:
+            return _looks_like_text(f.read(TEXT_SNIFF_SIZE))
+    except OSError as e:
         print(f"Error checking file type: {e}")
         return False
 
+
+@functools.lru_cache(maxsize=4096)
+def _git_root(directory):
+    """返回包含.git的最近上级目录，结果按目录缓存，兄弟目录共享上级的查找结果"""
+    if os.path.exists(os.path.join(directory, ".git")):
+        return directory
+    parent = os.path.dirname(directory)
+    return None if parent == directory else _git_root(parent)
+
+
+def find_workspace_root(path):
+    """向上查找包含.git的目录作为工作区根目录，找不到时使用当前目录"""
+    path = os.path.abspath(path)
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    return _git_root(directory) or os.getcwd()
+
+
+FileContext = collections.namedtuple("FileContext", ["is_text", "content"])
+
+
+class WorkspaceCache:
+    """工作区文件上下文缓存，保存文本判断、截断后的内容和行偏移索引
+
+    行偏移索引只在第一次按行号读取时建立；
+    以路径、mtime和大小作为有效性依据，每次读取只需一次stat；
+    数据存放在.cache/workspaces下每个工作区一个SQLite库，多线程各用一个连接。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        digest = hashlib.sha1(root.encode("utf-8")).hexdigest()[:16]
+        self.db_path = WORKSPACE_CACHE_DIR / f"{digest}.db"
+        self.local = threading.local()
+
+    def connect(self):
+        """返回当前线程的数据库连接"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            import sqlite3
+
+            WORKSPACE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    is_text INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    line_index BLOB
+                )
+                """
+            )
+            self.local.conn = conn
+        return conn
+
+    def get(self, path):
+        """读取文件上下文，缓存失效时重新读取"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = (
+            self.connect()
+            .execute(
+                "SELECT is_text, content FROM files "
+                "WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (path, stat.st_mtime_ns, stat.st_size),
+            )
+            .fetchone()
+        )
+        if row is not None:
+            return FileContext(bool(row[0]), row[1])
+        return self.refresh(path, stat)
+
+    def refresh(self, path, stat=None):
+        """重新读取文件开头并写入缓存，行偏移索引留待按行号读取时建立"""
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        with open(path, "rb") as f:
+            data = f.read(MAX_FILE_SIZE)
+        is_text = _looks_like_text(data[:TEXT_SNIFF_SIZE])
+        content = data.decode("utf-8", errors="ignore") if is_text else ""
+        self.connect().execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, NULL)",
+            (path, stat.st_mtime_ns, stat.st_size, int(is_text), content),
+        )
+        return FileContext(is_text, content)
+
+    def line_index(self, path, stat, data):
+        """返回文件的行偏移索引，缓存中没有时从data(整个文件的内容或映射)建立
+
+        不超过LINE_INDEX_MAX_BYTES的文件会把索引存回缓存条目。
+        """
+        path = os.path.abspath(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT line_index FROM files WHERE path = ? AND mtime_ns = ? AND size = ?", key
+        ).fetchone()
+        if row is not None and row[0] is not None:
+            return _unpack_line_index(row[0])
+        line_index = build_line_index(data)
+        if row is not None and stat.st_size <= LINE_INDEX_MAX_BYTES:
+            conn.execute(
+                "UPDATE files SET line_index = ? "
+                "WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (line_index.tobytes(), *key),
+            )
+        return line_index
+
+    def remove(self, path):
+        """删除文件的缓存条目"""
+        self.connect().execute("DELETE FROM files WHERE path = ?", (os.path.abspath(path),))
+
+
+def build_line_index(data):
+    """返回每一行起始位置的字节偏移数组"""
+    offsets = array.array("Q", [0])
+    position = data.find(b"\n")
+    while position != -1:
+        offsets.append(position + 1)
+        position = data.find(b"\n", position + 1)
+    return offsets
+
+
+def _unpack_line_index(blob):
+    if blob is None:
+        return None
+    offsets = array.array("Q")
+    offsets.frombytes(blob)
+    return offsets
+
+
+@functools.lru_cache(maxsize=None)
+def get_workspace_cache(root):
+    return WorkspaceCache(root)
+
+
+def read_file_context(file_path):
+    """通过所在工作区的缓存读取文件上下文"""
+    return get_workspace_cache(find_workspace_root(file_path)).get(file_path)
+
+
+def _is_watched_path(root, path):
+    """监视时跳过隐藏目录和依赖、构建目录里的文件"""
+    rel_parts = Path(os.path.relpath(path, root)).parts
+    return not any(part.startswith(".") or part in VENDOR_DIRS for part in rel_parts)
+
+
+def watch_workspace(root):
+    """预热工作区缓存，并用watchdog在文件变化时更新缓存"""
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+
+    root = find_workspace_root(root)
+    cache = get_workspace_cache(root)
+
+    count = 0
+    for rel_path, entry, _ in walk_directory(root, skip_dirs=VENDOR_DIRS):
+        if entry.is_file(follow_symlinks=False):
+            try:
+                cache.get(entry.path)
+                count += 1
+            except OSError:
+                pass
+    print(f"已缓存工作区 {root} 的 {count} 个文件，开始监视变化")
+
+    class CacheUpdater(FileSystemEventHandler):
+        def update(self, path):
+            if not _is_watched_path(root, path):
+                return
+            try:
+                cache.refresh(path)
+            except OSError:
+                cache.remove(path)
+
+        def on_created(self, event):
+            if not event.is_directory:
+                self.update(event.src_path)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                self.update(event.src_path)
+
+        def on_deleted(self, event):
+            cache.remove(event.src_path)
+
+        def on_moved(self, event):
+            cache.remove(event.src_path)
+            if not event.is_directory:
+                self.update(event.dest_path)
+
+    observer = Observer()
+    observer.schedule(CacheUpdater(), root, recursive=True)
+    observer.start()
+    try:
+        while observer.is_alive():
+            observer.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+
+
+_SEARCH_WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+|[\u4e00-\u9fff]+")
+_SEARCH_SUBWORD = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def search_terms(text):
+    """把文本切成检索词：标识符整体及其驼峰/下划线拆分，中文按二元组"""
+    terms = []
+    for word in _SEARCH_WORD.findall(text):
+        if "\u4e00" <= word[0] <= "\u9fff":
+            terms.extend(word[i : i + 2] for i in range(max(1, len(word) - 1)))
+            continue
+        lower = word.lower()
+        if len(lower) > 1:
+            terms.append(lower)
+        parts = [part.lower() for part in _SEARCH_SUBWORD.findall(word)]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) > 1)
+    return terms
+
+
+def _search_chunks(content, file_path):
+    """把文件切成检索片段，尽量按顶层定义对齐，每段不超过SEARCH_WINDOW_LINES行"""
+    lines = _split_lines(content)
+    chunks = []
+    start = end = 0
+    for unit_start, unit_end in syntax_units(content, file_path):
+        if unit_end - start > SEARCH_WINDOW_LINES and end > start:
+            chunks.append((start, end))
+            start = unit_start
+        end = unit_end
+        while end - start > SEARCH_WINDOW_LINES:
+            chunks.append((start, start + SEARCH_WINDOW_LINES))
+            start += SEARCH_WINDOW_LINES
+    if end > start:
+        chunks.append((start, end))
+    return [(a, b, "".join(lines[a:b])) for a, b in chunks]
+
+
+def _ensure_search_tables(conn):
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS search_files (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS search_chunks (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            start_line INTEGER NOT NULL,
+            end_line INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS search_chunks_path ON search_chunks(path);
+        CREATE TABLE IF NOT EXISTS search_postings (
+            term TEXT NOT NULL,
+            chunk_id INTEGER NOT NULL,
+            tf INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS search_postings_term ON search_postings(term);
+        CREATE INDEX IF NOT EXISTS search_postings_chunk ON search_postings(chunk_id);
+        """
+    )
+
+
+def _drop_search_file(conn, path):
+    conn.execute(
+        "DELETE FROM search_postings WHERE chunk_id IN "
+        "(SELECT id FROM search_chunks WHERE path = ?)",
+        (path,),
+    )
+    conn.execute("DELETE FROM search_chunks WHERE path = ?", (path,))
+    conn.execute("DELETE FROM search_files WHERE path = ?", (path,))
+
+
+def _scan_workspace_changes(cache, table, accept):
+    """对比工作区文件和索引表中记录的mtime/大小，返回(已删除路径, 新增或变化的(路径, stat))"""
+    indexed = {
+        path: (mtime_ns, size)
+        for path, mtime_ns, size in cache.connect().execute(
+            f"SELECT path, mtime_ns, size FROM {table}"
+        )
+    }
+    changed = []
+    seen = set()
+    for _, entry, _ in walk_directory(cache.root, skip_dirs=VENDOR_DIRS):
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        stat = entry.stat(follow_symlinks=False)
+        if not accept(entry.path, stat):
+            continue
+        seen.add(entry.path)
+        if indexed.get(entry.path) != (stat.st_mtime_ns, stat.st_size):
+            changed.append((entry.path, stat))
+    return indexed.keys() - seen, changed
+
+
+def update_search_index(cache):
+    """增量更新工作区检索索引：只重建新增或变化的文件，删除已消失的文件"""
+    conn = cache.connect()
+    _ensure_search_tables(conn)
+    removed, changed = _scan_workspace_changes(
+        cache, "search_files", lambda path, stat: stat.st_size <= SEARCH_MAX_FILE_BYTES
+    )
+
+    conn.execute("BEGIN")
+    try:
+        for path in removed:
+            _drop_search_file(conn, path)
+        for path, stat in changed:
+            _drop_search_file(conn, path)
+            conn.execute(
+                "INSERT INTO search_files VALUES (?, ?, ?)",
+                (path, stat.st_mtime_ns, stat.st_size),
+            )
+            if not cache.get(path).is_text:
+                continue
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                content = f.read()
+            for start, end, text in _search_chunks(content, path):
+                terms = collections.Counter(search_terms(text))
+                if not terms:
+                    continue
+                chunk_id = conn.execute(
+                    "INSERT INTO search_chunks (path, start_line, end_line, length, text) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (path, start, end, sum(terms.values()), text),
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO search_postings VALUES (?, ?, ?)",
+                    [(term, chunk_id, tf) for term, tf in terms.items()],
+                )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return len(changed)
+
+
+def search_workspace(query, root=None, top_k=SEARCH_TOP_K, budget=SEARCH_TOKEN_BUDGET):
+    """用BM25在工作区检索与query相关的代码片段，返回不超过budget个token的上下文"""
+    cache = get_workspace_cache(find_workspace_root(root or os.getcwd()))
+    update_search_index(cache)
+    conn = cache.connect()
+
+    terms = set(search_terms(query))
+    total, avg_length = conn.execute(
+        "SELECT COUNT(*), AVG(length) FROM search_chunks"
+    ).fetchone()
+    if not terms or not total:
+        return f"\n在 {cache.root} 中没有找到与 \"{query}\" 相关的内容\n"
+
+    scores = collections.Counter()
+    for term in terms:
+        rows = conn.execute(
+            "SELECT p.chunk_id, p.tf, c.length FROM search_postings p "
+            "JOIN search_chunks c ON c.id = p.chunk_id WHERE p.term = ?",
+            (term,),
+        ).fetchall()
+        if not rows:
+            continue
+        idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+        for chunk_id, tf, length in rows:
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+            scores[chunk_id] += idf * tf * (BM25_K1 + 1) / norm
+
+    sections = []
+    used = 0
+    for chunk_id, score in scores.most_common(top_k):
+        path, start, end, text = conn.execute(
+            "SELECT path, start_line, end_line, text FROM search_chunks WHERE id = ?",
+            (chunk_id,),
+        ).fetchone()
+        section = (
+            f"文件 {os.path.relpath(path, cache.root)} 第{start + 1}-{end}行 "
+            f"(相关度 {score:.2f}):\n```\n{text.rstrip()}\n```"
+        )
+        tokens = estimate_tokens(section)
+        if used + tokens > budget:
+            continue
+        sections.append(section)
+        used += tokens
+    if not sections:
+        return f"\n在 {cache.root} 中没有找到与 \"{query}\" 相关的内容\n"
+    return f"\n\n检索 \"{query}\" 得到的相关代码片段:\n\n" + "\n\n".join(sections) + "\n\n"
+
+
+# 各语言中表示定义的语法节点及其类型名称
+SYMBOL_NODE_KINDS = {
+    "function_definition": "function",
+    "class_definition": "class",
+    "function_declaration": "function",
+    "generator_function_declaration": "function",
+    "class_declaration": "class",
+    "method_definition": "method",
+    "class_specifier": "class",
+    "struct_specifier": "struct",
+    "union_specifier": "union",
+    "enum_specifier": "enum",
+    "namespace_definition": "namespace",
+}
+# 包裹定义的外层节点，符号的起始行取外层节点的起始行（装饰器、模板参数、export）
+SYMBOL_WRAPPER_NODES = {"decorated_definition", "template_declaration", "export_statement"}
+_SYMBOL_NAME_NODES = {
+    "identifier",
+    "field_identifier",
+    "type_identifier",
+    "property_identifier",
+    "qualified_identifier",
+    "destructor_name",
+    "operator_name",
+    "namespace_identifier",
+}
+
+
+def _symbol_name(node):
+    """取定义节点的名称，C/C++函数沿declarator逐层向下查找"""
+    current = node.child_by_field_name("name") or node.child_by_field_name("declarator")
+    while current is not None:
+        if current.type in _SYMBOL_NAME_NODES:
+            return current.text.decode("utf-8", errors="ignore").replace("::", ".")
+        current = current.child_by_field_name("declarator") or current.child_by_field_name(
+            "name"
+        )
+    return None
+
+
+def extract_symbols(content, file_path):
+    """用tree-sitter提取文件中的定义，返回[(名称, 限定名, 类型, 起始行, 结束行)]，行号从1开始"""
+    language = TREE_SITTER_LANGUAGES.get(Path(file_path).suffix.lower())
+    parser = get_tree_sitter_parser(language) if language else None
+    if parser is None:
+        return []
+    tree = parser.parse(content.encode("utf-8"))
+    symbols = []
+
+    def visit(node, scope):
+        for child in node.named_children:
+            kind = SYMBOL_NODE_KINDS.get(child.type)
+            name = None
+            if kind is None and child.type == "variable_declarator":
+                # JavaScript: const foo = () => {} / function () {}
+                value = child.child_by_field_name("value")
+                if value is not None and value.type in ("arrow_function", "function_expression", "function"):
+                    kind = "function"
+            if kind is not None:
+                name = _symbol_name(child)
+            if name and child.child_by_field_name("body") is None and kind != "function":
+                name = None  # 只有前置声明的struct/class
+            if name:
+                outer = child.parent if child.parent.type in SYMBOL_WRAPPER_NODES else child
+                qualname = ".".join(scope + [name])
+                symbols.append(
+                    (
+                        name.rsplit(".", 1)[-1],
+                        qualname,
+                        kind,
+                        outer.start_point[0] + 1,
+                        child.end_point[0] + 1,
+                    )
+                )
+                visit(child, scope + name.split("."))
+            else:
+                visit(child, scope)
+
+    visit(tree.root_node, [])
+    return symbols
+
+
+def _ensure_symbol_tables(conn):
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS symbol_files (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS symbols (
+            path TEXT NOT NULL,
+            name TEXT NOT NULL,
+            qualname TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            start_line INTEGER NOT NULL,
+            end_line INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS symbols_name ON symbols(name);
+        CREATE INDEX IF NOT EXISTS symbols_path ON symbols(path);
+        """
+    )
+
+
+def update_symbol_table(cache):
+    """增量更新工作区符号表，按mtime/大小判断文件是否需要重新解析"""
+    conn = cache.connect()
+    _ensure_symbol_tables(conn)
+    removed, changed = _scan_workspace_changes(
+        cache,
+        "symbol_files",
+        lambda path, stat: Path(path).suffix.lower() in TREE_SITTER_LANGUAGES,
+    )
+
+    conn.execute("BEGIN")
+    try:
+        for path in removed:
+            conn.execute("DELETE FROM symbols WHERE path = ?", (path,))
+            conn.execute("DELETE FROM symbol_files WHERE path = ?", (path,))
+        for path, stat in changed:
+            conn.execute("DELETE FROM symbols WHERE path = ?", (path,))
+            conn.execute(
+                "INSERT OR REPLACE INTO symbol_files VALUES (?, ?, ?)",
+                (path, stat.st_mtime_ns, stat.st_size),
+            )
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                content = f.read()
+            conn.executemany(
+                "INSERT INTO symbols VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, *symbol) for symbol in extract_symbols(content, path)],
+            )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return len(changed)
+
+
+def read_line_range(file_path, start, end):
+    """通过行偏移索引和mmap读取文件的第start到end行（从1开始，包含end）"""
+    cache = get_workspace_cache(find_workspace_root(file_path))
+    if not cache.get(file_path).is_text:
+        raise ValueError(f"{file_path} 是非文本文件")
+    with open(file_path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            line_index = cache.line_index(file_path, stat, mapped)
+            start = max(1, start)
+            if start > len(line_index):
+                return ""
+            begin = line_index[start - 1]
+            stop = line_index[end] if end < len(line_index) else len(mapped)
+            return mapped[begin:stop].decode("utf-8", errors="ignore")
+
+
+def find_symbol(name, root=None):
+    """按名称或限定名查找符号定义，返回上下文文本"""
+    cache = get_workspace_cache(find_workspace_root(root or os.getcwd()))
+    update_symbol_table(cache)
+    qualname = name.replace("::", ".")
+    # 用substr比较后缀而不是LIKE，标识符里的_和%不会被当成通配符
+    suffix = f".{qualname}"
+    rows = (
+        cache.connect()
+        .execute(
+            "SELECT path, qualname, kind, start_line, end_line FROM symbols "
+            "WHERE name = ? AND (? OR qualname = ? OR substr(qualname, ?) = ?) "
+            "ORDER BY qualname = ? DESC, path, start_line LIMIT ?",
+            (
+                qualname.rsplit(".", 1)[-1],
+                "." not in qualname,
+                qualname,
+                -len(suffix),
+                suffix,
+                qualname,
+                SYMBOL_MAX_MATCHES,
+            ),
+        )
+        .fetchall()
+    )
+    if not rows:
+        return f"\n在 {cache.root} 中没有找到符号 {name}\n"
+    sections = []
+    for path, found, kind, start, end in rows:
+        code = read_line_range(path, start, end)
+        sections.append(
+            f"符号 {found} ({kind}) 位于 {os.path.relpath(path, cache.root)} "
+            f"第{start}-{end}行:\n```\n{code.rstrip()}\n```"
+        )
+    return "\n\n" + "\n\n".join(sections) + "\n\n"
+
+
+def _read_text_snippet(file_path):
+    """读取文件开头，返回(是否文本, 最多MAX_FILE_SIZE字节的内容)"""
+    context = read_file_context(file_path)
+    return context.is_text, context.content
+
+
 def generate_treefullfile_context():
-    """生成完整目录结构及所有文件内容，但只显示文本文件的具体内容。"""
+    """生成完整目录结构及所有文件内容，但只显示文本文件的具体内容。
+
+    忽略.gitignore、隐藏目录、依赖和构建目录，用线程池并发读取，
+    总字节数达到预算后停止遍历。
+    """
     current_dir = os.getcwd()
-    dir_context = get_directory_context(max_depth=None)  # 假设这个函数已经定义了
+    dir_context = get_directory_context(max_depth=None)
     file_contents = []
-    
-    for root, dirs, files in os.walk(current_dir, topdown=True):
-        # 过滤隐藏目录和文件
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
-        files = [f for f in files if not f.startswith('.')]
-
-        for file in files:
-            file_path = os.path.join(root, file)
-            rel_path = os.path.relpath(file_path, current_dir)
-            
-            if is_text_file(file_path):
-                try:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read(MAX_FILE_SIZE)
-                        file_contents.append(f"文件路径: {rel_path}\n内容:\n```\n{content}\n```")
-                except Exception as e:
-                    file_contents.append(f"无法读取文件 {rel_path}: {str(e)}")
-            else:
-                file_contents.append(f"文件路径: {rel_path} (非文本文件)")
-    
+    used = 0
+    truncated = False
+
+    paths = (
+        rel_path
+        for rel_path, entry, _ in walk_directory(current_dir, skip_dirs=VENDOR_DIRS)
+        if entry.is_file(follow_symlinks=False)
+    )
+    window = collections.deque()
+    with ThreadPoolExecutor(max_workers=TREEFULLFILE_WORKERS) as executor:
+
+        def fill():
+            # 预读有限数量的文件，预算用完后不再继续遍历
+            while len(window) < TREEFULLFILE_WORKERS * 4:
+                rel_path = next(paths, None)
+                if rel_path is None:
+                    return
+                future = executor.submit(
+                    _read_text_snippet, os.path.join(current_dir, rel_path)
+                )
+                window.append((rel_path, future))
+
+        fill()
+        while window:
+            rel_path, future = window.popleft()
+            try:
+                is_text, content = future.result()
+                if is_text:
+                    entry = f"文件路径: {rel_path}\n内容:\n```\n{content}\n```"
+                else:
+                    entry = f"文件路径: {rel_path} (非文本文件)"
+            except OSError as e:
+                entry = f"无法读取文件 {rel_path}: {str(e)}"
+            size = len(entry.encode("utf-8"))
+            if used + size > TREEFULLFILE_BUDGET:
+                truncated = True
+                break
+            file_contents.append(entry)
+            used += size
+            fill()
+        for _, future in window:
+            future.cancel()
+
+    if truncated:
+        file_contents.append(
+            f"(已达到{TREEFULLFILE_BUDGET // 1024}KB的内容预算，省略其余文件)"
+        )
     return dir_context + "\n\n所有文件内容:\n" + "\n\n".join(file_contents)
 
 
@@ -497,37 +2695,229 @@ def get_clipboard_content():
         return f"获取剪贴板内容时出错: {str(e)}"
 
 
-def fetch_url_content(url, is_news=False):
-    """通过API获取URL对应的Markdown内容"""
+@functools.lru_cache(maxsize=None)
+def _convert_session():
+    """转换服务的HTTP会话，同一进程内的URL请求复用连接"""
+    import requests
+
+    session = requests.Session()
+    session.trust_env = False  # 禁用从环境变量读取代理，确保不使用任何代理
+    return session
+
+
+def fetch_url_content(url, is_news=False, max_tokens=URL_TOKEN_BUDGET):
+    """通过API获取URL对应的Markdown内容，流式读取，达到token预算后停止"""
     try:
-        api_url = f"http://127.0.0.1:8000/convert?url={url}&is_news={is_news}"
-        # 确保不使用任何代理
-        session = requests.Session()
-        session.trust_env = False  # 禁用从环境变量读取代理
-        response = session.get(api_url)
-        response.raise_for_status()
-        return response.text
+        params = {"url": url, "is_news": is_news, "stream": "true", "max_tokens": max_tokens}
+        with _convert_session().get(
+            f"{CONVERT_SERVER}/convert", params=params, stream=True, timeout=DIRECTIVE_TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            # 服务端已按预算截断时直接读完，否则(旧版服务)在客户端按预算停止读取
+            budget = None if "X-Truncated" in response.headers else max_tokens
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+            parts = []
+            tokens = 0
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                text = decoder.decode(chunk)
+                parts.append(text)
+                tokens += estimate_tokens(text)
+                if budget is not None and tokens > budget:
+                    parts.append("\n\n[内容已截断]\n")
+                    break
+            else:
+                parts.append(decoder.decode(b"", final=True))
+        return "".join(parts)
     except Exception as e:
         return f"获取URL内容失败: {str(e)}"
 
 
+def _fetch_urls_each(items, results, max_tokens):
+    """旧版转换服务没有批量接口，逐个URL并发请求，完成一个写入一个"""
+
+    def fetch(index, url, is_news):
+        results[index] = fetch_url_content(url, is_news, max_tokens)
+
+    with ThreadPoolExecutor(max_workers=min(DIRECTIVE_WORKERS, len(items))) as executor:
+        for index, (url, is_news) in enumerate(items):
+            executor.submit(fetch, index, url, is_news)
+    return results
+
+
+def fetch_urls_batch(items, results, max_tokens=URL_TOKEN_BUDGET):
+    """用一次批量请求转换多个(url, is_news)，结果按完成顺序写入与items同序的results
+
+    results由调用方传入，整体超时时已完成的URL仍然可用。服务端不支持批量接口时逐个获取。
+    """
+    body = {
+        "items": [{"url": url, "is_news": is_news} for url, is_news in items],
+        "max_tokens": max_tokens,
+    }
+    try:
+        with _convert_session().post(
+            f"{CONVERT_SERVER}/convert/batch", json=body, stream=True, timeout=DIRECTIVE_TIMEOUT
+        ) as response:
+            if response.status_code == 404:
+                return _fetch_urls_each(items, results, max_tokens)
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                item = json.loads(line)
+                if item["status"] == 200:
+                    results[item["index"]] = item["markdown"]
+                else:
+                    results[item["index"]] = f"获取URL内容失败: {item['error']}"
+    except Exception as e:
+        for index, result in enumerate(results):
+            if result is None:
+                results[index] = f"获取URL内容失败: {str(e)}"
+    return results
+
+
 USER_PROMPT_CONTEXT = {
     "edit": False,
     "read": False,
 }
 
 
+def run_with_timeouts(tasks, max_workers, timeout):
+    """用有限的并发执行一组无参任务，每个任务从开始运行起单独计时
+
+    返回与tasks顺序一致的(状态, 结果)列表，状态为ok/error/timeout。
+    使用守护线程，超时的任务不会拖住进程退出，并补充新的工作线程接替它。
+    """
+    results = [None] * len(tasks)
+    started = [None] * len(tasks)
+    pending = queue.Queue()
+    for index in range(len(tasks)):
+        pending.put(index)
+    done = threading.Condition()
+
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+            started[index] = time.monotonic()
+            try:
+                outcome = ("ok", tasks[index]())
+            except Exception as e:
+                outcome = ("error", e)
+            with done:
+                if results[index] is None:
+                    results[index] = outcome
+                done.notify_all()
+            if results[index][0] == "timeout":
+                return  # 已被判超时并由新线程接替
+
+    def spawn():
+        threading.Thread(target=worker, daemon=True).start()
+
+    for _ in range(min(max_workers, len(tasks))):
+        spawn()
+    with done:
+        while any(result is None for result in results):
+            now = time.monotonic()
+            for index, began in enumerate(started):
+                if results[index] is None and began is not None and now - began > timeout:
+                    results[index] = ("timeout", None)
+                    spawn()
+            done.wait(0.1)
+    return results
+
+
+# @file.py:120-260 形式的行范围指令
+_LINE_RANGE_DIRECTIVE = re.compile(r"^(.+):(\d+)-(\d+)$")
+
+
+def _classify_directive(match):
+    """判断@指令的类型：cmd、search、symbol、prompt、file、lines、url，无法识别时返回None"""
+    if match in DIRECTIVE_COMMANDS:
+        return "cmd"
+    if match.startswith("search:"):
+        return "search"
+    if match.startswith("symbol:"):
+        return "symbol"
+    if os.path.exists(os.path.join(os.path.dirname(__file__), "prompts", match)):
+        return "prompt"
+    if os.path.exists(os.path.abspath(os.path.expanduser(match))):
+        return "file"
+    line_range = _LINE_RANGE_DIRECTIVE.match(match)
+    if line_range and os.path.isfile(os.path.expanduser(line_range.group(1))):
+        return "lines"
+    if match.startswith("http") or match.startswith("read"):
+        return "url"
+    return None
+
+
+def _resolve_directive(kind, match, is_news, env_vars):
+    """读取单个@指令对应的内容，返回替换文本；URL指令由fetch_urls_batch批量处理"""
+    # 处理命令
+    if kind == "cmd":
+        return DIRECTIVE_COMMANDS[match]()
+
+    # @search:关键词1+关键词2，在本地索引中检索相关片段
+    if kind == "search":
+        query = re.sub(r"[+,]", " ", match[len("search:") :]).strip()
+        return search_workspace(query)
+
+    # @symbol:FooParser.parse，从符号表取出完整定义
+    if kind == "symbol":
+        return find_symbol(match[len("symbol:") :])
+
+    # @file.py:120-260，按行范围读取
+    if kind == "lines":
+        path, start, end = _LINE_RANGE_DIRECTIVE.match(match).groups()
+        expanded_path = os.path.abspath(os.path.expanduser(path))
+        content = read_line_range(expanded_path, int(start), int(end))[:MAX_FILE_SIZE]
+        return f"\n\n文件 {expanded_path} 第{start}-{end}行内容:\n```\n{content}\n```\n\n"
+
+    # 优先检查prompts目录下的文件
+    if kind == "prompt":
+        prompts_path = os.path.join(os.path.dirname(__file__), "prompts", match)
+        with open(prompts_path, "r", encoding="utf-8") as f:
+            content = f.read(MAX_PROMPT_SIZE)  # 最多读取10k
+            # 替换模板中的环境变量
+            content = content.format(**env_vars)
+        return f"\n{content}\n"
+
+    if kind == "file":
+        # 尝试展开相对路径，内容经工作区缓存读取，最多32k
+        expanded_path = os.path.abspath(os.path.expanduser(match))
+        context = read_file_context(expanded_path)
+        if not context.is_text:
+            return f"\n\n文件 {expanded_path} 是非文本文件\n\n"
+        content = context.content
+        return f"\n\n文件 {expanded_path} 内容:\n```\n{content}\n```\n\n"
+
+    raise ValueError(f"未知的指令类型: {kind}")
+
+
+def _directive_url(match):
+    """取出URL指令中的地址，@read前缀表示新闻正文提取"""
+    return match[4:] if match.startswith("read") else match
+
+
+def _format_url_content(url, markdown_content):
+    return f"\n\n参考URL: {url} \n内容(已经转换成markdown):\n{markdown_content}\n\n"
+
+
+# 命令映射表
+DIRECTIVE_COMMANDS = {
+    "clipboard": lambda: get_clipboard_content(),
+    "tree": lambda: get_directory_context(),
+    "treefull": lambda: get_directory_context(max_depth=None),
+    "treefullfile": lambda: generate_treefullfile_context(),
+}
+
+
 def process_text_with_file_path(text):
-    """处理包含@...的文本，支持@cmd命令、@path文件路径、@http网址和prompts目录下的模板文件"""
-
-    # 定义命令映射表
-    cmd_map = {
-        "clipboard": get_clipboard_content,
-        "tree": get_directory_context,
-        "treefull": lambda: get_directory_context(max_depth=None),
-        "treefullfile": generate_treefullfile_context,
-    }
+    """处理包含@...的文本，支持@cmd命令、@path文件路径、@http网址和prompts目录下的模板文件
 
+    所有指令并发解析，再按原始顺序替换回文本；超时或出错的指令替换为标记文字。
+    """
     # 定义环境变量
     env_vars = {
         "os": sys.platform,
@@ -538,6 +2928,8 @@ def process_text_with_file_path(text):
     # 使用正则表达式查找所有@开头的命令或路径
     matches = re.findall(r"@([^\s]+)", text)
 
+    # 先按顺序确定每个指令的类型和上下文标记，保持@read等标记的先后语义
+    jobs = []
     for match in matches:
         if text.endswith(match):
             match_key = f"@{match}"
@@ -546,52 +2938,47 @@ def process_text_with_file_path(text):
         # 如果match在context里，将context设为true
         if match in USER_PROMPT_CONTEXT:
             USER_PROMPT_CONTEXT[match] = True
-        try:
-
-            # 处理命令
-            if match in cmd_map:
-                result = cmd_map[match]()
-                text = text.replace(match_key, result)
-                continue
-
-            # 尝试展开相对路径
-            expanded_path = os.path.abspath(os.path.expanduser(match))
-
-            # 优先检查prompts目录下的文件
-            prompts_path = os.path.join(os.path.dirname(__file__), "prompts", match)
-            if os.path.exists(prompts_path):
-                with open(prompts_path, "r", encoding="utf-8") as f:
-                    content = f.read(MAX_PROMPT_SIZE)  # 最多读取10k
-                    # 替换模板中的环境变量
-                    content = content.format(**env_vars)
-                text = text.replace(match_key, f"\n{content}\n")
-                continue
-
-            if os.path.exists(expanded_path):
-                with open(expanded_path, "r", encoding="utf-8") as f:
-                    content = f.read(MAX_FILE_SIZE)  # 最多读取32k
-                text = text.replace(
-                    match_key,
-                    f"\n\n文件 {expanded_path} 内容:\n```\n{content}\n```\n\n",
-                )
-                continue
-
-            # 处理URL
-            if match.startswith("http") or match.startswith("read"):
-                # 如果match以read开头，则去掉read前缀
-                if match.startswith("read"):
-                    match = match[4:]
-                    USER_PROMPT_CONTEXT["read"] = True
-                markdown_content = fetch_url_content(match, USER_PROMPT_CONTEXT["read"])
-                text = text.replace(
-                    match_key,
-                    f"\n\n参考URL: {match} \n内容(已经转换成markdown):\n{markdown_content}\n\n",
-                )
-                continue
-
-        except Exception as e:
-            print(f"处理 {match} 时出错: {str(e)}")
-            sys.exit(1)
+        kind = _classify_directive(match)
+        if kind is None:
+            continue
+        if kind == "url" and match.startswith("read"):
+            USER_PROMPT_CONTEXT["read"] = True
+        jobs.append((kind, match, match_key, USER_PROMPT_CONTEXT["read"]))
+
+    # URL指令合并为一次批量请求，由转换服务统一调度到各个浏览器
+    url_indexes = [i for i, job in enumerate(jobs) if job[0] == "url" and _directive_url(job[1])]
+    other_indexes = [i for i, job in enumerate(jobs) if job[0] != "url"]
+    tasks = [
+        functools.partial(_resolve_directive, jobs[i][0], jobs[i][1], jobs[i][3], env_vars)
+        for i in other_indexes
+    ]
+    url_results = [None] * len(url_indexes)
+    if url_indexes:
+        batch = [(_directive_url(jobs[i][1]), jobs[i][3]) for i in url_indexes]
+        tasks.append(functools.partial(fetch_urls_batch, batch, url_results))
+    outcomes = run_with_timeouts(tasks, DIRECTIVE_WORKERS, DIRECTIVE_TIMEOUT)
+
+    resolved = dict(zip(other_indexes, outcomes))
+    if url_indexes:
+        batch_status, batch_error = outcomes[-1]
+        for i, content in zip(url_indexes, url_results):
+            if content is not None:
+                resolved[i] = ("ok", _format_url_content(_directive_url(jobs[i][1]), content))
+            elif batch_status == "ok":
+                resolved[i] = ("error", "转换服务没有返回结果")
+            else:
+                resolved[i] = (batch_status, batch_error)
+
+    for i, (_, match, match_key, _) in enumerate(jobs):
+        # 只有@read没有地址时不需要替换内容
+        status, result = resolved.get(i, ("ok", ""))
+        if status == "timeout":
+            print(f"处理 {match} 超时，已跳过")
+            result = f"\n[@{match} 超过{DIRECTIVE_TIMEOUT}秒未完成，内容缺失]\n"
+        elif status == "error":
+            print(f"处理 {match} 时出错: {str(result)}")
+            result = f"\n[@{match} 处理出错: {result}]\n"
+        text = text.replace(match_key, result)
 
     return text
 
@@ -600,44 +2987,101 @@ def process_text_with_file_path(text):
 shadowroot = Path(os.path.expanduser("~/.shadowroot"))
 
 
-def extract_and_diff_files(content):
-    """从内容中提取文件并生成diff"""
-    # 提取文件内容并保存
-    # 创建shadowroot目录
-    # 备份response.md内容
+# 文件块的起止标记行：@文件名，文件名中不含空白
+_FILE_BLOCK_MARKER = re.compile(r"^@(\S+)\s*$")
+_CODE_FENCE_LINE = re.compile(r"^\s*(`{3,}|~{3,})[\w+#.-]*\s*$")
 
-    response_path = shadowroot / Path("response.md")
-    with open(response_path, "w+", encoding="utf-8") as dst:
-        dst.write(content)
-    matches = re.findall(r"@([^\n]+)\n(.*)?\n@\1", content, re.S)
-    if not matches:
-        return
 
-    # print(f"已备份response.md到: {response_path}")
-    # 用于存储diff内容
-    diff_content = ""
+class FileBlockExtractor:
+    """从流式回答中增量识别 @文件名\n内容\n@文件名 形式的文件块，作为emit回调使用
+
+    每个文件块在结束标记出现时立即写入shadowroot下的影子文件，并生成与原文件的diff，
+    回答结束时前面文件的diff已经就绪。只缓存当前未闭合文件块的内容。
+    单个文件块读写失败只记入errors，不中断流式输出。
+    """
+
+    def __init__(self, root=None):
+        self.root = root or shadowroot
+        self.pending = ""
+        # 当前打开的文件块名称及其内容行，块内出现的其它@标记行都属于文件内容
+        self.active = None
+        self.lines = []
+        self.saved = []
+        self.diffs = []
+        self.errors = []
+
+    @classmethod
+    def combine(cls, extractors):
+        """合并逐个分块流式处理过的结果，影子文件不再重复写入"""
+        combined = cls()
+        for extractor in extractors:
+            combined.saved.extend(extractor.saved)
+            combined.diffs.extend(extractor.diffs)
+            combined.errors.extend(extractor.errors)
+        return combined
+
+    def emit(self, kind, text):
+        if kind != "content":
+            return
+        self.pending += text
+        *lines, self.pending = self.pending.split("\n")
+        for line in lines:
+            self.feed_line(line)
+
+    def finish(self):
+        """处理最后一行（结束标记可能没有换行）
+
+        到结尾仍未闭合的起始标记不是文件块，从它之后的内容重新识别。
+        """
+        if self.pending:
+            self.feed_line(self.pending)
+            self.pending = ""
+        while self.active is not None:
+            lines = self.lines
+            self.active = None
+            self.lines = []
+            for line in lines:
+                self.feed_line(line)
+
+    def feed_line(self, line):
+        marker = _FILE_BLOCK_MARKER.match(line)
+        if self.active is None:
+            if marker:
+                self.active = marker.group(1)
+            return
+        if marker and marker.group(1) == self.active:
+            self.close(self.active, self.lines)
+            self.active = None
+            self.lines = []
+            return
+        self.lines.append(line)
+
+    def close(self, filename, lines):
+        # 去掉模型额外包裹的代码围栏
+        if len(lines) >= 2 and _CODE_FENCE_LINE.match(lines[0]) and _CODE_FENCE_LINE.match(lines[-1]):
+            lines = lines[1:-1]
+        file_content = "\n".join(lines)
 
-    for filename, file_content in matches:
         # 处理文件路径
         file_path = Path(filename)
         old_file_path = file_path
         # 如果是绝对路径，转换为相对路径
         if file_path.is_absolute():
-            parts = file_path.parts[1:]
-            file_path = Path(*parts)
+            file_path = Path(*file_path.parts[1:])
         # 组合到shadowroot目录
-        shadow_file_path = shadowroot / file_path
-        # 创建父目录
-        shadow_file_path.parent.mkdir(parents=True, exist_ok=True)
-        # 写入文件内容
-        with open(shadow_file_path, "w", encoding="utf-8") as f:
-            f.write(file_content)
-        print(f"已保存文件到: {shadow_file_path}")
+        shadow_file_path = self.root / file_path
+        try:
+            shadow_file_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(shadow_file_path, "w", encoding="utf-8") as f:
+                f.write(file_content)
+            self.saved.append(shadow_file_path)
+
+            # 生成unified diff
+            if old_file_path.exists():
+                import difflib
 
-        # 生成unified diff
-        if old_file_path.exists():
-            with open(old_file_path, "r", encoding="utf-8") as orig_file:
-                original_content = orig_file.read()
+                with open(old_file_path, "r", encoding="utf-8") as orig_file:
+                    original_content = orig_file.read()
                 diff = difflib.unified_diff(
                     original_content.splitlines(),
                     file_content.splitlines(),
@@ -645,7 +3089,39 @@ def extract_and_diff_files(content):
                     tofile=str(shadow_file_path),
                     lineterm="",
                 )
-                diff_content += "\n".join(diff) + "\n\n"
+                self.diffs.append("\n".join(diff) + "\n\n")
+        except (OSError, UnicodeDecodeError) as e:
+            # 例如原文件不是UTF-8，或文件名指向一个目录
+            self.errors.append(f"{filename}: {e}")
+
+
+def extract_and_diff_files(content, blocks=None):
+    """保存回答中的文件块并生成diff，返回待确认应用的diff文件，没有时返回None
+
+    blocks为生成过程中已经增量处理过的FileBlockExtractor，未提供时对完整内容处理一遍。
+    询问是否应用由调用方在记录耗时之后通过confirm_and_apply_diff进行。
+    """
+    from pygments import highlight
+    from pygments.lexers import DiffLexer
+    from pygments.formatters import TerminalFormatter
+
+    # 备份response.md内容
+    response_path = shadowroot / Path("response.md")
+    with open(response_path, "w+", encoding="utf-8") as dst:
+        dst.write(content)
+    if blocks is None:
+        blocks = FileBlockExtractor()
+        blocks.emit("content", content)
+        blocks.finish()
+    for error in blocks.errors:
+        print(f"处理文件块失败，已跳过: {error}")
+    if not blocks.saved:
+        return None
+
+    for shadow_file_path in blocks.saved:
+        print(f"已保存文件到: {shadow_file_path}")
+    # 用于存储diff内容
+    diff_content = "".join(blocks.diffs)
 
     # 将diff写入文件
     if diff_content:
@@ -662,22 +3138,29 @@ def extract_and_diff_files(content):
             highlighted_diff = highlight(diff_text, DiffLexer(), TerminalFormatter())
             print("\n高亮显示的diff内容：")
             print(highlighted_diff)
-        # 询问用户是否应用diff
-        print(f"\n申请变更文件，是否应用 {diff_file}？")
-        apply = input("输入 y 应用，其他键跳过: ").lower()
-        if apply == "y":
-            # 应用diff
-            try:
-                subprocess.run(["patch", "-p0", "-i", str(diff_file)], check=True)
-                print("已成功应用变更")
-            except subprocess.CalledProcessError as e:
-                print(f"应用变更失败: {e}")
+        return diff_file
+    return None
+
+
+def confirm_and_apply_diff(diff_file):
+    """询问用户是否用patch应用diff文件"""
+    if diff_file is None:
+        return
+    print(f"\n申请变更文件，是否应用 {diff_file}？")
+    apply = input("输入 y 应用，其他键跳过: ").lower()
+    if apply == "y":
+        # 应用diff
+        try:
+            subprocess.run(["patch", "-p0", "-i", str(diff_file)], check=True)
+            print("已成功应用变更")
+        except subprocess.CalledProcessError as e:
+            print(f"应用变更失败: {e}")
 
 
 def process_response(
     response_data, file_path, save=True, obsidian_doc=None, ask_param=None
 ):
-    """处理API响应并保存结果"""
+    """处理API响应并保存结果，返回待确认应用的diff文件"""
     if not response_data["choices"]:
         raise ValueError("API返回空响应")
 
@@ -705,8 +3188,8 @@ def process_response(
 
         with open(save_path, "w", encoding="utf-8") as f:
             f.write(content)
-    else:
-        # 使用临时文件
+    elif MARKDOWN_RENDERER == "glow":
+        # 使用临时文件交给glow渲染
         with tempfile.NamedTemporaryFile(
             mode="w", suffix=".md", encoding="utf-8", delete=False
         ) as tmp_file:
@@ -742,22 +3225,107 @@ def process_response(
     if not check_deps_installed():
         sys.exit(1)
 
-    # 调用提取和diff函数
-    try:
-        subprocess.run(["glow", save_path], check=True)
-        # 如果是临时文件，使用后删除
-        if not save:
-            os.unlink(save_path)
-    except subprocess.CalledProcessError as e:
-        print(f"glow运行失败: {e}")
-        sys.exit(1)
+    # 内置渲染器已在生成时输出格式化结果，只有选择glow时再完整渲染一次
+    if MARKDOWN_RENDERER == "glow":
+        try:
+            subprocess.run(["glow", save_path], check=True)
+            # 如果是临时文件，使用后删除
+            if not save:
+                os.unlink(save_path)
+        except subprocess.CalledProcessError as e:
+            print(f"glow运行失败: {e}")
+            sys.exit(1)
+
+    return extract_and_diff_files(content, response_data.get("file_blocks"))
+
+
+def _timed(func):
+    """执行func并返回耗时（毫秒）"""
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+
+def profile_startup():
+    """输出启动耗时报告：冷启动、模块加载、延迟导入和初始化步骤"""
+    rows = []
 
-    extract_and_diff_files(content)
+    # 新进程里只导入本模块，即askgpt客户端路径的冷启动开销
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", "import llm_query"],
+        cwd=Path(__file__).parent,
+        check=False,
+    )
+    rows.append(("冷启动(新进程 import llm_query)", (time.perf_counter() - start) * 1000))
+    rows.append(
+        ("本进程 llm_query 模块加载", (_MODULE_LOAD_END - _MODULE_LOAD_START) * 1000)
+    )
+
+    for module in ["requests", "difflib", "pygments", "httpx", "openai", "tree_sitter"]:
+        if module in sys.modules:
+            rows.append((f"import {module}", 0.0))
+            continue
+        try:
+            cost = _timed(lambda: importlib.import_module(module))
+            rows.append((f"import {module}", cost))
+        except ImportError:
+            rows.append((f"import {module} (未安装)", 0.0))
+
+    api_key = os.getenv("GPT_KEY", "profile")
+    base_url = os.getenv("GPT_BASE_URL", "http://127.0.0.1")
+    rows.append(("读取model.json", _timed(load_model_config)))
+    rows.append(("检测代理配置", _timed(detect_proxies)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows.append(("依赖工具检测", _timed(check_deps_installed)))
+    if "openai" in sys.modules:
+        cost = _timed(lambda: get_openai_client(api_key, base_url))
+        rows.append(("创建OpenAI客户端", cost))
+
+    print("\n启动耗时报告 (毫秒):")
+    width = max(len(name) for name, _ in rows)
+    for name, cost in rows:
+        print(f"  {name.ljust(width)} : {cost:8.2f}")
+    daemon_state = "运行中" if os.path.exists(DAEMON_SOCKET) else "未启动"
+    print(f"  常驻进程: {daemon_state} ({DAEMON_SOCKET})")
 
 
 def main():
     args = parse_arguments()
 
+    if args.daemon:
+        run_daemon()
+        return
+
+    if args.watch:
+        watch_workspace(args.watch)
+        return
+
+    if args.profile_startup:
+        profile_startup()
+        return
+
+    if args.compact_conversations:
+        compact_all_conversations()
+        return
+
+    if args.cache_stats:
+        response_cache_stats()
+        return
+
+    if args.stats:
+        timing_stats()
+        return
+
+    if args.no_cache:
+        RESPONSE_CACHE_OPTIONS["mode"] = "off"
+    elif args.refresh_cache:
+        RESPONSE_CACHE_OPTIONS["mode"] = "refresh"
+
+    if args.rebuild_catalog:
+        print(f"已登记 {len(rebuild_catalog())} 个对话")
+        return
+
     # 如果目录不存在则创建
     shadowroot.mkdir(parents=True, exist_ok=True)
     # 集中检查环境变量
@@ -806,7 +3374,9 @@ def main():
     else:
         ask_param = args.file
     if args.ask:
+        start = time.perf_counter()
         text = process_text_with_file_path(args.ask)
+        _add_timing("context_ms", (time.perf_counter() - start) * 1000)
         print(text)
         response_data = query_gpt_api(
             api_key,
@@ -815,13 +3385,18 @@ def main():
             model=os.environ["GPT_MODEL"],
             base_url=base_url,
         )
-        process_response(
+        start = time.perf_counter()
+        diff_file = process_response(
             response_data,
             "",
             save=False,
             obsidian_doc=args.obsidian_doc,
             ask_param=ask_param,
         )
+        # 耗时在询问是否应用diff之前记录，不包含等待用户输入的时间
+        _add_timing("render_ms", (time.perf_counter() - start) * 1000)
+        write_timing_record("ask")
+        confirm_and_apply_diff(diff_file)
         return
 
     try:
@@ -831,30 +3406,55 @@ def main():
             code_content = f.read()
 
         # 如果代码超过分块大小，则分割处理
-        if len(code_content) > args.chunk_size:
-            code_chunks = split_code(code_content, args.chunk_size)
+        if estimate_tokens(code_content) > args.chunk_size:
+            code_chunks = split_code(code_content, args.chunk_size, args.file)
             responses = []
             total_chunks = len(code_chunks)
-            for i, chunk in enumerate(code_chunks, 1):
-                # 在提示词中添加当前分块信息
-                pager = f"这是代码的第 {i}/{total_chunks} 部分：\n\n"
-                print(pager)
-                chunk_prompt = prompt_template.format(
-                    path=args.file, pager=pager, code=chunk
+            chunk_prompts = [
+                prompt_template.format(
+                    path=args.file,
+                    pager=f"这是代码的第 {i}/{total_chunks} 部分：\n\n",
+                    code=chunk,
                 )
-                response_data = query_gpt_api(
+                for i, chunk in enumerate(code_chunks, 1)
+            ]
+            if args.parallel > 1:
+                print(f"共 {total_chunks} 个分块，并发数 {args.parallel}\n")
+                answers = query_chunks_concurrently(
                     api_key,
-                    chunk_prompt,
-                    proxies=proxies,
+                    chunk_prompts,
                     model=os.environ["GPT_MODEL"],
                     base_url=base_url,
+                    max_workers=args.parallel,
+                    retries=args.chunk_retries,
                 )
+                # 并发分块没有逐块提取，交给process_response对合并后的回答处理一遍
+                file_blocks = None
+            else:
+                answers = []
+                chunk_blocks = []
+                for i, chunk_prompt in enumerate(chunk_prompts, 1):
+                    # 在提示词中添加当前分块信息
+                    print(f"这是代码的第 {i}/{total_chunks} 部分：\n\n")
+                    response_data = query_gpt_api(
+                        api_key,
+                        chunk_prompt,
+                        proxies=proxies,
+                        model=os.environ["GPT_MODEL"],
+                        base_url=base_url,
+                    )
+                    answers.append(response_data["choices"][0]["message"]["content"])
+                    chunk_blocks.append(response_data["file_blocks"])
+                # 各分块的文件块已在生成时写入并生成diff
+                file_blocks = FileBlockExtractor.combine(chunk_blocks)
+            for i, answer in enumerate(answers, 1):
                 response_pager = f"\n这是回答的第 {i}/{total_chunks} 部分：\n\n"
-                responses.append(
-                    response_pager + response_data["choices"][0]["message"]["content"]
-                )
+                responses.append(response_pager + answer)
             final_content = "\n\n".join(responses)
-            response_data = {"choices": [{"message": {"content": final_content}}]}
+            response_data = {
+                "choices": [{"message": {"content": final_content}}],
+                "file_blocks": file_blocks,
+            }
         else:
             full_prompt = prompt_template.format(
                 path=args.file, pager="", code=code_content
@@ -866,17 +3466,24 @@ def main():
                 model=os.environ["GPT_MODEL"],
                 base_url=base_url,
             )
-        process_response(
+        start = time.perf_counter()
+        diff_file = process_response(
             response_data,
             args.file,
             obsidian_doc=args.obsidian_doc,
             ask_param=ask_param,
         )
+        # 耗时在询问是否应用diff之前记录，不包含等待用户输入的时间
+        _add_timing("render_ms", (time.perf_counter() - start) * 1000)
+        write_timing_record("file")
+        confirm_and_apply_diff(diff_file)
 
     except Exception as e:
         print(f"运行时错误: {e}")
         sys.exit(1)
 
 
+_MODULE_LOAD_END = time.perf_counter()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
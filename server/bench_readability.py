@@ -0,0 +1,106 @@
+"""比较进程内readability-lxml和node readability服务的新闻正文提取
+
+用法: python server/bench_readability.py 保存的网页目录 [--repeat 3] [--node-url URL]
+
+目录中的每个.html/.htm文件都会分别走两条路径并转换为Markdown：
+  python: readability-lxml提取正文 -> MarkItDown (与服务器工作进程相同)
+  node:   JSON序列化后POST到node/index.js -> 解析JSON -> MarkItDown
+"""
+import argparse
+import io
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import requests
+from markitdown import MarkItDown
+
+from server import extract_article, NODE_READABILITY_URL
+
+
+def to_markdown(md, html):
+    return md.convert_stream(io.BytesIO(html.encode('utf-8')), file_extension=".html").text_content
+
+
+def run_python(md, html):
+    return to_markdown(md, extract_article(html))
+
+
+def run_node(md, html, session, node_url):
+    response = session.post(
+        node_url,
+        data=json.dumps({'content': html}),
+        headers={'Content-Type': 'application/json'},
+        timeout=60
+    )
+    response.raise_for_status()
+    return to_markdown(md, response.json()['content'])
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比较python与node两种正文提取方式的耗时和输出大小')
+    parser.add_argument('corpus', help='保存的网页目录(.html/.htm)')
+    parser.add_argument('--repeat', type=int, default=3, help='每个页面每种方式重复次数，取最小值')
+    parser.add_argument('--node-url', default=NODE_READABILITY_URL, help='node readability服务地址')
+    parser.add_argument('--skip-node', action='store_true', help='只测python路径')
+    args = parser.parse_args()
+
+    pages = sorted(p for p in Path(args.corpus).iterdir() if p.suffix.lower() in ('.html', '.htm'))
+    if not pages:
+        sys.exit(f"{args.corpus} 中没有.html文件")
+
+    md = MarkItDown()
+    session = requests.Session()
+    session.trust_env = False
+    backends = {'python': lambda html: run_python(md, html)}
+    if not args.skip_node:
+        backends['node'] = lambda html: run_node(md, html, session, args.node_url)
+
+    timings = {name: [] for name in backends}
+    sizes = {name: [] for name in backends}
+    failures = {name: 0 for name in backends}
+    print(f"{'页面':40} {'HTML KB':>8} " + " ".join(f"{name + ' ms':>10} {name + ' KB':>9}" for name in backends))
+    for page in pages:
+        html = page.read_text(encoding='utf-8', errors='ignore')
+        row = [f"{page.name[:40]:40}", f"{len(html.encode('utf-8')) / 1024:8.1f}"]
+        for name, run in backends.items():
+            best = None
+            try:
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    output = run(html)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+            except Exception as e:
+                failures[name] += 1
+                row.append(f"{'失败':>10} {'-':>9}")
+                print(f"  {name} 处理 {page.name} 失败: {e}", file=sys.stderr)
+                continue
+            timings[name].append(best)
+            sizes[name].append(len(output.encode('utf-8')))
+            row.append(f"{best * 1000:10.1f} {sizes[name][-1] / 1024:9.1f}")
+        print(" ".join(row))
+
+    print()
+    for name in backends:
+        if not timings[name]:
+            print(f"{name}: 全部失败")
+            continue
+        print(
+            f"{name}: {len(timings[name])}页, 失败{failures[name]}, "
+            f"中位数 {statistics.median(timings[name]) * 1000:.1f}ms, "
+            f"p95 {percentile(timings[name], 0.95) * 1000:.1f}ms, "
+            f"合计 {sum(timings[name]):.2f}s, "
+            f"平均输出 {statistics.mean(sizes[name]) / 1024:.1f}KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
 const DEBUG = true; // 设为false关闭调试输出
 
+const DEFAULT_MAX_CONCURRENT = 4;  // 默认同时处理的页面数
+const JOB_TIMEOUT = 50000;         // 单个页面最长处理时间，需小于服务器的60秒超时
+const IDLE_TAB_TIMEOUT = 60000;    // 空闲标签页保留时间，超时后关闭
+const MAX_TAB_USES = 20;           // 标签页复用次数上限，超过后关闭重建，避免内存膨胀
+
 let ws = null, reconnectTimer = null;
-let currentTabId = null;
-let requestId = null;
+let maxConcurrent = DEFAULT_MAX_CONCURRENT;
+const jobs = new Map();      // tabId -> {requestId, url, injected, timer}
+const idleTabs = [];         // 可复用的空闲标签页 {tabId, uses, timer}
+const tabUses = new Map();   // tabId -> 已处理的页面数
+const waiting = [];          // 超出并发上限时本地排队的请求
 
 async function connectWebSocket(serverUrl) {
   if (ws && ws.readyState === WebSocket.OPEN) return;
@@ -12,66 +20,183 @@ async function connectWebSocket(serverUrl) {
   ws.onopen = () => {
     if (DEBUG) console.debug('✅ 成功连接WS服务器');
     clearTimeout(reconnectTimer);
+    // 告诉服务器本扩展可以同时处理多少个页面
+    ws.send(JSON.stringify({ type: 'hello', capacity: maxConcurrent }));
   };
 
   ws.onmessage = async (event) => {
     if (DEBUG) console.debug('📨 收到服务器消息:', event.data);
     const data = JSON.parse(event.data);
     if (data.type === 'extract') {
-      currentTabId = await createTab(data.url);
-      requestId = data.requestId;
+      waiting.push({ requestId: data.requestId, url: data.url });
+      dispatch();
+    } else if (data.type === 'cancel') {
+      cancelJob(data.requestId);
     }
   };
 
   ws.onclose = () => {
     if (DEBUG) console.debug('❌ 连接断开，1秒后重连...');
-      reconnectTimer = setTimeout(() => initWebSocket(), 1000);
+    // 服务器会把未完成的请求转给其他浏览器，这里直接放弃
+    waiting.length = 0;
+    for (const tabId of [...jobs.keys()]) finishJob(tabId);
+    reconnectTimer = setTimeout(() => initWebSocket(), 1000);
   };
 }
 
 
 function initWebSocket() {
-  chrome.storage.local.get(['serverUrl'], (result) => {
+  chrome.storage.local.get(['serverUrl', 'maxConcurrent'], (result) => {
     const serverUrl = result.serverUrl || 'ws://localhost:8000/ws';
+    maxConcurrent = parseInt(result.maxConcurrent, 10) || DEFAULT_MAX_CONCURRENT;
     connectWebSocket(serverUrl);
   });
 }
 
-async function createTab(url) {
-  if (DEBUG) console.debug(`🆕 正在创建标签页: ${url}`);
-  const tab = await chrome.tabs.create({ url, active: false });
-  if (DEBUG) console.debug(`✅ 标签页创建成功，ID: ${tab.id}`);
-  // 添加标签页加载监听器                                                     
-  chrome.tabs.onUpdated.addListener(async function listener(tabId, changeInfo) {
-    if (tabId === tab.id && changeInfo.status === 'complete') {
-      if (DEBUG) console.debug(`✅ 标签页加载完成，注入提取脚本`);
-
-      try {
-        await chrome.scripting.executeScript({
-          target: { tabId: tab.id },
-          files: ['extract.js']
-        });
-      } catch (error) {
-        console.error('脚本注入失败:', error);
-      }
-
-      chrome.tabs.onUpdated.removeListener(listener);
+function send(message) {
+  if (ws && ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify(message));
+}
+
+async function dispatch() {
+  while (waiting.length && jobs.size < maxConcurrent) {
+    const { requestId, url } = waiting.shift();
+    try {
+      await startJob(requestId, url);
+    } catch (error) {
+      console.error('标签页创建失败:', error);
+      send({ type: 'htmlError', requestId, error: `打开页面失败: ${error.message}` });
     }
-  });
-  return tab.id;
+  }
+}
+
+async function startJob(requestId, url) {
+  const job = { requestId, url, injected: false, timer: null };
+  let tabId;
+  const idle = idleTabs.pop();
+  if (idle) {
+    clearTimeout(idle.timer);
+    tabId = idle.tabId;
+    jobs.set(tabId, job);
+    if (DEBUG) console.debug(`♻️ 复用标签页 ${tabId}: ${url}`);
+    await chrome.tabs.update(tabId, { url });
+  } else {
+    if (DEBUG) console.debug(`🆕 正在创建标签页: ${url}`);
+    // 先创建空白页再登记任务，避免加载完成事件早于登记
+    const tab = await chrome.tabs.create({ url: 'about:blank', active: false });
+    tabId = tab.id;
+    tabUses.set(tabId, 0);
+    jobs.set(tabId, job);
+    if (DEBUG) console.debug(`✅ 标签页创建成功，ID: ${tabId}`);
+    await chrome.tabs.update(tabId, { url });
+  }
+  job.timer = setTimeout(() => {
+    if (jobs.get(tabId) !== job) return;
+    send({ type: 'htmlError', requestId, error: '页面处理超时' });
+    finishJob(tabId, { discard: true });
+  }, JOB_TIMEOUT);
+}
+
+// 服务器端已超时的请求：丢弃排队项或关闭正在加载的标签页，回复后服务器才释放名额
+function cancelJob(requestId) {
+  const index = waiting.findIndex((item) => item.requestId === requestId);
+  if (index !== -1) {
+    waiting.splice(index, 1);
+  } else {
+    const entry = [...jobs.entries()].find(([, job]) => job.requestId === requestId);
+    if (!entry) return;  // 已经完成，结果正在回传
+    if (DEBUG) console.debug(`🛑 取消请求 ${requestId}，关闭标签页 ${entry[0]}`);
+    finishJob(entry[0], { discard: true });
+  }
+  send({ type: 'htmlError', requestId, error: '已取消' });
+}
+
+// 任务结束后把标签页放回池中，超过复用次数、池已满或页面异常时关闭
+function finishJob(tabId, { discard = false } = {}) {
+  const job = jobs.get(tabId);
+  if (!job) return;
+  clearTimeout(job.timer);
+  jobs.delete(tabId);
+
+  const uses = (tabUses.get(tabId) || 0) + 1;
+  tabUses.set(tabId, uses);
+  if (discard || uses >= MAX_TAB_USES || idleTabs.length + jobs.size >= maxConcurrent) {
+    closeTab(tabId);
+  } else {
+    chrome.tabs.update(tabId, { url: 'about:blank' }).catch(() => closeTab(tabId));
+    const idle = { tabId, timer: null };
+    idle.timer = setTimeout(() => {
+      const index = idleTabs.indexOf(idle);
+      if (index !== -1) idleTabs.splice(index, 1);
+      closeTab(tabId);
+    }, IDLE_TAB_TIMEOUT);
+    idleTabs.push(idle);
+  }
+  dispatch();
 }
 
+function closeTab(tabId) {
+  tabUses.delete(tabId);
+  chrome.tabs.remove(tabId).catch(() => {});
+}
+
+// 标签页加载完成后注入提取脚本，跳过回收时的about:blank
+chrome.tabs.onUpdated.addListener(async (tabId, changeInfo, tab) => {
+  const job = jobs.get(tabId);
+  if (!job || job.injected || changeInfo.status !== 'complete') return;
+  if (!tab.url || tab.url === 'about:blank') return;
+  job.injected = true;
+  if (DEBUG) console.debug(`✅ 标签页 ${tabId} 加载完成，注入提取脚本`);
+
+  try {
+    await chrome.scripting.executeScript({
+      target: { tabId },
+      files: ['extract.js']
+    });
+  } catch (error) {
+    console.error('脚本注入失败:', error);
+    if (jobs.get(tabId) === job) {
+      send({ type: 'htmlError', requestId: job.requestId, error: `脚本注入失败: ${error.message}` });
+      finishJob(tabId, { discard: true });
+    }
+  }
+});
+
+// 标签页被用户或浏览器关闭
+chrome.tabs.onRemoved.addListener((tabId) => {
+  const index = idleTabs.findIndex((idle) => idle.tabId === tabId);
+  if (index !== -1) {
+    clearTimeout(idleTabs[index].timer);
+    idleTabs.splice(index, 1);
+  }
+  tabUses.delete(tabId);
+  const job = jobs.get(tabId);
+  if (job) {
+    clearTimeout(job.timer);
+    jobs.delete(tabId);
+    send({ type: 'htmlError', requestId: job.requestId, error: '标签页已被关闭' });
+    dispatch();
+  }
+});
+
 chrome.runtime.onMessage.addListener((message, sender) => {
-  if (message.action === 'htmlContent' && sender.tab.id === currentTabId) {
-    if (DEBUG) console.debug(`📤 发送HTML内容，长度: ${message.content.length} 字符`);
-    ws.send(JSON.stringify({
-      type: 'htmlResponse',
-      content: message.content,
-      requestId: requestId,
-    }));
-    requestId = null;
-    chrome.tabs.remove(sender.tab.id);
-    currentTabId = null;
+  if (message.action !== 'htmlContent' || !sender.tab) return;
+  const job = jobs.get(sender.tab.id);
+  if (!job) return;
+  if (DEBUG) console.debug(`📤 发送HTML内容，请求ID: ${job.requestId}，长度: ${message.content.length} 字符`);
+  send({
+    type: 'htmlResponse',
+    content: message.content,
+    requestId: job.requestId,
+  });
+  finishJob(sender.tab.id);
+});
+
+// 修改并发设置后重新向服务器声明
+chrome.storage.onChanged.addListener((changes) => {
+  if (changes.maxConcurrent) {
+    maxConcurrent = parseInt(changes.maxConcurrent.newValue, 10) || DEFAULT_MAX_CONCURRENT;
+    send({ type: 'hello', capacity: maxConcurrent });
+    dispatch();
   }
 });
 
@@ -2,10 +2,11 @@
                                                                               
 function initOptions() {                                                      
     // 加载保存的地址                                                         
-    chrome.storage.local.get(['serverUrl'], function(result) {                
-        document.getElementById('serverUrl').value = result.serverUrl ||      'ws://localhost:8000/ws';                                                       
-    });                                                                       
-                                                                              
+    chrome.storage.local.get(['serverUrl', 'maxConcurrent'], function(result) {
+        document.getElementById('serverUrl').value = result.serverUrl || 'ws://localhost:8000/ws';
+        document.getElementById('maxConcurrent').value = result.maxConcurrent || 4;
+    });
+
     document.getElementById('testBtn').addEventListener('click',              testConnection);                                                                
     document.getElementById('saveBtn').addEventListener('click', saveSettings);
 }                                                                             
@@ -41,13 +42,18 @@ function testConnection() {
     };                                                                        
 }                                                                             
                                                                               
-function saveSettings() {                                                     
-    const url = document.getElementById('serverUrl').value;                   
-    chrome.storage.local.set({ serverUrl: url }, () => {                      
-        showStatus('设置已保存！', 'success');                                
-    });                                                                       
-}                                                                             
-                                                                              
+function saveSettings() {
+    const url = document.getElementById('serverUrl').value;
+    const maxConcurrent = parseInt(document.getElementById('maxConcurrent').value, 10);
+    if (!(maxConcurrent >= 1 && maxConcurrent <= 16)) {
+        showStatus('同时处理的页面数必须在1到16之间', 'error');
+        return;
+    }
+    chrome.storage.local.set({ serverUrl: url, maxConcurrent }, () => {
+        showStatus('设置已保存！', 'success');
+    });
+}
+
 function showStatus(message, type) {                                          
     const status = document.getElementById('status');                         
     status.textContent = message;                                             
@@ -1,10 +1,21 @@
 
 import json
 import uuid
-import tempfile
 import os
 import logging
-from tornado import web, websocket, ioloop, gen
+import time
+import sqlite3
+import asyncio
+import collections
+import bisect
+import contextlib
+import io
+import multiprocessing
+import re
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tornado import web, websocket, ioloop, gen, iostream
 import pdb
 from markitdown import MarkItDown
 import argparse
@@ -21,8 +32,432 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-connected_clients = {}
-pending_requests = {}
+# 浏览器未通过hello消息声明并发能力时同时处理的请求数，以及所有浏览器都忙时最多排队的请求数
+BROWSER_MAX_INFLIGHT = int(os.getenv('BROWSER_MAX_INFLIGHT', 1))
+CONVERT_QUEUE_SIZE = int(os.getenv('CONVERT_QUEUE_SIZE', 32))
+CONVERT_RETRY_AFTER = int(os.getenv('CONVERT_RETRY_AFTER', 5))
+# 单个批量请求的URL数，默认不超过等待队列，保证一批能整体排进调度器
+CONVERT_BATCH_MAX = int(os.getenv('CONVERT_BATCH_MAX', CONVERT_QUEUE_SIZE))
+BROWSER_TIMEOUT = 60
+# 浏览器断开时请求会被转给其他浏览器，最多派发这么多次
+BROWSER_MAX_ATTEMPTS = 2
+# 超时的请求会通知浏览器取消，名额保留到浏览器回复，最多再等这么久
+BROWSER_CANCEL_GRACE = 10
+
+# HTML转Markdown在独立进程中进行，不阻塞IOLoop
+CONVERT_WORKERS = int(os.getenv('CONVERT_WORKERS', min(4, os.cpu_count() or 1)))
+CONVERT_MAX_HTML_BYTES = int(os.getenv('CONVERT_MAX_HTML_BYTES', 8 * 1024 * 1024))
+CONVERT_TIMEOUT = int(os.getenv('CONVERT_TIMEOUT', 30))
+# 新闻正文提取：python为进程池内的readability-lxml，node为node/index.js服务，auto优先python
+READABILITY_BACKEND = os.getenv('READABILITY_BACKEND', 'auto').lower()
+if READABILITY_BACKEND == 'auto':
+    READABILITY_BACKEND = 'python' if importlib.util.find_spec('readability') else 'node'
+NODE_READABILITY_URL = os.getenv('NODE_READABILITY_URL', 'http://localhost:3000/html_reader')
+# 流式响应每次刷新的字节数
+STREAM_CHUNK_BYTES = 16 * 1024
+
+# 转换结果缓存，重启后仍然有效
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+CONVERT_CACHE_PATH = os.path.join(CACHE_DIR, "convert.db")
+CONVERT_CACHE_TTL = int(os.getenv('CONVERT_CACHE_TTL', 24 * 3600))
+CONVERT_CACHE_MAX_ENTRIES = int(os.getenv('CONVERT_CACHE_MAX_ENTRIES', 1000))
+
+
+# 各阶段耗时(秒)和页面大小(字节)的直方图分桶
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(8))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Histogram:
+    """Prometheus直方图，按标签分组累计各分桶计数、总和与次数"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.series[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.series = collections.Counter()
+
+    def inc(self, amount=1, **labels):
+        self.series[tuple(sorted(labels.items()))] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Metrics:
+    """/metrics导出的指标：各阶段耗时、超时和错误计数、页面大小，以及渲染时读取的当前状态"""
+
+    def __init__(self):
+        self.stage_seconds = Histogram(
+            "convert_stage_seconds",
+            "Time spent in each conversion stage (queue, browser, readability_node, convert, convert_readability)",
+            LATENCY_BUCKETS,
+        )
+        self.request_seconds = Histogram(
+            "convert_request_seconds", "End-to-end request latency by endpoint", LATENCY_BUCKETS
+        )
+        self.page_bytes = Histogram(
+            "convert_page_bytes", "Size of HTML received from browsers and markdown produced", SIZE_BUCKETS
+        )
+        self.timeouts = Counter("convert_timeouts_total", "Timeouts by stage")
+        self.errors = Counter("convert_errors_total", "Failed conversions by error type")
+        self.requests = Counter("convert_requests_total", "Handled requests by endpoint and HTTP status")
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+    def render(self):
+        lines = []
+        for metric in (
+            self.stage_seconds,
+            self.request_seconds,
+            self.page_bytes,
+            self.timeouts,
+            self.errors,
+            self.requests,
+        ):
+            lines.extend(metric.render())
+
+        def gauge(name, help_text, value):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"])
+
+        browsers = scheduler.summary()
+        gauge("convert_browsers_connected", "Connected browser clients", browsers["clients"])
+        gauge("convert_browser_capacity", "Sum of in-flight limits of connected browsers", sum(browsers["capacity"].values()))
+        gauge("convert_browser_inflight", "Extractions currently running in browsers", sum(browsers["inflight"].values()))
+        gauge("convert_queue_waiting", "Extractions waiting for a free browser", browsers["waiting"])
+        if conversion_pool is not None:
+            gauge("convert_pool_pending", "Conversions submitted to the worker pool and not finished", conversion_pool.pending)
+        if convert_cache is not None:
+            cache = convert_cache.summary()
+            gauge("convert_cache_entries", "Pages in the markdown cache", cache["entries"])
+            gauge("convert_cache_bytes", "Markdown bytes in the cache", cache["bytes"])
+            gauge("convert_inflight_extractions", "Distinct (url, is_news) extractions in progress", cache["inflight"])
+            lines.append("# HELP convert_cache_lookups_total Cache lookups by result")
+            lines.append("# TYPE convert_cache_lookups_total counter")
+            for result in ("hit", "miss", "shared"):
+                lines.append(f'convert_cache_lookups_total{{result="{result}"}} {cache[result]}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class ConvertCache:
+    """URL到Markdown的磁盘缓存，按TTL过期，超过条目上限时淘汰最久未访问的记录"""
+
+    def __init__(self, path, ttl, max_entries):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hit": 0, "miss": 0, "shared": 0, "expired": 0, "evicted": 0}
+        # tornado单线程处理请求，连接只在IOLoop线程中使用
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT NOT NULL,
+                is_news INTEGER NOT NULL,
+                markdown TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (url, is_news)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_accessed ON pages(accessed)")
+
+    def get(self, url, news):
+        row = self.conn.execute(
+            "SELECT markdown, created FROM pages WHERE url = ? AND is_news = ?",
+            (url, int(news))
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > self.ttl:
+            self.conn.execute("DELETE FROM pages WHERE url = ? AND is_news = ?", (url, int(news)))
+            self.stats["expired"] += 1
+            return None
+        self.conn.execute(
+            "UPDATE pages SET accessed = ? WHERE url = ? AND is_news = ?",
+            (now, url, int(news))
+        )
+        return row[0]
+
+    def put(self, url, news, markdown):
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+            (url, int(news), markdown, now, now)
+        )
+        self.conn.execute("DELETE FROM pages WHERE created < ?", (now - self.ttl,))
+        evicted = self.conn.execute("""
+            DELETE FROM pages WHERE rowid IN (
+                SELECT rowid FROM pages ORDER BY accessed DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,)).rowcount
+        self.stats["evicted"] += max(evicted, 0)
+
+    def summary(self):
+        entries, size = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(markdown)), 0) FROM pages"
+        ).fetchone()
+        lookups = self.stats["hit"] + self.stats["miss"] + self.stats["shared"]
+        return {
+            **self.stats,
+            "entries": entries,
+            "bytes": size,
+            "inflight": len(inflight_conversions),
+            "hit_rate": round((self.stats["hit"] + self.stats["shared"]) / lookups, 3) if lookups else 0.0,
+            "ttl": self.ttl,
+            "max_entries": self.max_entries,
+        }
+
+
+convert_cache = None
+# (url, is_news) -> 正在进行的提取任务，相同请求共享同一个结果
+inflight_conversions = {}
+
+
+class NoBrowserError(Exception):
+    """没有可用的浏览器客户端"""
+
+
+class QueueFullError(Exception):
+    """所有浏览器都在忙且等待队列已满"""
+
+
+class BrowserDisconnectedError(Exception):
+    """处理请求的浏览器断开，且已没有重试机会"""
+
+
+class ExtractError(Exception):
+    """浏览器报告页面加载或提取失败"""
+
+
+class ExtractJob:
+    def __init__(self, url):
+        self.request_id = str(uuid.uuid4())
+        self.url = url
+        self.future = gen.Future()
+        self.client_id = None
+        self.attempts = 0
+        # 进入等待队列和派发给浏览器的时刻，分别用于统计queue和browser阶段耗时
+        self.enqueued = time.perf_counter()
+        self.dispatched = None
+
+
+class BrowserScheduler:
+    """在所有已连接的浏览器间分派提取请求，每个浏览器有在途上限，超出的请求排队等待"""
+
+    def __init__(self, max_inflight, queue_size):
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.clients = {}
+        # client_id -> 浏览器声明的并发能力
+        self.capacity = {}
+        # client_id -> {request_id: job}
+        self.inflight = {}
+        self.waiting = collections.deque()
+
+    def add_client(self, client):
+        self.clients[client.client_id] = client
+        self.inflight[client.client_id] = {}
+        self.pump()
+
+    def set_capacity(self, client_id, capacity):
+        if client_id in self.clients:
+            self.capacity[client_id] = max(1, int(capacity))
+            self.pump()
+
+    def remove_client(self, client_id):
+        self.clients.pop(client_id, None)
+        self.capacity.pop(client_id, None)
+        orphaned = self.inflight.pop(client_id, {})
+        # 断开浏览器上的请求立即重新派发，不再等待超时
+        for job in orphaned.values():
+            job.client_id = None
+            if job.future.done():
+                # 已超时、只等浏览器回复取消的请求
+                continue
+            if job.attempts >= BROWSER_MAX_ATTEMPTS:
+                self._fail(job, BrowserDisconnectedError(job.url))
+            else:
+                logger.debug(f"🔁 浏览器断开，重新派发请求 {job.request_id}")
+                job.enqueued = time.perf_counter()
+                self.waiting.appendleft(job)
+        if not self.clients:
+            while self.waiting:
+                self._fail(self.waiting.popleft(), NoBrowserError())
+        self.pump()
+
+    def _fail(self, job, error):
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def _pick_client(self):
+        """选择在途请求最少且未达上限的浏览器"""
+        candidates = [
+            client_id for client_id, jobs in self.inflight.items()
+            if len(jobs) < self.capacity.get(client_id, self.max_inflight)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda client_id: len(self.inflight[client_id]))
+
+    def pump(self):
+        while self.waiting:
+            client_id = self._pick_client()
+            if client_id is None:
+                return
+            job = self.waiting.popleft()
+            if job.future.done():
+                continue
+            job.client_id = client_id
+            job.attempts += 1
+            job.dispatched = time.perf_counter()
+            metrics.stage_seconds.observe(job.dispatched - job.enqueued, stage="queue")
+            self.inflight[client_id][job.request_id] = job
+            logger.debug(f"📤 发送提取请求到浏览器 {client_id}，请求ID: {job.request_id}")
+            try:
+                self.clients[client_id].write_message(json.dumps({
+                    "type": "extract",
+                    "url": job.url,
+                    "requestId": job.request_id
+                }))
+            except websocket.WebSocketClosedError:
+                # on_close稍后会重新派发这个浏览器上的请求
+                logger.warning(f"⚠️ 浏览器 {client_id} 连接已关闭")
+
+    def _finish(self, client_id, request_id):
+        """浏览器返回结果或错误时取出在途请求，记录从派发到返回的browser阶段耗时"""
+        job = self.inflight.get(client_id, {}).pop(request_id, None)
+        if job is not None and not job.future.done():
+            metrics.stage_seconds.observe(time.perf_counter() - job.dispatched, stage="browser")
+        return job
+
+    def resolve(self, client_id, request_id, content):
+        job = self._finish(client_id, request_id)
+        if job is None:
+            return
+        if not job.future.done():
+            job.future.set_result(content)
+        self.pump()
+
+    def reject(self, client_id, request_id, error):
+        job = self._finish(client_id, request_id)
+        if job is None:
+            return
+        self._fail(job, ExtractError(error))
+        self.pump()
+
+    def _discard(self, job):
+        """超时或完成后从队列中移除；浏览器仍在处理的请求通知其取消，名额保留到浏览器回复"""
+        if job.client_id is None:
+            try:
+                self.waiting.remove(job)
+            except ValueError:
+                pass
+        elif job.request_id in self.inflight.get(job.client_id, {}):
+            self._cancel(job)
+            return
+        self.pump()
+
+    def _cancel(self, job):
+        """浏览器的标签页还在加载页面，立即释放名额会让它超出声明的并发能力"""
+        logger.debug(f"🛑 通知浏览器 {job.client_id} 取消请求 {job.request_id}")
+        # 标记为已结束，迟到的回复和浏览器断开时都不再处理它
+        job.future.cancel()
+        try:
+            self.clients[job.client_id].write_message(json.dumps({
+                "type": "cancel",
+                "requestId": job.request_id
+            }))
+        except websocket.WebSocketClosedError:
+            pass
+        ioloop.IOLoop.current().call_later(BROWSER_CANCEL_GRACE, self._expire, job)
+
+    def _expire(self, job):
+        """浏览器迟迟不回复取消时强制释放名额"""
+        jobs = self.inflight.get(job.client_id, {})
+        if jobs.get(job.request_id) is job:
+            logger.warning(f"⚠️ 浏览器 {job.client_id} 未回复取消，释放请求 {job.request_id} 的名额")
+            del jobs[job.request_id]
+            self.pump()
+
+    async def fetch_html(self, url):
+        if not self.clients:
+            raise NoBrowserError()
+        if len(self.waiting) >= self.queue_size:
+            raise QueueFullError()
+        job = ExtractJob(url)
+        self.waiting.append(job)
+        self.pump()
+        try:
+            return await gen.with_timeout(
+                ioloop.IOLoop.current().time() + BROWSER_TIMEOUT,
+                job.future
+            )
+        except gen.TimeoutError:
+            logger.error(f"⏰ 请求超时，请求ID: {job.request_id}")
+            metrics.timeouts.inc(stage="browser")
+            raise
+        finally:
+            self._discard(job)
+
+    def summary(self):
+        return {
+            "clients": len(self.clients),
+            "inflight": {client_id: len(jobs) for client_id, jobs in self.inflight.items()},
+            "capacity": {
+                client_id: self.capacity.get(client_id, self.max_inflight)
+                for client_id in self.clients
+            },
+            "waiting": len(self.waiting),
+            "max_inflight": self.max_inflight,
+            "queue_size": self.queue_size,
+        }
+
+
+scheduler = BrowserScheduler(BROWSER_MAX_INFLIGHT, CONVERT_QUEUE_SIZE)
 
 class BrowserWebSocketHandler(websocket.WebSocketHandler):
     def check_origin(self, origin):
@@ -31,7 +466,7 @@ class BrowserWebSocketHandler(websocket.WebSocketHandler):
 
     def open(self):
         self.client_id = str(uuid.uuid4())
-        connected_clients[self.client_id] = self
+        scheduler.add_client(self)
         logger.debug(f"🎮 浏览器客户端连接成功，ID: {self.client_id}")
 
     async def on_message(self, message):
@@ -40,101 +475,459 @@ class BrowserWebSocketHandler(websocket.WebSocketHandler):
             data = json.loads(message)
             if data.get('type') == 'htmlResponse':
                 request_id = data.get('requestId')
-                if request_id in pending_requests:
-                    pending_requests[request_id].set_result(data['content'])
-                    logger.debug(f"✅ 请求 {request_id} 已设置结果")
+                scheduler.resolve(self.client_id, request_id, data['content'])
+                logger.debug(f"✅ 请求 {request_id} 已设置结果")
+            elif data.get('type') == 'htmlError':
+                logger.error(f"🚨 浏览器提取失败，请求ID: {data.get('requestId')}，原因: {data.get('error')}")
+                scheduler.reject(self.client_id, data.get('requestId'), data.get('error', 'unknown error'))
+            elif data.get('type') == 'hello':
+                logger.debug(f"👋 浏览器 {self.client_id} 声明并发能力: {data.get('capacity')}")
+                scheduler.set_capacity(self.client_id, data.get('capacity', BROWSER_MAX_INFLIGHT))
         except Exception as e:
             logger.error(f"处理消息出错: {str(e)}")
 
     def on_close(self):
-        del connected_clients[self.client_id]
+        scheduler.remove_client(self.client_id)
         logger.debug(f"❌ 浏览器客户端断开，ID: {self.client_id}")
 
 
 
 
-class ConvertHandler(web.RequestHandler):
-    async def get(self):
+class HtmlTooLargeError(Exception):
+    """HTML超过转换大小上限"""
+
+
+class ConvertTimeoutError(Exception):
+    """转换超过单个任务的时间上限"""
+
+
+class ReadabilityError(Exception):
+    """进程内正文提取失败，需要改用node服务"""
+
+
+# 每个工作进程复用一个MarkItDown实例
+_markitdown = None
+
+
+def _init_converter():
+    global _markitdown
+    _markitdown = MarkItDown()
+
+
+def extract_article(html):
+    """用readability-lxml提取正文，去掉导航、广告等模板内容"""
+    from readability import Document
+
+    return Document(html).summary(html_partial=True)
+
+
+def _convert_html(data, readable=False):
+    """在工作进程中把内存中的HTML转换为Markdown
+
+    readable为True时先提取正文，失败返回(None, 错误信息)，由调用方改用node服务。
+    """
+    if readable:
         try:
-            url = self.get_query_argument('url')
-            news = self.get_query_argument("is_news", "false").lower() == "true"
-            logger.debug(f"🌐 收到转换请求，URL: {url}")
+            data = extract_article(data.decode('utf-8')).encode('utf-8')
+        except Exception as e:
+            return None, f"{type(e).__name__}: {e}"
+    result = _markitdown.convert_stream(io.BytesIO(data), file_extension=".html")
+    return result.text_content, None
+
+
+class ConversionPool:
+    """MarkItDown进程池，限制输入大小和单个任务的耗时，并统计排队深度
+
+    超时的任务如果已在运行，future.cancel()无法停止它，会一直占着工作进程；
+    此时终止整个进程池换一个新的，被连带中断的其他任务在新池上重新提交。
+    """
 
-            if not connected_clients:
-                self.set_status(503)
-                return self.write({"error": "No browser connected"})
+    # 在工作进程中执行的转换函数
+    task = staticmethod(_convert_html)
 
-            client = next(iter(connected_clients.values()))
-            request_id = str(uuid.uuid4())
-            fut = gen.Future()
-            pending_requests[request_id] = fut
+    def __init__(self, workers, max_bytes, timeout):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.executor = self._new_executor()
+        # 已提交但尚未完成的任务数，超过workers的部分在排队
+        self.pending = 0
+        self.stats = {
+            "completed": 0,
+            "failed": 0,
+            "timed_out": 0,
+            "too_large": 0,
+            "workers_replaced": 0,
+            "resubmitted": 0,
+            "readability_python": 0,
+            "readability_fallback": 0,
+        }
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_converter,
+        )
+
+    def _replace_executor(self, executor):
+        """终止进程池的全部工作进程并换上新池，executor已被替换过时什么都不做"""
+        if executor is not self.executor:
+            return
+        self.executor = self._new_executor()
+        self.stats["workers_replaced"] += 1
+        logger.warning("♻️ 转换进程卡住，重建进程池")
+        if hasattr(executor, "terminate_workers"):
+            executor.terminate_workers()
+        else:
+            # Python 3.14之前没有公开接口，直接终止工作进程，
+            # 池内剩余任务随后以BrokenProcessPool结束
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+            executor.shutdown(wait=False)
+
+    async def convert(self, html, readable=False):
+        data = html.encode('utf-8')
+        if len(data) > self.max_bytes:
+            self.stats["too_large"] += 1
+            raise HtmlTooLargeError(f"{len(data)} > {self.max_bytes} bytes")
+        self.pending += 1
+        try:
+            with metrics.time("convert_readability" if readable else "convert"):
+                text, error = await self._run(data, readable)
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self.pending -= 1
+        if text is None:
+            self.stats["readability_fallback"] += 1
+            raise ReadabilityError(error)
+        if readable:
+            self.stats["readability_python"] += 1
+        self.stats["completed"] += 1
+        return text
 
+    async def _run(self, data, readable):
+        """提交到进程池并等待结果，进程池因其他任务超时被替换时重新提交一次"""
+        for attempt in range(2):
+            executor = self.executor
             try:
-                logger.debug(f"📤 发送提取请求到浏览器，请求ID: {request_id}")
-                await client.write_message(json.dumps({
-                    "type": "extract",
-                    "url": url,
-                    "requestId": request_id
-                }))
+                future = executor.submit(self.task, data, readable)
+                return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except asyncio.TimeoutError:
+                self.stats["timed_out"] += 1
+                metrics.timeouts.inc(stage="convert")
+                # 还在排队的任务直接取消；已在运行的任务只能终止工作进程
+                if not future.cancel():
+                    self._replace_executor(executor)
+                raise ConvertTimeoutError(f"conversion exceeded {self.timeout}s")
+            except BrokenProcessPool:
+                if executor is self.executor:
+                    # 工作进程自己崩溃，换新池后本任务按失败处理
+                    self._replace_executor(executor)
+                    raise
+                if attempt:
+                    raise
+                self.stats["resubmitted"] += 1
 
-                html = await gen.with_timeout(
-                    ioloop.IOLoop.current().time() + 60,
-                    fut
-                )
-                logger.debug(f"📥 收到HTML响应，长度: {len(html)} 字符")
-                if news:
-                    # ========== 新增净化处理 ==========
-                    logger.debug("🛠 正在使用Readability净化内容...")
-                    try:
-                        http_client = AsyncHTTPClient()
-                        response = await http_client.fetch(
-                            'http://localhost:3000/html_reader',
-                            method='POST',
-                            headers={'Content-Type': 'application/json'},
-                            body=json.dumps({'content': html}),
-                            connect_timeout=10,
-                            request_timeout=30
-                        )
-                        if response.code == 200:
-                            result = json.loads(response.body)
-                            if 'content' in result:
-                                html = result['content']
-                                logger.debug(f"✅ 净化完成，新长度: {len(html)} 字符")
-                            else:
-                                logger.warning("⚠️ 净化服务未返回有效内容，使用原始HTML")
-                        else:
-                            logger.error(f"⚠️ 净化服务返回错误状态码: {response.code}")
-                    except Exception as e:
-                        logger.error(f"🚨 净化服务调用失败: {str(e)}，继续使用原始HTML")
-                # 转换HTML为Markdown
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.html',
-delete=True) as f:
-                    f.write(html)
-                    f.flush()
-                    logger.debug(f"🔄 开始转换，临时文件: {f.name}")
-                    md = MarkItDown()
-                    result = md.convert(f.name)
-                    logger.debug(f"✅ 转换完成，Markdown长度: {len(result.text_content)} 字符")
-
-                self.write(result.text_content)
-            except gen.TimeoutError:
-                logger.error(f"⏰ 请求超时，请求ID: {request_id}")
-                self.set_status(504)
-                self.write({"error": "Request timeout"})
-            finally:
-                pending_requests.pop(request_id, None)
+    def summary(self):
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "pending": self.pending,
+            "queued": max(0, self.pending - self.workers),
+            "max_html_bytes": self.max_bytes,
+            "timeout": self.timeout,
+            "readability_backend": READABILITY_BACKEND,
+        }
+
+
+conversion_pool = None
+
+
+async def clean_with_readability(html):
+    """调用node readability服务提取正文，失败时返回原始HTML"""
+    logger.debug("🛠 正在使用Readability服务净化内容...")
+    try:
+        http_client = AsyncHTTPClient()
+        with metrics.time("readability_node"):
+            response = await http_client.fetch(
+                NODE_READABILITY_URL,
+                method='POST',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({'content': html}),
+                connect_timeout=10,
+                request_timeout=30
+            )
+        if response.code == 200:
+            result = json.loads(response.body)
+            if 'content' in result:
+                logger.debug(f"✅ 净化完成，新长度: {len(result['content'])} 字符")
+                return result['content']
+            logger.warning("⚠️ 净化服务未返回有效内容，使用原始HTML")
+        else:
+            logger.error(f"⚠️ 净化服务返回错误状态码: {response.code}")
+    except Exception as e:
+        logger.error(f"🚨 净化服务调用失败: {str(e)}，继续使用原始HTML")
+    return html
+
+
+async def extract_markdown(url, news):
+    """让浏览器打开页面取回HTML，按需净化后转换为Markdown"""
+    html = await scheduler.fetch_html(url)
+    logger.debug(f"📥 收到HTML响应，长度: {len(html)} 字符")
+    metrics.page_bytes.observe(len(html.encode('utf-8')), kind="html")
+    if news and READABILITY_BACKEND == 'python':
+        # 正文提取和转换在同一个工作进程中完成，HTML只传一次
+        try:
+            markdown = await conversion_pool.convert(html, readable=True)
+            logger.debug(f"✅ 转换完成，Markdown长度: {len(markdown)} 字符")
+            metrics.page_bytes.observe(len(markdown.encode('utf-8')), kind="markdown")
+            return markdown
+        except ReadabilityError as e:
+            logger.warning(f"⚠️ 进程内正文提取失败: {e}，改用node服务")
+    if news:
+        html = await clean_with_readability(html)
+    markdown = await conversion_pool.convert(html)
+    logger.debug(f"✅ 转换完成，Markdown长度: {len(markdown)} 字符")
+    metrics.page_bytes.observe(len(markdown.encode('utf-8')), kind="markdown")
+    return markdown
+
+
+async def convert_cached(url, news, refresh=False):
+    """先查缓存，再复用进行中的提取，最后才发起新的提取；返回(markdown, 缓存状态)"""
+    key = (url, news)
+    if not refresh:
+        markdown = convert_cache.get(url, news)
+        if markdown is not None:
+            convert_cache.stats["hit"] += 1
+            return markdown, "HIT"
+
+    task = inflight_conversions.get(key)
+    if task is not None:
+        convert_cache.stats["shared"] += 1
+        # shield避免一个请求被取消时连带取消其他请求共享的提取
+        return await asyncio.shield(task), "SHARED"
+
+    convert_cache.stats["miss"] += 1
+    task = asyncio.ensure_future(extract_markdown(url, news))
+    inflight_conversions[key] = task
+
+    def on_done(done):
+        inflight_conversions.pop(key, None)
+        if not done.cancelled() and done.exception() is None:
+            convert_cache.put(url, news, done.result())
+
+    task.add_done_callback(on_done)
+    return await asyncio.shield(task), "MISS"
+
+
+_CJK_PATTERN = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\u3000-\u303f\uff00-\uffef]"
+)
+
+
+def estimate_tokens(text):
+    """粗略估算token数：中日韩字符约每字1个token，其它字符约每4个字符1个token（与llm_query.py一致）"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _cut_line(line, max_bytes=None, max_tokens=None):
+    """在单行内部硬截断：按字节时落在字符边界上，按token时二分查找最长的前缀"""
+    if max_bytes:
+        line = line.encode('utf-8')[:max_bytes].decode('utf-8', errors='ignore')
+    if max_tokens and estimate_tokens(line) > max_tokens:
+        low, high = 0, len(line)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate_tokens(line[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        line = line[:low]
+    return line
+
+
+def truncate_markdown(text, max_bytes=None, max_tokens=None):
+    """按字节数或估算的token数在行尾截断，返回(文本, 是否截断)
+
+    第一行就超出预算时在行内截断，保证总能返回部分内容。
+    """
+    if not max_bytes and not max_tokens:
+        return text, False
+    used_bytes = used_tokens = 0
+    kept = []
+    for line in text.splitlines(keepends=True):
+        line_bytes = len(line.encode('utf-8'))
+        line_tokens = estimate_tokens(line)
+        if (max_bytes and used_bytes + line_bytes > max_bytes) or (
+            max_tokens and used_tokens + line_tokens > max_tokens
+        ):
+            if not kept:
+                kept.append(_cut_line(line, max_bytes, max_tokens))
+            break
+        kept.append(line)
+        used_bytes += line_bytes
+        used_tokens += line_tokens
+    else:
+        return text, False
+    kept.append(f"\n\n[内容已截断，原文约{estimate_tokens(text)} tokens]\n")
+    return "".join(kept), True
+
+
+class MeteredHandler(web.RequestHandler):
+    """请求结束时记录端点的耗时和状态码"""
+
+    def on_finish(self):
+        endpoint = self.request.path
+        metrics.request_seconds.observe(self.request.request_time(), endpoint=endpoint)
+        metrics.requests.inc(endpoint=endpoint, status=self.get_status())
+
+
+class ConvertHandler(MeteredHandler):
+    async def get(self):
+        try:
+            url = self.get_query_argument('url')
+            news = self.get_query_argument("is_news", "false").lower() == "true"
+            refresh = self.get_query_argument("refresh", "false").lower() == "true"
+            stream = self.get_query_argument("stream", "false").lower() == "true"
+            try:
+                max_bytes = int(self.get_query_argument("max_bytes", "0"))
+                max_tokens = int(self.get_query_argument("max_tokens", "0"))
+            except ValueError:
+                self.set_status(400)
+                return self.write({"error": "max_bytes and max_tokens must be integers"})
+            logger.debug(f"🌐 收到转换请求，URL: {url}")
+
+            markdown, cache_status = await convert_cached(url, news, refresh)
+            logger.debug(f"📦 缓存状态: {cache_status}，URL: {url}")
+            # 缓存保存完整内容，截断只作用于本次响应
+            markdown, truncated = truncate_markdown(markdown, max_bytes, max_tokens)
+            self.set_header("X-Cache", cache_status)
+            self.set_header("X-Truncated", str(truncated).lower())
+            if not stream:
+                self.write(markdown)
+                return
+            data = markdown.encode('utf-8')
+            for offset in range(0, len(data), STREAM_CHUNK_BYTES):
+                self.write(data[offset:offset + STREAM_CHUNK_BYTES])
+                await self.flush()
 
         except web.MissingArgumentError:
             self.set_status(400)
             self.write({"error": "Missing url parameter"})
+        except iostream.StreamClosedError:
+            logger.debug("🔌 客户端已读够内容并关闭连接")
         except Exception as e:
-            logger.error(f"处理请求出错: {str(e)}")
-            self.set_status(500)
-            self.write({"error": "Internal server error"})
+            status, message = describe_error(e)
+            self.set_status(status)
+            if isinstance(e, QueueFullError):
+                self.set_header("Retry-After", str(CONVERT_RETRY_AFTER))
+            self.write({"error": message})
+
+
+class BatchConvertHandler(MeteredHandler):
+    """POST一组URL，按完成顺序以NDJSON逐行返回结果
+
+    请求体: {"items": [{"url": ..., "is_news": false, "refresh": false}, ...],
+             "max_tokens": 0, "max_bytes": 0}，单个item可以覆盖max_tokens/max_bytes
+    每行: {"index": 序号, "url": ..., "status": 200, "cache": "HIT", "truncated": false, "markdown": ...}
+    出错时status为对应的HTTP状态码，并带error字段
+    """
+
+    async def post(self):
+        try:
+            body = json.loads(self.request.body)
+            items = [{"url": item} if isinstance(item, str) else item for item in body["items"]]
+            max_tokens = int(body.get("max_tokens", 0))
+            max_bytes = int(body.get("max_bytes", 0))
+            for item in items:
+                if not isinstance(item, dict) or not item.get("url"):
+                    raise ValueError("every item needs a url")
+                item["max_tokens"] = int(item.get("max_tokens", max_tokens))
+                item["max_bytes"] = int(item.get("max_bytes", max_bytes))
+        except (ValueError, KeyError, TypeError) as e:
+            self.set_status(400)
+            return self.write({"error": f"Invalid batch request: {e}"})
+        if len(items) > CONVERT_BATCH_MAX:
+            self.set_status(413)
+            return self.write({"error": f"At most {CONVERT_BATCH_MAX} urls per batch"})
+        logger.debug(f"🌐 收到批量转换请求，共 {len(items)} 个URL")
+
+        async def convert_item(index, item):
+            result = {"index": index, "url": item["url"]}
+            try:
+                markdown, cache_status = await convert_cached(
+                    item["url"], bool(item.get("is_news", False)), bool(item.get("refresh", False))
+                )
+                markdown, truncated = truncate_markdown(markdown, item["max_bytes"], item["max_tokens"])
+                result.update(status=200, cache=cache_status, truncated=truncated, markdown=markdown)
+            except Exception as e:
+                status, message = describe_error(e)
+                result.update(status=status, error=message)
+            return result
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        try:
+            # 所有URL同时交给调度器，哪个先完成先返回哪个
+            for finished in asyncio.as_completed(
+                [convert_item(index, item) for index, item in enumerate(items)]
+            ):
+                self.write(json.dumps(await finished, ensure_ascii=False) + "\n")
+                await self.flush()
+        except iostream.StreamClosedError:
+            logger.debug("🔌 批量请求的客户端已断开")
+
+
+def describe_error(e):
+    """把转换过程中的异常映射为(HTTP状态码, 错误信息)，并按异常类型计数"""
+    metrics.errors.inc(type=type(e).__name__)
+    if isinstance(e, NoBrowserError):
+        return 503, "No browser connected"
+    if isinstance(e, QueueFullError):
+        return 503, "All browsers busy, retry later"
+    if isinstance(e, BrowserDisconnectedError):
+        return 502, "Browser disconnected"
+    if isinstance(e, ExtractError):
+        return 502, f"Extraction failed: {e}"
+    if isinstance(e, HtmlTooLargeError):
+        return 413, f"Page too large: {e}"
+    if isinstance(e, ConvertTimeoutError):
+        return 504, f"Conversion timeout: {e}"
+    if isinstance(e, gen.TimeoutError):
+        return 504, "Request timeout"
+    logger.error(f"处理请求出错: {str(e)}")
+    return 500, "Internal server error"
+
+
+class MetricsHandler(web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+class StatsHandler(web.RequestHandler):
+    def get(self):
+        self.write({
+            "cache": convert_cache.summary(),
+            "browsers": scheduler.summary(),
+            "conversion": conversion_pool.summary(),
+        })
+
 
 def make_app():
+    global convert_cache, conversion_pool
+    if convert_cache is None:
+        convert_cache = ConvertCache(CONVERT_CACHE_PATH, CONVERT_CACHE_TTL, CONVERT_CACHE_MAX_ENTRIES)
+    if conversion_pool is None:
+        conversion_pool = ConversionPool(CONVERT_WORKERS, CONVERT_MAX_HTML_BYTES, CONVERT_TIMEOUT)
     return web.Application([
         (r"/convert", ConvertHandler),
+        (r"/convert/batch", BatchConvertHandler),
+        (r"/stats", StatsHandler),
+        (r"/metrics", MetricsHandler),
         (r"/ws", BrowserWebSocketHandler),
     ])
 
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT, ROOT / "server"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+import llm_query
+
+
+@pytest.fixture
+def conversation_dir(tmp_path, monkeypatch):
+    """把对话目录和目录数据库指向临时目录"""
+    directory = tmp_path / ".conversation"
+    directory.mkdir()
+    monkeypatch.setattr(llm_query, "CONVERSATION_DIR", directory)
+    monkeypatch.setattr(llm_query, "CATALOG_PATH", directory / "catalog.db")
+    return directory
+
+
+@pytest.fixture
+def response_cache_dir(tmp_path, monkeypatch):
+    """把响应缓存指向临时目录"""
+    directory = tmp_path / "responses"
+    monkeypatch.setattr(llm_query, "RESPONSE_CACHE_DIR", directory)
+    return directory
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """带.git的临时工作区，工作区缓存写到临时目录"""
+    root = tmp_path / "workspace"
+    (root / ".git").mkdir(parents=True)
+    monkeypatch.setattr(llm_query, "WORKSPACE_CACHE_DIR", tmp_path / "workspaces")
+    monkeypatch.chdir(root)
+    llm_query._git_root.cache_clear()
+    llm_query.get_workspace_cache.cache_clear()
+    yield root
+    llm_query._git_root.cache_clear()
+    llm_query.get_workspace_cache.cache_clear()
@@ -0,0 +1,12 @@
+"""在转换进程池的工作进程中运行的测试任务，不导入server以便快速启动"""
+import time
+
+
+def echo_or_hang(data, readable=False):
+    if data == b"hang":
+        time.sleep(60)
+    return data.decode("utf-8"), None
+
+
+def no_init():
+    pass
@@ -0,0 +1,158 @@
+import json
+import threading
+
+import pytest
+
+import llm_query
+
+
+def write_legacy(path, history):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(history, ensure_ascii=False), encoding="utf-8")
+
+
+HISTORY = [
+    {"role": "user", "content": "第一个问题"},
+    {"role": "assistant", "content": "第一个回答"},
+    {"role": "user", "content": "第二个问题"},
+    {"role": "assistant", "content": "第二个回答"},
+]
+
+
+def test_migrate_splits_turns(conversation_dir):
+    legacy = conversation_dir / "2024-01-01" / "10-00-00-abc.json"
+    write_legacy(legacy, HISTORY)
+
+    journal = llm_query.migrate_conversation(str(legacy))
+
+    assert journal.endswith(".jsonl")
+    assert not legacy.exists()
+    records, damaged = llm_query._read_journal(journal)
+    assert not damaged
+    assert [len(record["messages"]) for record in records] == [2, 2]
+    assert llm_query.load_conversation_history(journal) == HISTORY
+
+
+def test_append_and_compact_drops_damaged_record(conversation_dir):
+    journal = conversation_dir / "2024-01-01" / "10-00-00-abc.jsonl"
+    journal.parent.mkdir()
+    journal.touch()
+    llm_query.append_conversation_turn(str(journal), HISTORY[:2])
+    with open(journal, "a", encoding="utf-8") as f:
+        f.write('{"time": 1, "messa')
+    # 追加时先补换行，残缺记录不会吞掉新的一轮
+    llm_query.append_conversation_turn(str(journal), HISTORY[2:])
+
+    assert llm_query._read_journal(journal)[1]
+    assert llm_query.load_conversation_history(str(journal)) == HISTORY
+    records, damaged = llm_query._read_journal(journal)
+    assert not damaged
+    assert len(records) == 2
+
+
+def test_compact_all_keeps_journal_over_stale_legacy_file(conversation_dir):
+    legacy = conversation_dir / "2024-01-01" / "10-00-00-abc.json"
+    write_legacy(legacy, HISTORY[:2])
+    journal = llm_query.migrate_conversation(str(legacy))
+    llm_query.append_conversation_turn(journal, HISTORY[2:])
+    # 模拟迁移在删除旧文件之前中断
+    write_legacy(legacy, HISTORY[:2])
+
+    llm_query.compact_all_conversations()
+
+    assert not legacy.exists()
+    assert llm_query.load_conversation_history(journal) == HISTORY
+    assert llm_query.get_conversation("abc") == journal
+
+
+def catalog_rows(uuid):
+    with llm_query._open_catalog() as conn:
+        return conn.execute(
+            "SELECT path, created, turns, preview FROM conversations WHERE uuid = ?", (uuid,)
+        ).fetchone()
+
+
+def test_rebuild_catalog_created_is_stable_across_appends(conversation_dir):
+    journal = conversation_dir / "2024-01-01" / "10-00-00-abc.jsonl"
+    journal.parent.mkdir()
+    journal.touch()
+    llm_query.append_conversation_turn(str(journal), HISTORY[:2])
+
+    assert llm_query.rebuild_catalog() == {"abc": str(journal)}
+    path, created, turns, preview = catalog_rows("abc")
+    assert (path, turns, preview) == (str(journal), 1, "第一个问题")
+    assert created == llm_query._read_journal(journal)[0][0]["time"]
+
+    llm_query.append_conversation_turn(str(journal), HISTORY[2:])
+    llm_query.rebuild_catalog()
+    assert catalog_rows("abc")[1:3] == (created, 2)
+
+
+def test_rebuild_catalog_prefers_journal_over_legacy(conversation_dir):
+    day = conversation_dir / "2024-01-01"
+    write_legacy(day / "10-00-00-abc.json", HISTORY)
+    (day / "10-00-00-abc.jsonl").write_text("", encoding="utf-8")
+    write_legacy(day / "not-a-conversation.json", [])
+
+    assert llm_query.rebuild_catalog() == {"abc": str(day / "10-00-00-abc.jsonl")}
+
+
+def test_get_conversation_registers_file_missing_from_catalog(conversation_dir):
+    llm_query.rebuild_catalog()
+    # 旧版客户端在全量扫描之后写入的对话
+    legacy = conversation_dir / "2024-01-02" / "09-30-00-def.json"
+    write_legacy(legacy, HISTORY)
+
+    journal = llm_query.get_conversation("def")
+
+    assert journal == str(legacy.with_suffix(".jsonl"))
+    assert llm_query.load_conversation_history(journal) == HISTORY
+    assert catalog_rows("def")[0] == journal
+
+
+def test_get_conversation_unknown_uuid(conversation_dir):
+    llm_query.rebuild_catalog()
+    with pytest.raises(FileNotFoundError):
+        llm_query.get_conversation("missing")
+
+
+def test_concurrent_appends_and_compaction_lose_no_turns(conversation_dir):
+    journal = conversation_dir / "2024-01-01" / "10-00-00-abc.jsonl"
+    journal.parent.mkdir()
+    journal.touch()
+
+    def append(worker):
+        for n in range(20):
+            llm_query.append_conversation_turn(
+                str(journal), [{"role": "user", "content": f"{worker}-{n}"}]
+            )
+
+    def compact():
+        for _ in range(20):
+            llm_query.compact_conversation(str(journal))
+
+    threads = [threading.Thread(target=append, args=(worker,)) for worker in range(4)]
+    threads += [threading.Thread(target=compact) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    records, damaged = llm_query._read_journal(journal)
+    assert not damaged
+    assert len(records) == 80
+    assert not list(journal.parent.glob("*.tmp"))
+
+
+def test_compaction_uses_a_unique_temp_file(conversation_dir, monkeypatch):
+    journal = conversation_dir / "2024-01-01" / "10-00-00-abc.jsonl"
+    journal.parent.mkdir()
+    journal.write_text('{"time": 1, "messages": []}\n', encoding="utf-8")
+    # 其他进程遗留的固定名临时文件不会被当作自己的输出
+    stale = journal.parent / "10-00-00-abc.jsonl.tmp"
+    stale.write_text("garbage", encoding="utf-8")
+
+    llm_query.compact_conversation(str(journal))
+
+    assert stale.read_text(encoding="utf-8") == "garbage"
+    assert llm_query._read_journal(journal) == ([{"time": 1, "messages": []}], False)
@@ -0,0 +1,115 @@
+import pytest
+
+import llm_query
+
+
+@pytest.fixture
+def shadow(tmp_path, monkeypatch):
+    root = tmp_path / "shadow"
+    root.mkdir()
+    monkeypatch.setattr(llm_query, "shadowroot", root)
+    work = tmp_path / "work"
+    work.mkdir()
+    monkeypatch.chdir(work)
+    return root
+
+
+def stream(text, extractor=None, size=7):
+    """按固定大小切片模拟流式增量"""
+    extractor = extractor or llm_query.FileBlockExtractor()
+    for offset in range(0, len(text), size):
+        extractor.emit("content", text[offset : offset + size])
+    extractor.finish()
+    return extractor
+
+
+def test_blocks_are_saved_and_diffed_as_they_close(shadow):
+    with open("a.py", "w", encoding="utf-8") as f:
+        f.write("print(1)\n")
+    extractor = llm_query.FileBlockExtractor()
+    extractor.emit("content", "修改如下\n@a.py\nprint(2)\n@a.py\n")
+    # 第一个块关闭时diff已生成，不必等回答结束
+    assert extractor.saved == [shadow / "a.py"]
+    assert "-print(1)" in extractor.diffs[0] and "+print(2)" in extractor.diffs[0]
+
+    stream("@b.py\nnew file\n@b.py", extractor)
+    assert extractor.saved == [shadow / "a.py", shadow / "b.py"]
+    assert (shadow / "b.py").read_text(encoding="utf-8") == "new file"
+    assert len(extractor.diffs) == 1
+
+
+def test_reasoning_is_ignored(shadow):
+    extractor = llm_query.FileBlockExtractor()
+    extractor.emit("reasoning", "@x.py\nthinking\n@x.py\n")
+    extractor.finish()
+    assert extractor.saved == []
+
+
+def test_marker_lines_inside_a_block_are_content(shadow):
+    text = "@main.py\n@decorator\ndef f():\n    pass\n@nested.txt\n@main.py\n"
+    stream(text)
+    assert (shadow / "main.py").read_text(encoding="utf-8") == (
+        "@decorator\ndef f():\n    pass\n@nested.txt"
+    )
+
+
+def test_wrapping_code_fence_is_stripped(shadow):
+    stream("@c.py\n```python\nx = 1\n```\n@c.py\n")
+    assert (shadow / "c.py").read_text(encoding="utf-8") == "x = 1"
+
+
+def test_unclosed_marker_is_rescanned(shadow):
+    extractor = stream("@stray\ntext\n@d.py\ny = 2\n@d.py\n")
+    assert extractor.saved == [shadow / "d.py"]
+    assert not (shadow / "stray").exists()
+
+
+def test_bad_targets_are_reported_without_stopping(shadow):
+    with open("latin1.txt", "wb") as f:
+        f.write(b"caf\xe9\n")
+    (shadow.parent / "work" / "sub").mkdir()
+
+    extractor = stream("@latin1.txt\ncafe\n@latin1.txt\n@sub\nx\n@sub\n@ok.py\nok\n@ok.py\n")
+
+    assert [error.split(":")[0] for error in extractor.errors] == ["latin1.txt", "sub"]
+    assert shadow / "ok.py" in extractor.saved
+    assert (shadow / "ok.py").read_text(encoding="utf-8") == "ok"
+
+
+def test_combine_keeps_results_without_rewriting(shadow):
+    first = stream("@e.py\none\n@e.py\n")
+    second = stream("@f.py\ntwo\n@f.py\n")
+    (shadow / "e.py").unlink()
+
+    combined = llm_query.FileBlockExtractor.combine([first, second])
+
+    assert combined.saved == [shadow / "e.py", shadow / "f.py"]
+    assert not (shadow / "e.py").exists()
+
+
+def test_extract_and_diff_files_reports_errors(shadow, capsys):
+    (shadow.parent / "work" / "sub").mkdir()
+    llm_query.extract_and_diff_files("@sub\nx\n@sub\n@g.py\ng\n@g.py\n")
+
+    output = capsys.readouterr().out
+    assert "处理文件块失败，已跳过: sub:" in output
+    assert f"已保存文件到: {shadow / 'g.py'}" in output
+    assert (shadow / "response.md").exists()
+
+
+def test_extract_and_diff_files_does_not_prompt(shadow, monkeypatch):
+    with open("h.py", "w", encoding="utf-8") as f:
+        f.write("old\n")
+
+    def no_input(prompt=""):
+        raise AssertionError("extract_and_diff_files must not wait for input")
+
+    monkeypatch.setattr("builtins.input", no_input)
+    diff_file = llm_query.extract_and_diff_files("@h.py\nnew\n@h.py\n")
+
+    assert diff_file == shadow / "changes.diff"
+    assert "+new" in diff_file.read_text(encoding="utf-8")
+
+    monkeypatch.setattr("builtins.input", lambda prompt="": "n")
+    llm_query.confirm_and_apply_diff(diff_file)
+    assert open("h.py", encoding="utf-8").read() == "old\n"
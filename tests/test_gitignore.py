@@ -0,0 +1,82 @@
+import pytest
+
+import llm_query
+
+
+def matcher(tmp_path, rules, rel_dir=""):
+    directory = tmp_path / rel_dir if rel_dir else tmp_path
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / ".gitignore").write_text(rules, encoding="utf-8")
+    return llm_query.GitIgnore().extend(str(directory), rel_dir)
+
+
+@pytest.mark.parametrize(
+    "rules, path, is_dir, expected",
+    [
+        ("*.pyc\n", "a/b/c.pyc", False, True),
+        ("*.pyc\n", "a/b/c.py", False, False),
+        ("x\n", "x", False, True),
+        ("x\n", "deep/x", False, True),
+        ("x\n", "prefix_x", False, False),
+        ("**/x\n", "x", False, True),
+        ("**/x\n", "a/b/x", False, True),
+        ("**/x\n", "a/bx", False, False),
+        ("foo/**/x\n", "foo/x", False, True),
+        ("foo/**/x\n", "foo/a/b/x", False, True),
+        ("foo/**/x\n", "foo/prefix_x", False, False),
+        ("foo/**\n", "foo/a/b", False, True),
+        ("foo/**\n", "foo", True, False),
+        ("/build\n", "build", True, True),
+        ("/build\n", "src/build", True, False),
+        ("docs/*.md\n", "docs/a.md", False, True),
+        ("docs/*.md\n", "docs/sub/a.md", False, False),
+        ("logs/\n", "logs", True, True),
+        ("logs/\n", "logs", False, False),
+        ("*.log\n!keep.log\n", "keep.log", False, False),
+        ("*.log\n!keep.log\n", "other.log", False, True),
+        ("file[0-9].txt\n", "file7.txt", False, True),
+        ("file[!0-9].txt\n", "file7.txt", False, False),
+        ("a?c\n", "a/c", False, False),
+        ("# comment\n\n", "# comment", False, False),
+    ],
+)
+def test_patterns(tmp_path, rules, path, is_dir, expected):
+    assert matcher(tmp_path, rules).ignored(path, is_dir) is expected
+
+
+def test_nested_gitignore_is_relative_to_its_directory(tmp_path):
+    ignore = matcher(tmp_path, "/out\n", "pkg")
+    assert ignore.ignored("pkg/out", True)
+    assert not ignore.ignored("out", True)
+    assert not ignore.ignored("pkg/src/out", True)
+
+
+def test_walk_directory_skips_ignored_entries(tmp_path):
+    (tmp_path / ".gitignore").write_text("foo/**/x\n*.tmp\n", encoding="utf-8")
+    for name in ("foo/x", "foo/a/x", "foo/prefix_x", "keep.txt", "drop.tmp"):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("", encoding="utf-8")
+
+    paths = [rel_path for rel_path, *_ in llm_query.walk_directory(str(tmp_path))]
+
+    assert paths == ["foo", "foo/a", "foo/prefix_x", "keep.txt"]
+
+
+def test_walk_from_subdirectory_applies_workspace_gitignore(tmp_path):
+    llm_query._git_root.cache_clear()
+    (tmp_path / ".git").mkdir()
+    (tmp_path / ".gitignore").write_text("*.o\n/pkg/generated/\n", encoding="utf-8")
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / ".gitignore").write_text("/local.txt\n", encoding="utf-8")
+    for name in ("pkg/src/a.c", "pkg/src/a.o", "pkg/generated/x.c", "pkg/sub/local.txt", "pkg/sub/b.c"):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("", encoding="utf-8")
+
+    paths = [rel_path for rel_path, *_ in llm_query.walk_directory(str(tmp_path / "pkg"))]
+    assert paths == ["src", "src/a.c", "sub", "sub/b.c", "sub/local.txt"]
+
+    paths = [rel_path for rel_path, *_ in llm_query.walk_directory(str(tmp_path / "pkg" / "sub"))]
+    assert paths == ["b.c", "local.txt"]
+    llm_query._git_root.cache_clear()
@@ -0,0 +1,86 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import llm_query
+
+
+def read_stats(directory):
+    with open(directory / "stats.json", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_concurrent_stat_updates_are_not_lost(response_cache_dir):
+    def record(field):
+        for _ in range(50):
+            llm_query._record_cache_stat(field)
+
+    threads = [threading.Thread(target=record, args=(field,)) for field in ("hits", "misses") * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = read_stats(response_cache_dir)
+    assert (stats["hits"], stats["misses"]) == (200, 200)
+    assert not list(response_cache_dir.glob("*.tmp"))
+
+
+def test_round_trip_and_expiry(response_cache_dir):
+    key = llm_query._response_cache_key("http://api", "model", [{"role": "user", "content": "hi"}])
+    llm_query._write_response_cache(key, "model", "answer", "")
+
+    assert llm_query._read_response_cache(key)["content"] == "answer"
+    path = llm_query._response_cache_path(key)
+    old = time.time() - llm_query.RESPONSE_CACHE_MAX_AGE - 10
+    os.utime(path, (old, old))
+    assert llm_query._read_response_cache(key) is None
+
+
+def test_eviction_only_when_over_budget(response_cache_dir, monkeypatch):
+    sweeps = []
+    evict = llm_query._evict_response_cache
+
+    def counting_evict():
+        sweeps.append(1)
+        return evict()
+
+    monkeypatch.setattr(llm_query, "_evict_response_cache", counting_evict)
+    monkeypatch.setattr(llm_query, "RESPONSE_CACHE_MAX_BYTES", 1000)
+    keys = [f"{index:02x}" + "0" * 62 for index in range(8)]
+
+    def write(index):
+        llm_query._write_response_cache(keys[index], "model", "x" * 200, "")
+        # 按写入顺序设定使用时间，淘汰顺序确定
+        stamp = time.time() - 100 + index
+        os.utime(llm_query._response_cache_path(keys[index]), (stamp, stamp))
+
+    write(0)
+    # 首次写入没有清理记录，会做一次全量清理
+    assert len(sweeps) == 1
+    write(1)
+    write(2)
+    assert len(sweeps) == 1
+
+    for index in range(3, len(keys)):
+        write(index)
+    assert len(sweeps) >= 2
+    remaining = list(response_cache_dir.glob("*/*.json"))
+    assert sum(path.stat().st_size for path in remaining) <= 1000
+    # 最早使用的条目先被淘汰
+    assert not llm_query._response_cache_path(keys[0]).exists()
+    assert llm_query._response_cache_path(keys[-1]).exists()
+    assert read_stats(response_cache_dir)["bytes"] <= 1000
+
+
+def test_stats_work_without_fcntl(response_cache_dir, monkeypatch):
+    # Windows没有fcntl，统计退回只用线程锁
+    monkeypatch.setitem(sys.modules, "fcntl", None)
+    llm_query._record_cache_stat("hits")
+    key = "ab" + "0" * 62
+    llm_query._write_response_cache(key, "model", "answer", "")
+
+    assert read_stats(response_cache_dir)["hits"] == 1
+    assert llm_query._read_response_cache(key)["content"] == "answer"
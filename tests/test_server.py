@@ -0,0 +1,381 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+pytest.importorskip("tornado")
+pytest.importorskip("markitdown")
+
+import server
+from convert_tasks import echo_or_hang, no_init
+
+
+class EchoPool(server.ConversionPool):
+    task = staticmethod(echo_or_hang)
+
+    def _new_executor(self):
+        return server.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=server.multiprocessing.get_context("spawn"),
+            initializer=no_init,
+        )
+
+
+@pytest.fixture
+def pool():
+    pools = []
+
+    def make(workers=1, timeout=2):
+        pool = EchoPool(workers, 1024, timeout)
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def test_conversion_limits(pool):
+    conversions = pool()
+
+    async def run():
+        assert await conversions.convert("ok") == "ok"
+        with pytest.raises(server.HtmlTooLargeError):
+            await conversions.convert("x" * 2048)
+
+    asyncio.run(run())
+    assert conversions.stats["completed"] == 1
+    assert conversions.stats["too_large"] == 1
+
+
+def test_timeout_replaces_stuck_worker(pool):
+    conversions = pool(workers=1, timeout=1)
+
+    async def run():
+        with pytest.raises(server.ConvertTimeoutError):
+            await conversions.convert("hang")
+        # 唯一的工作进程被终止并替换，后续任务不会在队列里超时
+        return await conversions.convert("ok")
+
+    assert asyncio.run(run()) == "ok"
+    assert conversions.stats["timed_out"] == 1
+    assert conversions.stats["workers_replaced"] == 1
+
+
+def test_jobs_broken_by_replacement_are_resubmitted(pool):
+    conversions = pool(workers=1, timeout=2)
+
+    async def run():
+        hang = asyncio.ensure_future(conversions.convert("hang"))
+        await asyncio.sleep(0.5)
+        start = time.monotonic()
+        result = await conversions.convert("queued")
+        with pytest.raises(server.ConvertTimeoutError):
+            await hang
+        return result, time.monotonic() - start
+
+    result, elapsed = asyncio.run(run())
+    assert result == "queued"
+    assert elapsed < 4
+    assert conversions.stats["resubmitted"] == 1
+    assert conversions.pending == 0
+
+
+def test_truncate_markdown_at_line_end():
+    text = "first line\nsecond line\nthird line\n"
+
+    assert server.truncate_markdown(text) == (text, False)
+    assert server.truncate_markdown(text, max_bytes=1000) == (text, False)
+    truncated, flag = server.truncate_markdown(text, max_bytes=25)
+    assert flag
+    assert truncated.split("\n\n[内容已截断")[0] == "first line\nsecond line\n"
+
+    truncated, flag = server.truncate_markdown(text, max_tokens=3)
+    assert flag
+    assert truncated.split("\n\n[内容已截断")[0] == "first line\n"
+
+
+def test_truncate_markdown_cuts_inside_an_oversized_first_line():
+    text = "中文" * 100 + "\nnext\n"
+
+    truncated, flag = server.truncate_markdown(text, max_bytes=10)
+    content = truncated.split("\n\n[内容已截断")[0]
+    assert flag
+    # 10字节落在第4个汉字中间，退回到字符边界
+    assert content == "中文中"
+
+    truncated, flag = server.truncate_markdown("a" * 1000, max_tokens=5)
+    content = truncated.split("\n\n[内容已截断")[0]
+    assert flag
+    assert content == "a" * 20
+    assert server.estimate_tokens(content) <= 5
+
+
+class FakeBrowser:
+    """代替浏览器扩展的WebSocket连接，按URL设定的延迟返回HTML或错误"""
+
+    def __init__(self, scheduler, delays=None, answer_cancel=True):
+        self.client_id = "fake"
+        self.scheduler = scheduler
+        # 延迟为None的URL永远不返回
+        self.delays = delays or {}
+        self.answer_cancel = answer_cancel
+        self.requests = []
+        self.cancels = []
+        self.dispatched = {}
+
+    def write_message(self, message):
+        request = json.loads(message)
+        loop = asyncio.get_running_loop()
+        if request["type"] == "cancel":
+            self.cancels.append(request["requestId"])
+            if self.answer_cancel:
+                loop.call_soon(self.scheduler.reject, self.client_id, request["requestId"], "已取消")
+            return
+        self.requests.append(request["url"])
+        self.dispatched[request["url"]] = time.monotonic()
+        delay = self.delays.get(request["url"], 0)
+        if delay is not None:
+            loop.call_later(delay, self.answer, request)
+
+    def answer(self, request):
+        if "fail" in request["url"]:
+            self.scheduler.reject(self.client_id, request["requestId"], "boom")
+        else:
+            self.scheduler.resolve(self.client_id, request["requestId"], f"<p>{request['url']}</p>")
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    fresh = server.Metrics()
+    monkeypatch.setattr(server, "metrics", fresh)
+    return fresh
+
+
+def stage_total(metrics, stage):
+    counts, total = metrics.stage_seconds.series[(("stage", stage),)]
+    return sum(counts), total
+
+
+def test_browser_stage_excludes_queue_wait(metrics):
+    scheduler = server.BrowserScheduler(1, 4)
+    browser = FakeBrowser(scheduler, {"http://a": 0.3, "http://b": 0.1})
+
+    async def run():
+        scheduler.add_client(browser)
+        return await asyncio.gather(scheduler.fetch_html("http://a"), scheduler.fetch_html("http://b"))
+
+    assert asyncio.run(run()) == ["<p>http://a</p>", "<p>http://b</p>"]
+    count, browser_seconds = stage_total(metrics, "browser")
+    assert count == 2
+    # b在队列中等待a的0.3秒不计入browser阶段
+    assert 0.35 <= browser_seconds < 0.55
+    count, queue_seconds = stage_total(metrics, "queue")
+    assert count == 2
+    assert 0.25 <= queue_seconds < 0.45
+
+
+@pytest.fixture
+def live_server(tmp_path, monkeypatch, metrics, pool):
+    """在随机端口上启动转换服务，浏览器和转换进程池都用测试替身"""
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.httpserver import HTTPServer
+    from tornado.testing import bind_unused_port
+
+    scheduler = server.BrowserScheduler(2, 8)
+    browser = FakeBrowser(scheduler)
+    monkeypatch.setattr(server, "scheduler", scheduler)
+    monkeypatch.setattr(server, "inflight_conversions", {})
+    monkeypatch.setattr(
+        server, "convert_cache", server.ConvertCache(str(tmp_path / "convert.db"), 3600, 100)
+    )
+    monkeypatch.setattr(server, "conversion_pool", pool(workers=1, timeout=10))
+
+    def run(scenario):
+        async def main():
+            sock, port = bind_unused_port()
+            http_server = HTTPServer(server.make_app())
+            http_server.add_sockets([sock])
+            scheduler.add_client(browser)
+            client = AsyncHTTPClient()
+
+            async def fetch(path, **kwargs):
+                return await client.fetch(f"{fetch.base}{path}", raise_error=False, **kwargs)
+
+            fetch.base = f"http://127.0.0.1:{port}"
+
+            try:
+                return await scenario(fetch)
+            finally:
+                http_server.stop()
+
+        return asyncio.run(main())
+
+    run.browser = browser
+    return run
+
+
+def test_metrics_endpoint(live_server):
+    async def scenario(fetch):
+        assert (await fetch("/convert?url=http://a")).code == 200
+        assert (await fetch("/convert?url=http://fail")).code == 502
+        return await fetch("/metrics")
+
+    response = live_server(scenario)
+    body = response.body.decode()
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert '# TYPE convert_stage_seconds histogram' in body
+    assert 'convert_stage_seconds_count{stage="browser"} 2' in body
+    assert 'convert_stage_seconds_count{stage="convert"} 1' in body
+    assert 'convert_requests_total{endpoint="/convert",status="200"} 1' in body
+    assert 'convert_requests_total{endpoint="/convert",status="502"} 1' in body
+    assert 'convert_errors_total{type="ExtractError"} 1' in body
+    assert 'convert_page_bytes_bucket{kind="html",le="+Inf"} 1' in body
+
+
+def batch_lines(response):
+    return [json.loads(line) for line in response.body.decode().splitlines()]
+
+
+def post_batch(fetch, body):
+    return fetch("/convert/batch", method="POST", body=json.dumps(body))
+
+
+def test_batch_streams_results_in_completion_order(live_server):
+    live_server.browser.delays = {"http://slow": 0.3}
+
+    async def scenario(fetch):
+        first = await post_batch(fetch, {"items": ["http://slow", {"url": "http://fast"}, "http://fail"]})
+        again = await post_batch(fetch, {"items": ["http://fast"]})
+        return first, again
+
+    first, again = live_server(scenario)
+    assert first.code == 200
+    assert first.headers["Content-Type"] == "application/x-ndjson"
+    lines = batch_lines(first)
+    # 慢页面最后返回，其它结果不等它
+    assert lines[-1]["url"] == "http://slow"
+    assert len(lines) == 3
+    by_index = {line["index"]: line for line in lines}
+    assert by_index[0]["markdown"] == "<p>http://slow</p>"
+    assert (by_index[1]["status"], by_index[1]["cache"]) == (200, "MISS")
+    assert by_index[2]["status"] == 502
+    assert "boom" in by_index[2]["error"]
+    assert batch_lines(again)[0]["cache"] == "HIT"
+
+
+def test_batch_shares_duplicate_urls(live_server):
+    live_server.browser.delays = {"http://dup": 0.2}
+
+    async def scenario(fetch):
+        return await post_batch(fetch, {"items": ["http://dup", "http://dup"]})
+
+    lines = batch_lines(live_server(scenario))
+    assert sorted(line["cache"] for line in lines) == ["MISS", "SHARED"]
+    assert live_server.browser.requests == ["http://dup"]
+
+
+def test_batch_truncation_per_item(live_server):
+    async def scenario(fetch):
+        return await post_batch(
+            fetch,
+            {"items": ["http://a", {"url": "http://b", "max_tokens": 100}], "max_tokens": 2},
+        )
+
+    by_url = {line["url"]: line for line in batch_lines(live_server(scenario))}
+    assert by_url["http://a"]["truncated"] is True
+    assert by_url["http://b"]["truncated"] is False
+    assert by_url["http://b"]["markdown"] == "<p>http://b</p>"
+
+
+def test_batch_rejects_bad_requests(live_server, monkeypatch):
+    monkeypatch.setattr(server, "CONVERT_BATCH_MAX", 2)
+
+    async def scenario(fetch):
+        return [
+            await fetch("/convert/batch", method="POST", body="not json"),
+            await post_batch(fetch, {"items": [{"is_news": True}]}),
+            await post_batch(fetch, {"items": ["http://a", "http://b", "http://c"]}),
+        ]
+
+    invalid, missing_url, too_many = live_server(scenario)
+    assert invalid.code == 400
+    assert missing_url.code == 400
+    assert too_many.code == 413
+    assert live_server.browser.requests == []
+
+
+def test_client_batch_fetch(live_server, monkeypatch):
+    pytest.importorskip("requests")
+    import llm_query
+
+    live_server.browser.delays = {"http://slow": 0.2}
+
+    async def scenario(fetch):
+        monkeypatch.setattr(llm_query, "CONVERT_SERVER", fetch.base)
+        results = [None] * 3
+        items = [("http://slow", False), ("http://fast", False), ("http://fail", False)]
+        return await asyncio.to_thread(llm_query.fetch_urls_batch, items, results)
+
+    results = live_server(scenario)
+    assert results[:2] == ["<p>http://slow</p>", "<p>http://fast</p>"]
+    assert results[2].startswith("获取URL内容失败: Extraction failed")
+
+
+@pytest.mark.parametrize("answer_cancel", [True, False])
+def test_timed_out_job_holds_browser_slot_until_cancelled(metrics, monkeypatch, answer_cancel):
+    monkeypatch.setattr(server, "BROWSER_TIMEOUT", 0.1)
+    monkeypatch.setattr(server, "BROWSER_CANCEL_GRACE", 0.3)
+    scheduler = server.BrowserScheduler(1, 4)
+    browser = FakeBrowser(scheduler, {"http://hang": None}, answer_cancel=answer_cancel)
+
+    async def run():
+        scheduler.add_client(browser)
+        with pytest.raises(server.gen.TimeoutError):
+            await scheduler.fetch_html("http://hang")
+        assert len(browser.cancels) == 1
+        await asyncio.sleep(0.05)
+        held = scheduler._pick_client() is None
+        await asyncio.sleep(0.3)
+        return held, await scheduler.fetch_html("http://next")
+
+    held, second = asyncio.run(run())
+    # 浏览器确认取消后立即释放名额；不回复时保留到宽限期结束
+    assert held is not answer_cancel
+    assert second == "<p>http://next</p>"
+    assert scheduler.inflight["fake"] == {}
+    assert stage_total(metrics, "browser")[0] == 1
+
+
+def test_client_falls_back_to_concurrent_single_fetches(monkeypatch):
+    pytest.importorskip("requests")
+    import llm_query
+    from tornado import web
+    from tornado.httpserver import HTTPServer
+    from tornado.testing import bind_unused_port
+
+    class OldConvertHandler(web.RequestHandler):
+        """没有/convert/batch的旧版服务，每个页面需要0.3秒"""
+
+        async def get(self):
+            await asyncio.sleep(0.3)
+            self.write(f"# {self.get_query_argument('url')}\n")
+
+    async def main():
+        sock, port = bind_unused_port()
+        http_server = HTTPServer(web.Application([(r"/convert", OldConvertHandler)]))
+        http_server.add_sockets([sock])
+        monkeypatch.setattr(llm_query, "CONVERT_SERVER", f"http://127.0.0.1:{port}")
+        items = [(f"http://page{n}", False) for n in range(4)]
+        results = [None] * len(items)
+        start = time.monotonic()
+        try:
+            await asyncio.to_thread(llm_query.fetch_urls_batch, items, results)
+        finally:
+            http_server.stop()
+        return results, time.monotonic() - start
+
+    results, elapsed = asyncio.run(main())
+    assert results == [f"# http://page{n}\n" for n in range(4)]
+    assert elapsed < 0.9
@@ -0,0 +1,34 @@
+import llm_query
+
+
+def test_oversized_line_fills_the_budget():
+    line = "x" * (9000 * 4) + "\n"
+    pieces = llm_query._split_oversized(line, 8192)
+
+    assert "".join(pieces) == line
+    assert [llm_query.estimate_tokens(piece) for piece in pieces] == [8192, 809]
+
+
+def test_oversized_cjk_line():
+    line = "中" * 25 + "\n"
+    pieces = llm_query._split_oversized(line, 10)
+
+    assert "".join(pieces) == line
+    assert [llm_query.estimate_tokens(piece) for piece in pieces] == [10, 10, 6]
+
+
+def test_lines_are_packed_up_to_the_budget():
+    text = "".join(f"line{n:03d}\n" for n in range(100))
+    pieces = llm_query._split_oversized(text, 20)
+
+    assert "".join(pieces) == text
+    assert all(llm_query.estimate_tokens(piece) <= 20 for piece in pieces)
+    assert all(piece.endswith("\n") for piece in pieces)
+
+
+def test_split_code_respects_budget():
+    code = "".join(f"def f{n}():\n    return {n}\n\n\n" for n in range(20))
+    chunks = llm_query.split_code(code, 30, "example.txt")
+
+    assert "".join(chunks) == code
+    assert all(llm_query.estimate_tokens(chunk) <= 30 for chunk in chunks)
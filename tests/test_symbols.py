@@ -0,0 +1,96 @@
+import pytest
+
+import llm_query
+
+pytest.importorskip("tree_sitter")
+pytest.importorskip("tree_sitter_python")
+
+SOURCE = '''\
+def foo_bar():
+    return 1
+
+
+def fooXbar():
+    return 2
+
+
+class Outer:
+    def run(self):
+        return "outer"
+
+
+class Other:
+    def run(self):
+        return "other"
+
+
+class A_B:
+    def step(self):
+        return "underscore"
+
+
+class Wrapper:
+    class AxB:
+        def step(self):
+            return "wildcard"
+'''
+
+
+@pytest.fixture
+def module(workspace):
+    path = workspace / "mod.py"
+    path.write_text(SOURCE, encoding="utf-8")
+    return path
+
+
+def test_extract_symbols(module):
+    symbols = llm_query.extract_symbols(SOURCE, str(module))
+    qualnames = [symbol[1] for symbol in symbols]
+    assert qualnames == [
+        "foo_bar",
+        "fooXbar",
+        "Outer",
+        "Outer.run",
+        "Other",
+        "Other.run",
+        "A_B",
+        "A_B.step",
+        "Wrapper",
+        "Wrapper.AxB",
+        "Wrapper.AxB.step",
+    ]
+
+
+def test_underscore_is_not_a_wildcard(module):
+    result = llm_query.find_symbol("foo_bar")
+    assert "符号 foo_bar (" in result
+    assert "fooXbar" not in result
+
+    result = llm_query.find_symbol("A_B.step")
+    assert 'return "underscore"' in result
+    assert "Wrapper.AxB.step" not in result
+
+
+def test_qualified_name_selects_one_definition(module):
+    result = llm_query.find_symbol("Outer.run")
+    assert 'return "outer"' in result
+    assert 'return "other"' not in result
+    assert 'return "outer"' in llm_query.find_symbol("Outer::run")
+
+
+def test_unqualified_name_matches_all_definitions(module):
+    result = llm_query.find_symbol("run")
+    assert 'return "outer"' in result
+    assert 'return "other"' in result
+
+
+def test_nested_suffix_match(module):
+    assert 'return "wildcard"' in llm_query.find_symbol("AxB.step")
+
+
+def test_unknown_symbol(module):
+    assert "没有找到符号 missing_name" in llm_query.find_symbol("missing_name")
+
+
+def test_line_range_directive_lines(module):
+    assert llm_query.read_line_range(str(module), 1, 2) == "def foo_bar():\n    return 1\n"
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+
+import pytest
+
+import llm_query
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def timing(monkeypatch, response_cache_dir, tmp_path):
+    record = {}
+    monkeypatch.setattr(llm_query, "INVOCATION_TIMING", record)
+    monkeypatch.setattr(llm_query, "LOGS_DIR", tmp_path / "logs")
+    monkeypatch.setattr(llm_query, "TIMING_LOG_FILE", tmp_path / "logs" / "timings.jsonl")
+    monkeypatch.setitem(llm_query.RESPONSE_CACHE_OPTIONS, "mode", "use")
+    key = llm_query._response_cache_key("http://api", "model", MESSAGES)
+    llm_query._write_response_cache(key, "model", "cached answer", "")
+    return record
+
+
+def timed_request(emitted):
+    start = time.perf_counter()
+    emit = llm_query._timed_emit(lambda kind, text: emitted.append(text), start)
+    content, reasoning = llm_query.stream_chat_completion("key", "http://api", "model", MESSAGES, emit)
+    llm_query._record_request_timing("model", "http://api", MESSAGES, content, reasoning, start, emit)
+    return content
+
+
+def test_only_timed_requests_count_cache_hits(timing):
+    # 摘要请求走同一个缓存，但不经_timed_emit，不应计入
+    summary, _ = llm_query.stream_chat_completion(
+        "key", "http://api", "model", MESSAGES, emit=lambda kind, text: None
+    )
+    assert summary == "cached answer"
+    assert "cache_hits" not in timing
+
+    emitted = []
+    assert timed_request(emitted) == "cached answer"
+    assert emitted == ["cached answer"]
+    assert timing["requests"] == 1
+    assert timing["cache_hits"] == 1
+
+
+def test_concurrent_requests_count_every_hit(timing):
+    threads = [threading.Thread(target=timed_request, args=([],)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert timing["requests"] == timing["cache_hits"] == 8
+
+
+def test_timing_stats_skips_fully_cached_invocations(timing, capsys):
+    llm_query.LOGS_DIR.mkdir()
+    records = [
+        {"model": "m", "requests": 1, "cache_hits": 0, "request_ms": 100.0, "total_ms": 150.0},
+        {"model": "m", "requests": 1, "cache_hits": 0, "request_ms": 300.0, "total_ms": 350.0},
+        {"model": "m", "requests": 1, "cache_hits": 1, "request_ms": 1.0, "total_ms": 5.0},
+        {"model": "m", "requests": 2, "cache_hits": 1, "request_ms": 200.0, "total_ms": 250.0},
+    ]
+    with open(llm_query.TIMING_LOG_FILE, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        f.write("{broken\n")
+
+    llm_query.timing_stats()
+
+    output = capsys.readouterr().out
+    assert "m  (3 次调用)" in output
+    request_line = next(line for line in output.splitlines() if "模型请求" in line)
+    assert request_line.split()[1:] == ["200.0", "300.0", "300.0"]
+
+
+def test_write_timing_record(timing):
+    timed_request([])
+    llm_query.write_timing_record("query")
+
+    with open(llm_query.TIMING_LOG_FILE, encoding="utf-8") as f:
+        record = json.loads(f.readline())
+    assert record["mode"] == "query"
+    assert record["model"] == "model"
+    assert (record["requests"], record["cache_hits"]) == (1, 1)
+    assert "generation_ms" not in record
@@ -0,0 +1,49 @@
+import os
+
+import llm_query
+
+
+def stored_line_index(cache, path):
+    return (
+        cache.connect()
+        .execute("SELECT line_index FROM files WHERE path = ?", (str(path),))
+        .fetchone()[0]
+    )
+
+
+def test_find_workspace_root(workspace, tmp_path):
+    nested = workspace / "a" / "b"
+    nested.mkdir(parents=True)
+    (nested / "c.py").write_text("", encoding="utf-8")
+
+    assert llm_query.find_workspace_root(str(nested / "c.py")) == str(workspace)
+    assert llm_query.find_workspace_root(str(nested)) == str(workspace)
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    assert llm_query.find_workspace_root(str(outside)) == os.getcwd()
+
+
+def test_cache_hit_and_invalidation(workspace):
+    path = workspace / "a.txt"
+    path.write_text("one\n", encoding="utf-8")
+
+    assert llm_query.read_file_context(str(path)) == (True, "one\n")
+    path.write_text("changed\n", encoding="utf-8")
+    assert llm_query.read_file_context(str(path)).content == "changed\n"
+
+    path.write_bytes(b"\x00\x01binary")
+    assert not llm_query.read_file_context(str(path)).is_text
+
+
+def test_line_index_is_built_lazily(workspace):
+    path = workspace / "lines.txt"
+    path.write_text("".join(f"line {n}\n" for n in range(1, 11)), encoding="utf-8")
+    cache = llm_query.get_workspace_cache(str(workspace))
+
+    llm_query.read_file_context(str(path))
+    assert stored_line_index(cache, path) is None
+
+    assert llm_query.read_line_range(str(path), 3, 4) == "line 3\nline 4\n"
+    assert stored_line_index(cache, path) is not None
+    assert llm_query.read_line_range(str(path), 10, 20) == "line 10\n"
+    assert llm_query.read_line_range(str(path), 11, 12) == ""